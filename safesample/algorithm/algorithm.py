@@ -1,21 +1,91 @@
 from collections import defaultdict
 import itertools
+import multiprocessing
 import nltk
 import sqlparse
 import pprint
 
+import equivalence
 import ground_tup
 import incl_excl
 import ind_join
 import ind_proj
 import ind_union
+import plan_cache
 import query_exp
 import query_sym
 
 
-def getSafeQueryPlan(dnf):
+# Plans (and unsafe outcomes) of queries without separator replacements,
+# keyed on plan_cache.canonicalKey; the CLI may replace this with a cache
+# backed by a file
+planCache = plan_cache.PlanCache()
+
+# Safety decisions of isSafe, keyed the same way
+safetyCache = plan_cache.LRUCache(maxSize=16384)
+
+# Queries whose CNF has more disjuncts than this are treated as unsafe, so
+# that they are sampled instead of planned; None means no limit
+maxCNFDisjuncts = None
+
+
+# Hands out the SQL aliases and separator replacement ids of one query. Every
+# top-level call to getSafeQueryPlan, generateSQL_DNF and generateSQL_CNF
+# starts a new context, so identical queries compile to identical SQL and
+# queries can be compiled from several threads.
+# With a batchColumn, generateSQL_DNF evaluates the query in many sampled
+# worlds at once: sampled relations carry the world in batchColumn, every
+# subquery over a sampled relation is keyed on it like on a separator, and
+# batchTable lists all worlds (see generateBatchedSQL_DNF).
+# With materialize, a function from a subplan and its SQL to the SQL that
+# replaces it, the largest subplans reading no sampled relations are replaced
+# (see generateChildSQL_DNF), so that their rows can be computed once.
+class CompilationContext(object):
+
+    def __init__(self, batchColumn=None, batchTable=None, materialize=None):
+        self.aliasCounter = 0
+        self.separatorCounter = 0
+        self.batchColumn = batchColumn
+        self.batchTable = batchTable
+        self.materialize = materialize
+
+    def counter(self):
+        self.aliasCounter += 1
+        return self.aliasCounter
+
+    def attCounter(self):
+        self.separatorCounter += 1
+        return self.separatorCounter
+
+
+def getSafeQueryPlan(dnf, context=None):
+    # subqueries share the context of the query being compiled and carry its
+    # separator ids, so only top-level queries are cached
+    if context is not None or dnf.getUsedSeparators():
+        return buildSafeQueryPlan(dnf, context or CompilationContext())
+    key = plan_cache.canonicalKey(dnf)
+    cached = planCache.get(key)
+    if cached is not None:
+        (plan, unsafeMessage) = cached
+        if plan is None:
+            raise UnsafeException(unsafeMessage)
+        return plan
+    try:
+        plan = buildSafeQueryPlan(dnf, CompilationContext())
+    except CNFTooLargeException:
+        # depends on maxCNFDisjuncts, which may differ when the cache is
+        # loaded again
+        raise
+    except UnsafeException as e:
+        planCache.put(key, (None, str(e)))
+        raise
+    planCache.put(key, (plan, None))
+    return plan
+
+
+def buildSafeQueryPlan(dnf, context):
     if isinstance(dnf, query_exp.DNF):
-        cnf = dnf.toCNF().minimize()
+        cnf = dnf.toCNF(maxCNFDisjuncts).minimize()
     else:
         cnf = dnf.minimize()
 
@@ -23,58 +93,20 @@ def getSafeQueryPlan(dnf):
 
     if len(symbolComponentsDNF) > 1:
         termList = [query_exp.DNF((list(s))) for s in symbolComponentsDNF]
-        return ind_union.IndependentUnion(cnf, termList)
+        return ind_union.IndependentUnion(cnf, termList, context=context)
 
     symbolComponents = query_exp.computeSymbolComponentsCNF(cnf)
 
     # independent join
     if len(symbolComponents) > 1:
         termList = [query_exp.CNF(list(s)) for s in symbolComponents]
-        return ind_join.IndependentJoin(cnf, termList)
+        return ind_join.IndependentJoin(cnf, termList, context=context)
 
     # inclusion/exclusion
     if len(cnf.getDisjuncts()) > 1:
-        termList = []
-        coeffList = []
-
-        for x in powerset(cnf.getDisjuncts()):
-            if len(x):
-                termList.append(
-                    query_exp.CNF(
-                        [query_exp.DisjunctiveQuery(
-                            [c.copy() for d in x for c in d.getComponents()]
-                        )
-                        ]
-                    )
-                )
-                coeffList.append((-1) ** len(x))
-
-        lexpr = nltk.Expression.fromstring
-        for i in range(len(termList)):
-            if coeffList[i] == 0:
-                continue
-            for j in range(i + 1, len(termList)):
-                if coeffList[j] == 0:
-                    continue
-                p9termI = lexpr(termList[i].toProver9())
-                p9termJ = lexpr(termList[j].toProver9())
-                proverItoJ = nltk.Prover9Command(
-                    p9termJ, assumptions=[p9termI])
-                proverJtoI = nltk.Prover9Command(
-                    p9termI, assumptions=[p9termJ])
-                if proverItoJ.prove() and proverJtoI.prove():
-                    coeffList[i] += coeffList[j]
-                    coeffList[j] = 0
-
-        subplans = []
-        finalCoeffList = []
-        for ind, term in enumerate(termList):
-            if coeffList[ind] == 0:
-                continue
-            subplans.append(term)
-            finalCoeffList.append(coeffList[ind])
-
-        return incl_excl.InclusionExclusion(cnf, subplans, finalCoeffList)
+        (termList, coeffList) = inclusionExclusionTerms(cnf)
+        return incl_excl.InclusionExclusion(
+            cnf, termList, coeffList, context=context)
 
     d = cnf.getDisjuncts()[0]
     symbolComponents = query_exp.computeSymbolComponentsDisjunct(d)
@@ -86,19 +118,96 @@ def getSafeQueryPlan(dnf):
                 [query_exp.DisjunctiveQuery(list(s))]
             ) for s in symbolComponents]
 
-        return ind_union.IndependentUnion(cnf, termList)
+        return ind_union.IndependentUnion(cnf, termList, context=context)
 
     # ground tuple
     if not d.hasVariables():
         comInd = 0  # only one component in a ground tuple
         rel = d.getComponents()[comInd].getRelations()[comInd]
-        return ground_tup.GroundTuple(cnf, d, rel)
+        return ground_tup.GroundTuple(cnf, d, rel, context=context)
 
     # separator variable
-    separator = d.getSeparator()
-    if separator:
-        return ind_proj.IndependentProject(cnf, d, separator)
+    separators = d.getSeparators()
+    if separators and separators[0]:
+        return ind_proj.IndependentProject(
+            cnf, d, ind_proj.cheapestSeparator(d, separators),
+            context=context)
+
+    newDNF = rewriteDisjunct(d)
+    if newDNF is not None:
+        return getSafeQueryPlan(newDNF, context)
+    raise UnsafeException("FAIL")
+
+
+# Decides whether getSafeQueryPlan(dnf) would succeed by applying the same
+# rules, without building plan nodes. Decisions are memoized on the canonical
+# form of every subquery visited.
+def isSafe(dnf, context=None):
+    if context is None:
+        context = CompilationContext()
+    key = plan_cache.canonicalKey(dnf)
+    safe = safetyCache.get(key)
+    if safe is None:
+        if key in planCache:
+            safe = planCache.get(key)[0] is not None
+        else:
+            safe = decideSafety(dnf, context)
+        safetyCache.put(key, safe)
+    return safe
+
+
+# Mirrors buildSafeQueryPlan rule for rule
+def decideSafety(dnf, context):
+    if isinstance(dnf, query_exp.DNF):
+        try:
+            cnf = dnf.toCNF(maxCNFDisjuncts).minimize()
+        except CNFTooLargeException:
+            return False
+    else:
+        cnf = dnf.minimize()
+
+    symbolComponentsDNF = query_exp.computeSymbolComponentsDNF(dnf)
+    if len(symbolComponentsDNF) > 1:
+        return all(isSafe(query_exp.DNF(list(s)), context)
+                   for s in symbolComponentsDNF)
+
+    symbolComponents = query_exp.computeSymbolComponentsCNF(cnf)
+    if len(symbolComponents) > 1:
+        return all(isSafe(query_exp.CNF(list(s)), context)
+                   for s in symbolComponents)
+
+    if len(cnf.getDisjuncts()) > 1:
+        (termList, coeffList) = inclusionExclusionTerms(cnf)
+        return all(isSafe(term, context) for term in termList)
 
+    d = cnf.getDisjuncts()[0]
+    symbolComponents = query_exp.computeSymbolComponentsDisjunct(d)
+    if len(symbolComponents) > 1:
+        return all(isSafe(query_exp.CNF([query_exp.DisjunctiveQuery(list(s))]),
+                          context) for s in symbolComponents)
+
+    if not d.hasVariables():
+        return True
+
+    separators = d.getSeparators()
+    if separators and separators[0]:
+        # as in IndependentProject, but on a copy as no plan keeps d
+        separator = ind_proj.cheapestSeparator(d, separators)
+        d = d.copy()
+        d.applySeparator(separator, context.attCounter())
+        return isSafe(query_exp.DNF(
+            [query_exp.ConjunctiveQuery(query_exp.decomposeComponent(c))
+             for c in d.getComponents()]), context)
+
+    newDNF = rewriteDisjunct(d)
+    return newDNF is not None and isSafe(newDNF, context)
+
+
+# The rewriting rule: finds a conjunction of atoms of d that implies d, is
+# satisfiable, and is not contained in any component of d, and returns the
+# equivalent DNF in which it is a disjunct of its own. Returns None if there
+# is no such conjunction.
+def rewriteDisjunct(d):
     lexpr = nltk.Expression.fromstring
     p9d = lexpr(d.toProver9())
 
@@ -127,38 +236,218 @@ def getSafeQueryPlan(dnf):
                     query_exp.decomposeComponent(proposedComponent)))
                 for c in d.getComponents():
                     newConjQueries.append(query_exp.ConjunctiveQuery([c]))
-                newDNF = query_exp.DNF(newConjQueries)
-                return getSafeQueryPlan(newDNF)
-    raise UnsafeException("FAIL")
+                return query_exp.DNF(newConjQueries)
+    return None
+
+
+# Inclusion/exclusion over the lattice of distinct unions of the CNF's
+# disjuncts (Dalvi, Suciu 2012). A set of disjuncts stands for its closure,
+# the set of every disjunct implied by their union, so equivalent unions are
+# a single lattice element. The coefficient of an element is the sum of
+# (-1)^|S| over all sets S with that closure, i.e., the Mobius function of the
+# lattice, and terms whose coefficient is zero are never built.
+def inclusionExclusionTerms(cnf):
+    disjuncts = cnf.getDisjuncts()
+
+    def union(s):
+        return query_exp.DisjunctiveQuery(
+            [c.copy() for i in sorted(s) for c in disjuncts[i].getComponents()])
+
+    def closure(s):
+        u = union(s)
+        return frozenset(
+            [i for i in range(len(disjuncts))
+             if i in s or equivalence.containedIn(disjuncts[i], u)])
+
+    termList = []
+    coeffList = []
+    for (s, coeff) in mobiusCoefficients(len(disjuncts), closure):
+        termList.append(query_exp.CNF([union(s)]))
+        coeffList.append(coeff)
+    return (termList, coeffList)
+
+
+# Returns (closed set, coefficient) pairs for the non-empty closed subsets of
+# range(n) with a non-zero coefficient, smallest sets first. The lattice is
+# generated by closing singletons and joins, which never visits more sets
+# than the lattice has elements times n.
+def mobiusCoefficients(n, closure):
+    closures = {}
+
+    def cachedClosure(s):
+        if s not in closures:
+            closures[s] = closure(s)
+        return closures[s]
+
+    elements = set()
+    frontier = [cachedClosure(frozenset([i])) for i in range(n)]
+    while frontier:
+        e = frontier.pop()
+        if e in elements:
+            continue
+        elements.add(e)
+        for i in range(n):
+            if i not in e:
+                frontier.append(cachedClosure(e.union([i])))
+
+    ordered = sorted(elements, key=lambda e: (len(e), sorted(e)))
+    coeffs = {}
+    for e in ordered:
+        # the empty set (bottom of the lattice) contributes 1
+        coeffs[e] = -(1 + sum(coeffs[f] for f in ordered
+                              if len(f) < len(e) and f < e))
+    return [(e, coeffs[e]) for e in ordered if coeffs[e] != 0]
 
 
 # TODO(ericgribkoff) Should be aware of already-deterministic relations
 def findSafeResidualQuery(dnf):
-    relations = dnf.getRelations()
-    relNames = set()
-    for rel in relations:
-        relName = rel.getName()
-        relNames.add(relName)
+    relNames = set([rel.getName() for rel in dnf.getRelations()])
     for rels in powerset(relNames):
         if len(rels) == 0:
             continue
         residualDNF = dnf.copyWithDeterminism(set(rels))
-        try:
-            plan = getSafeQueryPlan(residualDNF)
-            sql = plan.generateSQL_DNF()
-            relsObjects = []
-            relObjectsAdded = {}
-            for rel in residualDNF.getRelations():
-                relName = rel.getName()
-                if relName in rels and relName not in relObjectsAdded:
-                    relsObjects.append(rel)
-                    relObjectsAdded[relName] = 1
-            return (rels, residualDNF, sql, relsObjects)
-        except UnsafeException:
-            pass
+        if isSafe(residualDNF):
+            sql = getSafeQueryPlan(residualDNF).generateSQL_DNF()
+            return (rels, residualDNF, sql,
+                    sampledRelationObjects(residualDNF, rels))
     raise UnsafeException("NO SAFE RESIDUAL QUERY FOUND")
 
 
+# Returns SQL giving the probability of the plan's query in each world of
+# batchTable, as rows (batchColumn, pUse) ordered by world. Worlds in which
+# the query has no answer get probability 0.
+def generateBatchedSQL_DNF(plan, batchColumn='sample_id',
+                           batchTable='sample_ids', materialize=None):
+    context = CompilationContext(batchColumn, batchTable, materialize)
+    sql = plan.generateSQL_DNF(None, context)
+    if plan.usesSampledRelations():
+        return ("select %s.%s, COALESCE(q.pUse, 0) as pUse from %s "
+                "LEFT OUTER JOIN (%s) as q ON q.%s = %s.%s order by %s.%s" % (
+                    batchTable, batchColumn, batchTable, sql, batchColumn,
+                    batchTable, batchColumn, batchTable, batchColumn))
+    return "select %s.%s, q.pUse from %s, (%s) as q order by %s.%s" % (
+        batchTable, batchColumn, batchTable, sql, batchTable, batchColumn)
+
+
+# The SQL of a child of plan. A child reading no sampled relations under a
+# plan that does is replaced by the materialize function of the context.
+def generateChildSQL_DNF(plan, child, separatorSubs, context):
+    sql = child.generateSQL_DNF(separatorSubs, context)
+    if (context.materialize is not None and plan.usesSampledRelations() and
+            not child.usesSampledRelations()):
+        sql = context.materialize(child, sql)
+    return sql
+
+
+# Wraps a subquery that does not read sampled relations so that it has a row
+# for each of its rows in every world of the batch
+def liftToBatch(sql, context):
+    ident = context.counter()
+    return ("\n -- every sampled world \n select %s.%s, q%d.* from (%s) as "
+            "q%d, %s" % (context.batchTable, context.batchColumn, ident, sql,
+                         ident, context.batchTable))
+
+
+# The first non-null value of column among the subqueries q<ident>, for
+# columns of subqueries combined with full outer joins
+def coalesceColumn(idents, column):
+    columns = ["q%d.%s" % (ident, column) for ident in idents]
+    if len(columns) == 1:
+        return columns[0]
+    return "COALESCE(%s)" % ", ".join(columns)
+
+
+# Plans every residual query sampling a given number of relations, in a pool
+# of processes (processes=1 plans in this process), starting with a single
+# relation and stopping at the first size that has a safe residual. The safe
+# residuals are ranked by residualCost and returned as a list of
+# (rels, residualDNF, plan, relsObjects, cost), cheapest first, together with
+# the SQL of the cheapest one. cardinalities maps relation names to their
+# number of tuples.
+def findRankedSafeResidualQueries(dnf, cardinalities=None, processes=None):
+    relNames = sorted(set([rel.getName() for rel in dnf.getRelations()]))
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+    ranked = []
+    try:
+        for size in range(1, len(relNames) + 1):
+            candidates = [(dnf, rels)
+                          for rels in itertools.combinations(relNames, size)]
+            if pool is None:
+                results = map(planResidualCandidate, candidates)
+            else:
+                results = pool.map(planResidualCandidate, candidates)
+            for (rels, residualDNF, key, plan) in results:
+                # the workers' caches die with them, keep their results
+                safetyCache.put(key, plan is not None)
+                if plan is not None:
+                    planCache.put(key, (plan, None))
+                    relsObjects = sampledRelationObjects(residualDNF, rels)
+                    ranked.append((rels, residualDNF, plan, relsObjects,
+                                   residualCost(plan, rels, cardinalities)))
+            if ranked:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if not ranked:
+        raise UnsafeException("NO SAFE RESIDUAL QUERY FOUND")
+    ranked.sort(key=lambda candidate: candidate[4])
+    return (ranked[0][2].generateSQL_DNF(), ranked)
+
+
+# Runs in the pool, so it only returns picklable values
+def planResidualCandidate(candidate):
+    (dnf, rels) = candidate
+    residualDNF = dnf.copyWithDeterminism(set(rels))
+    key = plan_cache.canonicalKey(residualDNF)
+    if not isSafe(residualDNF):
+        return (rels, residualDNF, key, None)
+    # the plan is needed for its cost, its SQL is not
+    return (rels, residualDNF, key, getSafeQueryPlan(residualDNF))
+
+
+def sampledRelationObjects(residualDNF, rels):
+    relsObjects = []
+    relObjectsAdded = {}
+    for rel in residualDNF.getRelations():
+        relName = rel.getName()
+        if relName in rels and relName not in relObjectsAdded:
+            relsObjects.append(rel)
+            relObjectsAdded[relName] = 1
+    return relsObjects
+
+
+# Every sample instantiates the sampled relations and runs the plan's SQL
+# once, so residuals are compared by the number of tuples sampled, then by
+# the number of joins and the depth of the plan. Without cardinalities, only
+# the plan shape is compared.
+def residualCost(plan, rels, cardinalities=None):
+    sampledTuples = 0
+    if cardinalities:
+        sampledTuples = sum([cardinalities.get(r, 0) for r in rels])
+    return (sampledTuples, planJoins(plan), planDepth(plan))
+
+
+def getPlanChildren(plan):
+    if isinstance(plan, ind_proj.IndependentProject):
+        return [plan.child] if plan.child is not None else []
+    # inclusion/exclusion terms are plain numbers for some datasets
+    return [c for c in getattr(plan, 'children', [])
+            if not isinstance(c, int)]
+
+
+def planJoins(plan):
+    children = getPlanChildren(plan)
+    return max(0, len(children) - 1) + sum(map(planJoins, children))
+
+
+def planDepth(plan):
+    return 1 + max([0] + map(planDepth, getPlanChildren(plan)))
+
+
 def getPrettySQL(sql):
     return sqlparse.format(sql,  reindent=True, keyword_case='upper')
 
@@ -167,25 +456,12 @@ class UnsafeException(Exception):
     pass
 
 
+class CNFTooLargeException(UnsafeException):
+    pass
+
+
 def powerset(iterable):
     "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
     s = list(iterable)
     return itertools.chain.from_iterable(
         itertools.combinations(s, r) for r in range(len(s) + 1))
-
-
-def resetCounters():
-    counter.counter = 0
-    attCounter.counter = 0
-
-
-def counter():
-    counter.counter += 1
-    return counter.counter
-counter.counter = 0
-
-
-def attCounter():
-    attCounter.counter += 1
-    return attCounter.counter
-attCounter.counter = 0
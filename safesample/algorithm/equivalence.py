@@ -0,0 +1,71 @@
+import nltk
+
+import plan_cache
+import query_exp
+
+
+# Containment decisions keyed on the canonical forms of both queries. The
+# keys keep separator replacements as they are, since those are constants
+# shared by the two queries.
+containmentCache = plan_cache.LRUCache(maxSize=16384)
+
+
+# Returns True if q1 implies q2. Queries are Components, DisjunctiveQuery
+# objects or CNFs; the homomorphism test below decides most of them and
+# Prover9 is only started for the ones it cannot.
+def containedIn(q1, q2):
+    key = (plan_cache.canonicalKey(q1, renameSeparators=False),
+           plan_cache.canonicalKey(q2, renameSeparators=False))
+    decision = containmentCache.get(key)
+    if decision is None:
+        decision = nativeContainedIn(q1, q2)
+        if decision is None:
+            decision = prover9ContainedIn(q1, q2)
+        containmentCache.put(key, decision)
+    return decision
+
+
+def isEquivalent(q1, q2):
+    return containedIn(q1, q2) and containedIn(q2, q1)
+
+
+# Union of conjunctive queries containment (Sagiv, Yannakakis 1980): every
+# component of d1 must be contained in some component of d2, using
+# Component.containedIn. The test is exact for queries without negation or
+# inequality constraints. A homomorphism that maps negated atoms onto negated
+# atoms still proves containment, so with negation only a positive answer is
+# trusted. Returns None when the question is left to Prover9.
+def nativeContainedIn(q1, q2):
+    d1 = asDisjunctiveQuery(q1)
+    d2 = asDisjunctiveQuery(q2)
+    if d1 is None or d2 is None:
+        return None
+    if hasInequalityVariables(d1) or hasInequalityVariables(d2):
+        return None
+    if d1.containedIn(d2):
+        return True
+    if any(r.isNegated() for r in d1.getRelations() + d2.getRelations()):
+        return None
+    return False
+
+
+def asDisjunctiveQuery(q):
+    if isinstance(q, query_exp.DisjunctiveQuery):
+        return q
+    elif isinstance(q, query_exp.Component):
+        return query_exp.DisjunctiveQuery([q])
+    elif isinstance(q, query_exp.CNF) and len(q.getDisjuncts()) == 1:
+        return q.getDisjuncts()[0]
+    return None
+
+
+def hasInequalityVariables(d):
+    return any(v.isInequality()
+               for c in d.getComponents() for v in c.getVariables())
+
+
+def prover9ContainedIn(q1, q2):
+    lexpr = nltk.Expression.fromstring
+    prover = nltk.Prover9Command(
+        lexpr(q2.toProver9()), assumptions=[lexpr(q1.toProver9())])
+    return prover.prove()
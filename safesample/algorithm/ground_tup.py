@@ -1,11 +1,15 @@
+import numpy as np
+
 import algorithm
+import in_memory
 
 
 class GroundTuple(object):
     # ground tuples are leaf nodes
     nodes = []
 
-    def __init__(self, query, disjunctiveQuery, groundTuple, init=True):
+    def __init__(self, query, disjunctiveQuery, groundTuple, init=True,
+                 context=None):
         self.query = query
         self.disjunctiveQuery = disjunctiveQuery
         self.groundTuple = groundTuple
@@ -23,13 +27,19 @@ class GroundTuple(object):
     def getSafeQueryPlan(self):
         pass
 
+    def getRelation(self):
+        return self.disjunctiveQuery.getComponents()[0].getRelations()[0]
+
+    def usesSampledRelations(self):
+        return self.getRelation().isSampled()
+
     def hasGenericConstant(self):
         return self.genericConstantStr is not None
 
     def getGenericConstantStr(self):
         return self.genericConstantStr
 
-    def generateSQL_DNF(self, separatorSubs=None):
+    def generateSQL_DNF(self, separatorSubs=None, context=None):
         if separatorSubs is None:
             separatorSubs = []
         rel = self.disjunctiveQuery.getComponents()[0].getRelations()[0]
@@ -108,6 +118,10 @@ class GroundTuple(object):
         if len(extraSelectAttribute):
             selectAttributes.append(extraSelectAttribute)
 
+        if context is not None and context.batchColumn and rel.isSampled():
+            selectAttributes.insert(0, "%s.%s as %s" % (
+                relSym, context.batchColumn, context.batchColumn))
+
         if len(whereConditions):
             whereClause = ' where ' + (' and ' . join(whereConditions))
         else:
@@ -132,6 +146,63 @@ class GroundTuple(object):
             (selectClause, relSym, whereExtraTableStr, whereClause)
         return sql
 
+    # the rows of generateSQL_DNF, from the relation in memory
+    def compileWorlds(self, separatorSubs, database):
+        rel = self.getRelation()
+        relSym = rel.getName()
+        alwaysTrue = len(self.disjunctiveQuery.getComponents()) > 1
+        relArgs = rel.getArguments()
+
+        columns = []
+        positions = []
+        if rel.getConstraints():
+            argPos = 0
+            for (tablePos, constant) in enumerate(rel.getConstraints()):
+                if (not constant or
+                        (type(constant) == int and constant < 0)
+                        or constant == '-c'):
+                    columns.append(relArgs[argPos].getReplacement())
+                    positions.append(tablePos)
+                    argPos += 1
+        else:
+            for i in range(len(relArgs)):
+                if rel.isVariable(i):
+                    raise Exception("A ground tuple can't have variables!")
+                elif rel.isConstant(i):
+                    raise Exception("A ground tuple can't have constants!")
+                columns.append(relArgs[i].getReplacement())
+                positions.append(i)
+
+        conditions = []
+        for i, constant in enumerate(rel.getConstraints()):
+            if constant == 'c' or constant == '-c':
+                raise in_memory.UnsupportedPlanException(
+                    "Generic constants are only evaluated in SQL")
+            elif not constant:
+                continue
+            elif constant > 0:
+                conditions.append((i, constant, True))
+            else:
+                conditions.append((i, -1 * constant, False))
+
+        tuples = database.getTuples(relSym)
+        selected = [row for (row, t) in enumerate(tuples)
+                    if all((t[i] == constant) == isEqual
+                           for (i, constant, isEqual) in conditions)]
+        keys = [tuple(tuples[row][pos] for pos in positions)
+                for row in selected]
+        selected = np.array(selected, dtype=int)
+
+        def probs(worlds):
+            if alwaysTrue:
+                return np.ones((len(selected), 1))
+            p = database.getProbabilities(
+                relSym, rel.isSampled(), worlds)[selected]
+            if rel.isNegated():
+                p = 1 - p
+            return p
+        return in_memory.WorldRows(columns, keys, probs)
+
     # depending on parameters, the generated SQL may denote 0 with NULL
     # or -Infinity
     def getZeroGivenParams(self, params):
@@ -149,7 +220,7 @@ class GroundTuple(object):
         else:
             return "1"
 
-    def generateSQL_CNF(self, params):
+    def generateSQL_CNF(self, params, context=None):
         rel = self.disjunctiveQuery.getComponents()[0].getRelations()[0]
         signature = rel.getSignature()
 
@@ -0,0 +1,212 @@
+import re
+
+import numpy as np
+
+import algorithm
+import ground_tup
+
+# relations with more tuples in total are left to the database
+maxTuples = 10000000
+
+# number of worlds sampled per evaluation of a plan
+blockSize = 1000
+
+
+# Plans are evaluated in memory over many possible worlds at once. Each node
+# of a plan is compiled into WorldRows mirroring the rows of its SQL: which
+# rows exist depends only on the tuples of the relations, so the joins are
+# done once, and only the probabilities of the rows are computed per world,
+# as a (rows x worlds) array. NULL is None in the keys and NaN in the
+# probabilities, and a deterministic array has a single column that
+# broadcasts over the worlds.
+class WorldRows(object):
+
+    def __init__(self, columns, keys, probs):
+        # separator replacement values, the c<i> columns of the SQL
+        self.columns = columns
+        self.keys = keys
+        # function from the sampled worlds to the probabilities of the rows
+        self.probs = probs
+
+
+class UnsupportedPlanException(Exception):
+    pass
+
+
+class InMemoryDatabase(object):
+
+    # tables maps relation names to (tuples, p), where p is an array of the
+    # probabilities of the tuples
+    def __init__(self, tables):
+        self.tables = tables
+
+    def getTuples(self, relName):
+        return self.tables[relName][0]
+
+    def getProbabilities(self, relName, isSampled, worlds):
+        if isSampled:
+            return worlds[relName]
+        return self.tables[relName][1][:, np.newaxis]
+
+    # Each sampled tuple is in a world with its probability, as in the
+    # tables SafeSample builds in SQL
+    def drawWorlds(self, relNames, numSamples, randomState=None):
+        if randomState is None:
+            randomState = np.random
+        worlds = {}
+        for relName in relNames:
+            p = self.tables[relName][1]
+            draws = randomState.random_sample((len(p), numSamples))
+            worlds[relName] = (draws < p[:, np.newaxis]).astype(float)
+        return worlds
+
+
+def loadDatabase(conn, relNames):
+    cur = conn.cursor()
+    total = 0
+    for relName in relNames:
+        cur.execute("select count(*) from %s" % relName)
+        total += cur.fetchone()[0]
+    if total > maxTuples:
+        cur.close()
+        raise UnsupportedPlanException(
+            "%d tuples do not fit in memory" % total)
+    tables = {}
+    for relName in relNames:
+        cur.execute("select * from %s" % relName)
+        names = [d[0] for d in cur.description]
+        positions = sorted([(int(name[1:]), pos)
+                            for (pos, name) in enumerate(names)
+                            if re.match(r'v\d+$', name)])
+        pPos = names.index('p')
+        tuples = []
+        p = []
+        for row in cur.fetchall():
+            tuples.append(tuple(row[pos] for (_, pos) in positions))
+            p.append(row[pPos])
+        tables[relName] = (tuples, np.array(p, dtype=float))
+    cur.close()
+    return InMemoryDatabase(tables)
+
+
+# Joins the rows of children in order, as a chain of joins in SQL. Child k is
+# joined with the rows joined so far on conditions[k], a list of (j, column)
+# pairs equating the column of child j with the same column of child k; an
+# empty list joins every pair of rows. Returns the row of each child in each
+# joined row, -1 where a full outer join found no row.
+def joinRows(children, conditions, outer):
+    joined = [(row,) for row in range(len(children[0].keys))]
+    for k in range(1, len(children)):
+        child = children[k]
+        childPositions = [child.columns.index(column)
+                          for (j, column) in conditions[k]]
+        positions = [(j, children[j].columns.index(column))
+                     for (j, column) in conditions[k]]
+        index = {}
+        for (row, key) in enumerate(child.keys):
+            value = tuple(key[pos] for pos in childPositions)
+            if None not in value:
+                index.setdefault(value, []).append(row)
+        matched = set()
+        result = []
+        for t in joined:
+            value = tuple(children[j].keys[t[j]][pos] if t[j] >= 0 else None
+                          for (j, pos) in positions)
+            rows = index.get(value, []) if None not in value else []
+            for row in rows:
+                result.append(t + (row,))
+            matched.update(rows)
+            if not rows and outer:
+                result.append(t + (-1,))
+        if outer:
+            for row in range(len(child.keys)):
+                if row not in matched:
+                    result.append((-1,) * k + (row,))
+        joined = result
+    return [np.array([t[k] for t in joined], dtype=int)
+            for k in range(len(children))]
+
+
+# The first non-null value of column among the given children, for each
+# joined row
+def coalesceKeys(children, rows, column, sources):
+    values = []
+    for r in range(len(rows[0])):
+        value = None
+        for k in sources:
+            if rows[k][r] >= 0:
+                value = children[k].keys[rows[k][r]][
+                    children[k].columns.index(column)]
+                if value is not None:
+                    break
+        values.append(value)
+    return values
+
+
+# The probabilities of the given rows, NaN for -1
+def gatherProbs(probs, rows):
+    padded = np.vstack([probs, np.full((1, probs.shape[1]), np.nan)])
+    return padded[rows]
+
+
+# ior(COALESCE(pUse, 0)) grouped by the groupBy columns of child
+def projectRows(child, groupBy):
+    positions = [child.columns.index(column) for column in groupBy]
+    groups = {}
+    for (row, key) in enumerate(child.keys):
+        groups.setdefault(tuple(key[pos] for pos in positions),
+                          []).append(row)
+    if groupBy:
+        keys = sorted(groups.keys())
+    else:
+        # without a group by, the aggregate has a row even over no rows
+        keys = [()]
+    order = np.array([row for key in keys for row in groups.get(key, [])],
+                     dtype=int)
+    sizes = [len(groups.get(key, [])) for key in keys]
+    starts = np.cumsum([0] + sizes[:-1])
+
+    def probs(worlds):
+        p = child.probs(worlds)
+        factors = 1.0 - np.where(np.isnan(p), 0.0, p)
+        if not len(order):
+            return np.zeros((len(keys), factors.shape[1]))
+        return 1.0 - np.multiply.reduceat(factors[order], starts, axis=0)
+    return WorldRows(list(groupBy), keys, probs)
+
+
+def getGroundTuples(plan):
+    if isinstance(plan, ground_tup.GroundTuple):
+        return [plan]
+    return [t for child in algorithm.getPlanChildren(plan)
+            for t in getGroundTuples(child)]
+
+
+# Samples worlds of the sampled relations of a plan and evaluates the plan in
+# all of them at once, the in-memory counterpart of the SQL SafeSample runs
+class WorldEvaluator(object):
+
+    def __init__(self, plan, database):
+        self.database = database
+        self.sampledRelations = sorted(set(
+            t.getRelation().getName() for t in getGroundTuples(plan)
+            if t.getRelation().isSampled()))
+        self.rows = plan.compileWorlds([], database)
+
+    def evaluate(self, worlds, numSamples):
+        result = np.zeros(numSamples)
+        if self.rows.keys:
+            # the SQL path reads the first row, NULL counting as 0
+            p = self.rows.probs(worlds)[0]
+            result = result + np.where(np.isnan(p), 0.0, p)
+        return result
+
+    def sample(self, numSamples, randomState=None):
+        worlds = self.database.drawWorlds(
+            self.sampledRelations, numSamples, randomState)
+        return self.evaluate(worlds, numSamples)
+
+
+def getPlanRelationNames(plan):
+    return sorted(set(t.getRelation().getName()
+                      for t in getGroundTuples(plan)))
@@ -1,10 +1,11 @@
 import algorithm
+import in_memory
 import itertools
 
 
 class InclusionExclusion(object):
 
-    def __init__(self, query, subqueries, coeffs, init=True):
+    def __init__(self, query, subqueries, coeffs, init=True, context=None):
         self.query = query
         self.subqueries = subqueries
         self.coeffs = coeffs
@@ -16,7 +17,7 @@ class InclusionExclusion(object):
         self.trueOnMissing = False
 
         # this call must be last for initialization purposes
-        self.getSafeQueryPlan(init)
+        self.getSafeQueryPlan(init, context)
 
     def hasGenericConstant(self):
         return self.genericConstantStr is not None
@@ -24,10 +25,14 @@ class InclusionExclusion(object):
     def getGenericConstantStr(self):
         return self.genericConstantStr
 
+    def usesSampledRelations(self):
+        return any(child.usesSampledRelations() for child in self.children
+                   if not isinstance(child, int))
+
     def formatSeparatorVariable(self, sep):
         return "sep_var_%s" % str(sep)
 
-    def getSafeQueryPlan(self, init=True):
+    def getSafeQueryPlan(self, init=True, context=None):
         self.usedSeparatorVars = self.query.getUsedSeparators()
         self.formattedUsedSeparators = [
             self.formatSeparatorVariable(sep)
@@ -36,21 +41,27 @@ class InclusionExclusion(object):
         self.children = []
         if init:
             for ind, term in enumerate(self.subqueries):
-                plan = algorithm.getSafeQueryPlan(term)
+                plan = algorithm.getSafeQueryPlan(term, context)
                 self.children.append(plan)
 
-    def generateSQL_DNF(self, separatorSubs=None):
+    def generateSQL_DNF(self, separatorSubs=None, context=None):
         if separatorSubs is None:
             separatorSubs = []
+        if context is None:
+            context = algorithm.CompilationContext()
         results = []
         counters = []
         selectAtts = []
 
         counterIdentToGenericConstantStr = {}
         genericConstantStrIdent = 0
+        batched = context.batchColumn and self.usesSampledRelations()
         for (i, child) in enumerate(self.children):
-            sql = child.generateSQL_DNF(separatorSubs[:])
-            ident = algorithm.counter()
+            sql = algorithm.generateChildSQL_DNF(
+                self, child, separatorSubs[:], context)
+            if batched and not child.usesSampledRelations():
+                sql = algorithm.liftToBatch(sql, context)
+            ident = context.counter()
             if child.hasGenericConstant():
                 genericConstantStr = child.getGenericConstantStr()
                 # doesn't matter which one, just pick arbitrarily
@@ -84,11 +95,19 @@ class InclusionExclusion(object):
         previousIdent = False
         for (sql, ident) in results:
             newSubquery = "(%s) as q%d" % (sql, ident)
+            batchConditions = []
+            if batched and previousIdent:
+                # some of the previous subqueries may be missing a world
+                batchConditions.append("%s = q%d.%s" % (
+                    algorithm.coalesceColumn(
+                        counters[:counters.index(ident)],
+                        context.batchColumn),
+                    ident, context.batchColumn))
             if previousIdent:
-                if len(separatorSubs):
+                if len(separatorSubs) or batched:
                     condition = "ON %s" % " and ".join(
                         ["q%d.c%d = q%d.c%d" % (previousIdent, i, ident, i)
-                         for(i, x) in separatorSubs])
+                         for(i, x) in separatorSubs] + batchConditions)
                     subqueries.append(
                         "FULL OUTER JOIN %s %s" % (newSubquery, condition))
                 else:
@@ -97,7 +116,7 @@ class InclusionExclusion(object):
                 subqueries.append("%s" % (newSubquery))
             previousIdent = ident
 
-        if len(separatorSubs):
+        if len(separatorSubs) or batched:
             subqueryString = " ".join(subqueries)
         else:
             subqueryString = ", ".join(subqueries)
@@ -109,6 +128,10 @@ class InclusionExclusion(object):
         for (i, x) in separatorSubs:
             selectAtts.append("COALESCE(%s) as c%d" % (
                 ", ".join(["q%d.c%d" % (ident, i) for ident in counters]), i))
+        if batched:
+            selectAtts.insert(0, "%s as %s" % (
+                algorithm.coalesceColumn(counters, context.batchColumn),
+                context.batchColumn))
         attString = ', '.join(selectAtts)
 
         if attString:
@@ -120,7 +143,32 @@ class InclusionExclusion(object):
             selectString, subqueryString, joinCondition)
         return sql
 
-    def generateSQL_CNF(self, params):
+    # the rows of generateSQL_DNF, from the relations in memory
+    def compileWorlds(self, separatorSubs, database):
+        children = [child.compileWorlds(separatorSubs[:], database)
+                    for child in self.children]
+        conditions = [[(k - 1, i) for (i, x) in separatorSubs if k > 0]
+                      for k in range(len(children))]
+        rows = in_memory.joinRows(children, conditions, len(separatorSubs) > 0)
+
+        columns = [i for (i, x) in separatorSubs]
+        values = [in_memory.coalesceKeys(children, rows, i,
+                                         range(len(children)))
+                  for i in columns]
+        keys = zip(*values) if values else [()] * len(rows[0])
+
+        def probs(worlds):
+            p = None
+            for (ind, (child, childRows)) in enumerate(zip(children, rows)):
+                term = (-1 * self.coeffs[ind]) * in_memory.gatherProbs(
+                    child.probs(worlds), childRows)
+                p = term if p is None else p + term
+            return p
+        return in_memory.WorldRows(columns, keys, probs)
+
+    def generateSQL_CNF(self, params, context=None):
+        if context is None:
+            context = algorithm.CompilationContext()
         if params['useLog']:
             if params['useNull']:
                 defaultValue = "NULL"
@@ -162,8 +210,8 @@ class InclusionExclusion(object):
                 constantInSelectClause = child * self.coeffs[i]
                 continue
 
-            currentSubqueryID = algorithm.counter()
-            subquerySQL = child.generateSQL_CNF(params)
+            currentSubqueryID = context.counter()
+            subquerySQL = child.generateSQL_CNF(params, context)
             tableAlias = "q%d" % currentSubqueryID
             tableAliases.append(tableAlias)
             tableAliasToSubquerySQLMap[tableAlias] = subquerySQL
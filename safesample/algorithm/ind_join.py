@@ -1,9 +1,10 @@
 import algorithm
+import in_memory
 
 
 class IndependentJoin(object):
 
-    def __init__(self, query, subqueries, init=True):
+    def __init__(self, query, subqueries, init=True, context=None):
         self.query = query
         self.subqueries = subqueries
         self.genericConstantStr = None
@@ -16,9 +17,9 @@ class IndependentJoin(object):
         self.trueOnMissing = False
 
         # this call must be last for initialization purposes
-        self.getSafeQueryPlan(init)
+        self.getSafeQueryPlan(init, context)
 
-    def getSafeQueryPlan(self, init=True):
+    def getSafeQueryPlan(self, init=True, context=None):
         if isinstance(self.query, list):
             self.usedSeparatorVars = set()
             for q in self.query:
@@ -30,19 +31,25 @@ class IndependentJoin(object):
         ]
 
         if init:
-            self.children = map(algorithm.getSafeQueryPlan, self.subqueries)
+            self.children = [algorithm.getSafeQueryPlan(q, context)
+                             for q in self.subqueries]
         else:
             self.children = []
 
+    def usesSampledRelations(self):
+        return any(child.usesSampledRelations() for child in self.children)
+
     def hasGenericConstant(self):
         return self.genericConstantStr is not None
 
     def getGenericConstantStr(self):
         return self.genericConstantStr
 
-    def generateSQL_DNF(self, separatorSubs=None):
+    def generateSQL_DNF(self, separatorSubs=None, context=None):
         if separatorSubs is None:
             separatorSubs = []
+        if context is None:
+            context = algorithm.CompilationContext()
         results = []
 
         selectAttributes = []
@@ -52,9 +59,19 @@ class IndependentJoin(object):
         counterIdentToGenericConstantStr = {}
         genericConstantStrIdent = 0
         identOfSampledRelation = -1
-        for (i, child) in enumerate(self.children):
-            subquerySQL = child.generateSQL_DNF(separatorSubs[:])
-            ident = algorithm.counter()
+        # children keyed on the sampled world are joined on it
+        batchedIdents = []
+        if context.materialize is not None:
+            (children, childRelations) = self.groupDeterministicChildren()
+        else:
+            children = self.children
+            childRelations = [q.getRelations() for q in self.subqueries]
+        for (i, child) in enumerate(children):
+            subquerySQL = algorithm.generateChildSQL_DNF(
+                self, child, separatorSubs[:], context)
+            ident = context.counter()
+            if context.batchColumn and child.usesSampledRelations():
+                batchedIdents.append(ident)
             if child.hasGenericConstant():
                 if hasattr(child, 'isSampled'):
                     identOfSampledRelation = ident
@@ -67,16 +84,24 @@ class IndependentJoin(object):
                 genericConstantStrIdent = ident
             counters.append(ident)
             results.append((subquerySQL, ident))
-            counterIdentToRelations[ident] = self.subqueries[i].getRelations()
+            counterIdentToRelations[ident] = childRelations[i]
 
         if self.hasGenericConstant():
             selectAttributes.append(
                 "q%d.%s" % (genericConstantStrIdent, self.genericConstantStr))
+        if batchedIdents:
+            selectAttributes.insert(0, "q%d.%s" % (
+                batchedIdents[0], context.batchColumn))
 
         subqueries = []
         previousIdent = False
         for (sql, ident) in results:
             newSubquery = "(%s) as q%d" % (sql, ident)
+            batchConditions = []
+            if ident in batchedIdents and ident != batchedIdents[0]:
+                batchConditions.append("q%d.%s = q%d.%s" % (
+                    batchedIdents[0], context.batchColumn,
+                    ident, context.batchColumn))
             if previousIdent:
                 joinType = "INNER JOIN"
                 if len(separatorSubs):
@@ -97,6 +122,7 @@ class IndependentJoin(object):
                                            if self.separatorInRelation1And2(
                                                i, prevIdent, ident,
                                                counterIdentToRelations)]
+                        conditions += batchConditions
                         condition = "ON %s" % " and ".join(conditions)
                         subqueries.append(
                             "%s %s %s" % (joinType, newSubquery, condition))
@@ -109,6 +135,7 @@ class IndependentJoin(object):
                                            if self.separatorInRelation1And2(
                                                i, prevIdent, ident,
                                                counterIdentToRelations)]
+                        conditions += batchConditions
                         condition = "ON %s" % " and ".join(conditions)
                         subqueries.append(
                             "%s %s %s" % (joinType, newSubquery, condition))
@@ -125,12 +152,14 @@ class IndependentJoin(object):
                                      prevIdent,
                                      counterIdentToGenericConstantStr[prevIdent
                                                                       ]))
+                        conditions += batchConditions
                         condition = "ON %s" % " and ".join(conditions)
                         subqueries.append(
                             "%s %s %s" % (joinType, newSubquery, condition))
                     else:
-                        subqueries.append(
-                            "%s %s ON TRUE" % (joinType, newSubquery))
+                        subqueries.append("%s %s ON %s" % (
+                            joinType, newSubquery,
+                            " and ".join(batchConditions) or "TRUE"))
 
             else:
                 subqueries.append("%s" % (newSubquery))
@@ -147,6 +176,10 @@ class IndependentJoin(object):
                 if separatorInI:
                     termIdentWithThisSubstitution = i
                     break
+            if termIdentWithThisSubstitution == -1:
+                # a group of deterministic children may not use every
+                # separator of the query
+                continue
             selectAttributes.append(
                 "q%d.c%d" %
                 (termIdentWithThisSubstitution, separatorReplacement))
@@ -161,6 +194,67 @@ class IndependentJoin(object):
             selectString, " ".join(subqueries))
         return sql
 
+    # The children to join and their relations when subplans are
+    # materialized. Deterministic children are joined in a single child, so
+    # that their join is materialized once rather than each of them.
+    def groupDeterministicChildren(self):
+        childRelations = [q.getRelations() for q in self.subqueries]
+        deterministic = [k for (k, child) in enumerate(self.children)
+                         if not child.usesSampledRelations()]
+        # generic constants are joined on by the children that have them
+        hasGenericConstant = any(
+            constant in ('c', '-c')
+            for k in deterministic for rel in childRelations[k]
+            for constant in rel.getConstraints())
+        if (len(deterministic) < 2 or
+                len(deterministic) == len(self.children) or
+                hasGenericConstant):
+            return (self.children, childRelations)
+        subqueries = [self.subqueries[k] for k in deterministic]
+        group = IndependentJoin(subqueries, subqueries, init=False)
+        group.children = [self.children[k] for k in deterministic]
+        children = [group]
+        relations = [[rel for k in deterministic for rel in childRelations[k]]]
+        for (k, child) in enumerate(self.children):
+            if k not in deterministic:
+                children.append(child)
+                relations.append(childRelations[k])
+        return (children, relations)
+
+    # the rows of generateSQL_DNF, from the relations in memory
+    def compileWorlds(self, separatorSubs, database):
+        children = [child.compileWorlds(separatorSubs[:], database)
+                    for child in self.children]
+        childRelations = dict((k, self.subqueries[k].getRelations())
+                              for k in range(len(children)))
+        conditions = [[(j, i) for j in range(k) for (i, x) in separatorSubs
+                       if self.separatorInRelation1And2(
+                           i, j, k, childRelations)]
+                      for k in range(len(children))]
+        rows = in_memory.joinRows(children, conditions, False)
+
+        columns = []
+        values = []
+        for (separatorReplacement, separatorVarsByComponent) in separatorSubs:
+            for k in range(len(children)):
+                if any(separatorReplacement in
+                       rel.getSeparatorReplacementValues()
+                       for rel in childRelations[k]):
+                    columns.append(separatorReplacement)
+                    values.append(in_memory.coalesceKeys(
+                        children, rows, separatorReplacement, [k]))
+                    break
+        keys = zip(*values) if values else [()] * len(rows[0])
+
+        def probs(worlds):
+            p = None
+            for (child, childRows) in zip(children, rows):
+                childProbs = in_memory.gatherProbs(
+                    child.probs(worlds), childRows)
+                p = childProbs if p is None else p * childProbs
+            return p
+        return in_memory.WorldRows(columns, keys, probs)
+
     def formatSeparatorVariable(self, sep):
         return "sep_var_%s" % str(sep)
 
@@ -176,7 +270,9 @@ class IndependentJoin(object):
                     attributeToFormattedStringMap[attribute])
         return ", ".join(selectAttributes)
 
-    def generateSQL_CNF(self, params):
+    def generateSQL_CNF(self, params, context=None):
+        if context is None:
+            context = algorithm.CompilationContext()
         if params['useLog']:
             if params['useNull']:
                 defaultValue = "NULL"
@@ -206,8 +302,8 @@ class IndependentJoin(object):
         # assign each child a table alias and fetch its SQL code, then build the maps
         # that say which identifiers/separator vars are used by each child
         for child in self.children:
-            currentSubqueryID = algorithm.counter()
-            subquerySQL = child.generateSQL_CNF(params)
+            currentSubqueryID = context.counter()
+            subquerySQL = child.generateSQL_CNF(params, context)
             tableAlias = "q%d" % currentSubqueryID
             tableAliases.append(tableAlias)
             tableAliasToSubquerySQLMap[tableAlias] = subquerySQL
@@ -1,10 +1,34 @@
 import algorithm
+import in_memory
 import query_exp
 
 
+# Picks the separator of disjunctiveQuery whose independent project is
+# cheapest to evaluate. Generic inequality separators join every group with
+# the active domain and other inequality separators add a filter, so plain
+# variables come first; among those, separators in leading columns are
+# preferred, as they match the leading column of the relations' keys. Ties
+# keep getSeparators' order.
+def cheapestSeparator(disjunctiveQuery, separators):
+    varPositions = [c.getVarPositions()
+                    for c in disjunctiveQuery.getComponents()
+                    if c.hasVariables()]
+
+    def cost(separator):
+        inequalities = [v for v in separator if v.isInequality()]
+        generic = [v for v in inequalities
+                   if v.getInequalityConstraint().isGeneric()]
+        columns = sum(min(positions)
+                      for (ind, var) in enumerate(separator)
+                      for positions in varPositions[ind][var].values())
+        return (len(generic), len(inequalities), columns)
+    return min(separators, key=cost)
+
+
 class IndependentProject(object):
 
-    def __init__(self, query, disjunctiveQuery, separator, init=True):
+    def __init__(self, query, disjunctiveQuery, separator, init=True,
+                 context=None):
         self.query = query.copy()
         self.disjunctiveQuery = disjunctiveQuery
         self.separator = separator
@@ -19,7 +43,10 @@ class IndependentProject(object):
         self.effectiveDomainSize = 0
 
         # this call must be last for initialization purposes
-        self.getSafeQueryPlan(init)
+        self.getSafeQueryPlan(init, context)
+
+    def usesSampledRelations(self):
+        return self.child.usesSampledRelations()
 
     def hasGenericConstant(self):
         return self.genericConstantStr is not None
@@ -27,7 +54,10 @@ class IndependentProject(object):
     def getGenericConstantStr(self):
         return self.genericConstantStr
 
-    def getSafeQueryPlan(self, init=True):
+    def getSafeQueryPlan(self, init=True, context=None):
+        if context is None:
+            context = algorithm.CompilationContext()
+
         # we are interested in whether the separator represents
         # a generic inequality constraint - if so, it doesn't matter which
         # component it occurs in, as it must have the same
@@ -39,7 +69,7 @@ class IndependentProject(object):
             self.replacementVal = "generic_%s" % representativeSeparator.getInequalityConstraint(
             ).getConstant()
         else:
-            self.replacementVal = algorithm.attCounter()
+            self.replacementVal = context.attCounter()
 
         # for webkb
         if representativeSeparator.domainSize:
@@ -61,16 +91,19 @@ class IndependentProject(object):
             self.childDNF = d
 
         if init:
-            self.child = algorithm.getSafeQueryPlan(self.childDNF)
+            self.child = algorithm.getSafeQueryPlan(
+                self.childDNF, context)
         else:
             self.child = None
 
-    def generateSQL_DNF(self, separatorSubs=None):
+    def generateSQL_DNF(self, separatorSubs=None, context=None):
         if separatorSubs is None:
             separatorSubs = []
-        replacementVal = algorithm.attCounter()
-
+        if context is None:
+            context = algorithm.CompilationContext()
         groupBy = ["c%d" % i for (i, x) in separatorSubs]
+        if context.batchColumn and self.usesSampledRelations():
+            groupBy.insert(0, context.batchColumn)
         if len(groupBy):
             groupByString = 'group by ' + ', '.join(groupBy)
         else:
@@ -78,9 +111,10 @@ class IndependentProject(object):
         selectString = ', '.join(groupBy + ['ior(COALESCE(pUse,0))'])
         separatorSubs.append((self.replacementVal, self.separator))
 
-        childSQL = self.child.generateSQL_DNF(separatorSubs[:])
+        childSQL = algorithm.generateChildSQL_DNF(
+            self, self.child, separatorSubs[:], context)
         sql = "\n -- independent project \n select %s as pUse from (%s) as q%d %s " % (
-            selectString, childSQL, algorithm.counter(), groupByString)
+            selectString, childSQL, context.counter(), groupByString)
 
         if self.child.hasGenericConstant():
             genericConstantStr = self.child.getGenericConstantStr()
@@ -88,13 +122,20 @@ class IndependentProject(object):
             groupBy.append(genericConstantStr)
             groupByString = 'group by ' + ', '.join(groupBy)
             sql = "\n -- independent project \n select %s, %s as pUse from (%s) as q%d %s " % (
-                genericConstantStr, selectString, childSQL, algorithm.counter(), groupByString)
+                genericConstantStr, selectString, childSQL, context.counter(), groupByString)
         else:
             sql = "\n -- independent project \n select %s as pUse from (%s) as q%d %s " % (
-                selectString, childSQL, algorithm.counter(), groupByString)
+                selectString, childSQL, context.counter(), groupByString)
 
         return sql
 
+    # the rows of generateSQL_DNF, from the relations in memory
+    def compileWorlds(self, separatorSubs, database):
+        groupBy = [i for (i, x) in separatorSubs]
+        separatorSubs.append((self.replacementVal, self.separator))
+        child = self.child.compileWorlds(separatorSubs[:], database)
+        return in_memory.projectRows(child, groupBy)
+
     def isInequalityVar(self, separatorVar):
         return separatorVar[0].isInequality()
 
@@ -102,14 +143,14 @@ class IndependentProject(object):
         return self.isInequalityVar(separatorVar) and self.separator[
             0].getInequalityConstraint().isGeneric()
 
-    def generateSQL_CNF(self, params):
-        replacementVal = algorithm.attCounter()
-
-        childSQL = self.child.generateSQL_CNF(params)
+    def generateSQL_CNF(self, params, context=None):
+        if context is None:
+            context = algorithm.CompilationContext()
+        childSQL = self.child.generateSQL_CNF(params, context)
         self.trueOnMissing = self.child.trueOnMissing
 
         self.genericIdentifiers = self.child.genericIdentifiers.copy()
-        subqueryAlias = 'q%d' % algorithm.counter()
+        subqueryAlias = 'q%d' % context.counter()
 
         # this steps replaces a universally (\forall) quantified variable
         # with a product - if some tuples can be missing, we need to count
@@ -1,11 +1,14 @@
 import itertools
 
+import numpy as np
+
 import algorithm
+import in_memory
 
 
 class IndependentUnion(object):
 
-    def __init__(self, query, subqueries, init=True):
+    def __init__(self, query, subqueries, init=True, context=None):
         self.query = query
         self.subqueries = subqueries
         self.genericConstantStr = None
@@ -16,9 +19,9 @@ class IndependentUnion(object):
         self.trueOnMissing = False
 
         # this call must be last for initialization purposes
-        self.getSafeQueryPlan(init)
+        self.getSafeQueryPlan(init, context)
 
-    def getSafeQueryPlan(self, init=True):
+    def getSafeQueryPlan(self, init=True, context=None):
         if isinstance(self.query, list):
             self.usedSeparatorVars = set()
             for q in self.query:
@@ -29,7 +32,8 @@ class IndependentUnion(object):
             self.formatSeparatorVariable(sep) for sep in
             self.usedSeparatorVars]
         if init:
-            self.children = map(algorithm.getSafeQueryPlan, self.subqueries)
+            self.children = [algorithm.getSafeQueryPlan(q, context)
+                             for q in self.subqueries]
         else:
             self.children = []
 
@@ -39,9 +43,11 @@ class IndependentUnion(object):
     def getGenericConstantStr(self):
         return self.genericConstantStr
 
-    def generateSQL_DNF(self, separatorSubs=None):
+    def generateSQL_DNF(self, separatorSubs=None, context=None):
         if separatorSubs is None:
             separatorSubs = []
+        if context is None:
+            context = algorithm.CompilationContext()
         results = []
         counters = []
 
@@ -51,9 +57,13 @@ class IndependentUnion(object):
         counterIdentToGenericConstantStr = {}
         genericConstantStrIdent = 0
 
+        batched = context.batchColumn and self.usesSampledRelations()
         for (i, child) in enumerate(self.children):
-            sql = child.generateSQL_DNF(separatorSubs[:])
-            ident = algorithm.counter()
+            sql = algorithm.generateChildSQL_DNF(
+                self, child, separatorSubs[:], context)
+            if batched and not child.usesSampledRelations():
+                sql = algorithm.liftToBatch(sql, context)
+            ident = context.counter()
             if child.hasGenericConstant():
                 genericConstantStr = child.getGenericConstantStr()
                 # doesn't matter which one, just pick arbitrarily
@@ -93,18 +103,26 @@ class IndependentUnion(object):
         previousIdent = False
         for (sql, ident) in results:
             newSubquery = "(%s) as q%d" % (sql, ident)
+            batchConditions = []
+            if batched and previousIdent:
+                # some of the previous subqueries may be missing a world
+                batchConditions.append("%s = q%d.%s" % (
+                    algorithm.coalesceColumn(
+                        counters[:counters.index(ident)],
+                        context.batchColumn),
+                    ident, context.batchColumn))
             if previousIdent:
                 if len(separatorSubs):
                     condition = "ON %s" % " and ".join(
                         ["q%d.c%d = q%d.c%d" % (previousIdent, i, ident, i)
                          for(i, x) in separatorSubs
                          if i in identToTermSubs[previousIdent] and i in identToTermSubs
-                         [ident]])
+                         [ident]] + batchConditions)
                     subqueries.append(
                         "FULL OUTER JOIN %s %s" % (newSubquery, condition))
                 else:
-                    subqueries.append(
-                        "FULL OUTER JOIN %s ON true" % (newSubquery))
+                    subqueries.append("FULL OUTER JOIN %s ON %s" % (
+                        newSubquery, " and ".join(batchConditions) or "true"))
             else:
                 subqueries.append("%s" % (newSubquery))
 
@@ -121,6 +139,10 @@ class IndependentUnion(object):
                  [ident]])
             if len(attsToCoalesce) > 0:
                 selectAtts.append("COALESCE(%s) as c%d" % (attsToCoalesce, i))
+        if batched:
+            selectAtts.insert(0, "%s as %s" % (
+                algorithm.coalesceColumn(counters, context.batchColumn),
+                context.batchColumn))
         attString = ', '.join(selectAtts)
 
         if attString:
@@ -132,6 +154,42 @@ class IndependentUnion(object):
             selectString, subqueryString, joinCondition)
         return sql
 
+    # the rows of generateSQL_DNF, from the relations in memory
+    def compileWorlds(self, separatorSubs, database):
+        children = [child.compileWorlds(separatorSubs[:], database)
+                    for child in self.children]
+        termSubs = [set(subId for (subId, varList) in separatorSubs
+                        if child.usesSeparator(subId))
+                    for child in self.children]
+        conditions = [[(k - 1, i) for (i, x) in separatorSubs
+                       if k > 0 and i in termSubs[k - 1] and i in termSubs[k]]
+                      for k in range(len(children))]
+        rows = in_memory.joinRows(children, conditions, True)
+
+        columns = []
+        values = []
+        for (i, x) in separatorSubs:
+            sources = [k for k in range(len(children))
+                       if i in termSubs[-1] and i in termSubs[k]]
+            if sources:
+                columns.append(i)
+                values.append(
+                    in_memory.coalesceKeys(children, rows, i, sources))
+        keys = zip(*values) if values else [()] * len(rows[0])
+
+        def probs(worlds):
+            product = None
+            for (child, childRows) in zip(children, rows):
+                factors = 1 - in_memory.gatherProbs(
+                    child.probs(worlds), childRows)
+                factors[np.isnan(factors)] = 1
+                product = factors if product is None else product * factors
+            return 1 - product
+        return in_memory.WorldRows(columns, keys, probs)
+
+    def usesSampledRelations(self):
+        return any(child.usesSampledRelations() for child in self.children)
+
     def formatSeparatorVariable(self, sep):
         return "sep_var_%s" % str(sep)
 
@@ -149,7 +207,9 @@ class IndependentUnion(object):
                     attributeToFormattedStringMap[attribute])
         return ", ".join(selectAttributes)
 
-    def generateSQL_CNF(self, params):
+    def generateSQL_CNF(self, params, context=None):
+        if context is None:
+            context = algorithm.CompilationContext()
         if params['useLog']:
             if params['useNull']:
                 defaultValue = "NULL"
@@ -177,8 +237,8 @@ class IndependentUnion(object):
         # assign each child a table alias and fetch its SQL code, then build the maps
         # that say which identifiers/separator vars are used by each child
         for child in self.children:
-            currentSubqueryID = algorithm.counter()
-            subquerySQL = child.generateSQL_CNF(params)
+            currentSubqueryID = context.counter()
+            subquerySQL = child.generateSQL_CNF(params, context)
             tableAlias = "q%d" % currentSubqueryID
             tableAliases.append(tableAlias)
             tableAliasToSubquerySQLMap[tableAlias] = subquerySQL
@@ -315,7 +375,7 @@ class IndependentUnion(object):
              for tableAlias in tableAliases])
 
         unionClause = " UNION ALL ".join(unionSubqueries)
-        unionClauseAlias = "q%d" % algorithm.counter()
+        unionClauseAlias = "q%d" % context.counter()
         joinSQL = "\n -- independent union \n WITH %s select %s from (%s) %s %s" % (
             withClause, selectClause, unionClause, unionClauseAlias, groupByClause)
 
@@ -0,0 +1,211 @@
+from collections import OrderedDict
+import cPickle as pickle
+import os
+import threading
+
+# query_exp and query_sym are imported by the functions using them, since
+# query_exp imports algorithm, which creates its caches from this module when
+# it is imported
+
+
+# Bounded map with least-recently-used eviction, shared by the planner caches
+class LRUCache(object):
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = value
+            while self.maxSize and len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        return "%d entries, %d hits, %d misses" % (
+            len(self.entries), self.hits, self.misses)
+
+
+# Query plans keyed on canonicalKey(query), optionally persisted to a pickle
+# file that is read back when the cache is created. The file starts with
+# formatVersion; files of another version, or that fail to unpickle (e.g.
+# after the plan classes changed), are ignored and the cache starts empty.
+class PlanCache(LRUCache):
+
+    formatVersion = 1
+
+    def __init__(self, maxSize=1024, path=None):
+        super(PlanCache, self).__init__(maxSize)
+        self.path = path
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                (version, entries) = pickle.load(f)
+        except (pickle.UnpicklingError, AttributeError, EOFError,
+                ImportError, IndexError, TypeError, ValueError) as e:
+            print "Warning: ignoring unreadable plan cache %s (%s)" % (
+                self.path, e)
+            return
+        if version != self.formatVersion:
+            print "Warning: ignoring plan cache %s of format %s" % (
+                self.path, version)
+            return
+        for (key, value) in entries:
+            self.put(key, value)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = self.entries.items()
+        # write to a temporary file first so a crash never leaves a
+        # truncated cache behind
+        tmpPath = "%s.tmp" % self.path
+        with open(tmpPath, 'wb') as f:
+            pickle.dump((self.formatVersion, entries), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, self.path)
+
+
+# Returns a string describing the query up to variable renaming and the
+# order of conjuncts, disjuncts, components and atoms. Atoms are first ordered
+# by a signature that ignores variable names, variables are then numbered in
+# that order. Ties between atoms with identical signatures are broken by input
+# order, so a few isomorphic queries may get different keys (a cache miss),
+# but two queries with the same key are always identical up to renaming.
+# Separator replacements are renamed too unless renameSeparators is False,
+# which is needed when keys of several queries are combined, as the
+# replacements are constants shared between those queries.
+def canonicalKey(query, renameSeparators=True):
+    names = {}
+    for rel in orderedRelations(query):
+        for arg in rel.getArguments():
+            argName = argumentName(arg, renameSeparators)
+            if argName is not None and argName not in names:
+                names[argName] = "%s%d" % (argName[0], len(names))
+    return renderCanonical(query, names, renameSeparators)
+
+
+def expressionParts(e):
+    import query_exp
+    if isinstance(e, query_exp.DNF):
+        return ('dnf', e.getConjuncts())
+    elif isinstance(e, query_exp.CNF):
+        return ('cnf', e.getDisjuncts())
+    elif isinstance(e, query_exp.ConjunctiveQuery):
+        return ('and', e.getComponents())
+    elif isinstance(e, query_exp.DisjunctiveQuery):
+        return ('or', e.getComponents())
+    elif isinstance(e, query_exp.Component):
+        return ('com', e.getRelations())
+    raise Exception("Cannot compute a canonical form for %s" % e)
+
+
+def shapeKey(e):
+    import query_sym
+    if isinstance(e, query_sym.Relation):
+        return relationKey(e, None)
+    (tag, children) = expressionParts(e)
+    return "%s(%s)" % (tag, ','.join(sorted(shapeKey(c) for c in children)))
+
+
+def orderedRelations(e):
+    import query_sym
+    if isinstance(e, query_sym.Relation):
+        return [e]
+    (tag, children) = expressionParts(e)
+    rels = []
+    for (key, i, c) in sorted(
+            [(shapeKey(c), i, c) for (i, c) in enumerate(children)]):
+        rels.extend(orderedRelations(c))
+    return rels
+
+
+def renderCanonical(e, names, renameSeparators=True):
+    import query_sym
+    if isinstance(e, query_sym.Relation):
+        return relationKey(e, names, renameSeparators)
+    (tag, children) = expressionParts(e)
+    return "%s(%s)" % (tag, ','.join(sorted(
+        renderCanonical(c, names, renameSeparators) for c in children)))
+
+
+# Variables and numbered separator replacements are renamed; the names
+# returned here identify them across the whole query
+def argumentName(arg, renameSeparators=True):
+    import query_sym
+    if isinstance(arg, query_sym.Variable):
+        return "v%s" % arg.getVar()
+    elif (renameSeparators and
+            isinstance(arg, query_sym.SeparatorVariable) and
+            isinstance(arg.getReplacement(), int)):
+        return "s%s" % arg.getReplacement()
+    return None
+
+
+# With names=None, variables are numbered by first occurrence within the atom
+def relationKey(rel, names, renameSeparators=True):
+    import query_sym
+    localNames = {}
+    args = []
+    for arg in rel.getArguments():
+        argName = argumentName(arg, renameSeparators)
+        if argName is not None:
+            if names is None:
+                if argName not in localNames:
+                    localNames[argName] = "%s%d" % (
+                        argName[0], len(localNames))
+                argStr = localNames[argName]
+            else:
+                argStr = names[argName]
+            if isinstance(arg, query_sym.Variable):
+                if arg.isInequality():
+                    argStr += "!=%s" % arg.getInequalityConstraint()
+                if arg.domainSize:
+                    argStr += "#%d" % arg.domainSize
+        elif isinstance(arg, query_sym.SeparatorVariable):
+            argStr = "s:%s" % arg.getReplacement()
+        elif isinstance(arg, query_sym.Constant):
+            argStr = "c:%s" % arg.getConstant()
+        else:
+            argStr = "%%%s" % arg
+        args.append(argStr)
+    flags = ''.join([
+        'd' if rel.isDeterministic() else '',
+        's' if rel.isSampled() else ''])
+    return "%s%s%s/%s(%s)" % (
+        '~' if rel.isNegated() else '',
+        rel.getName(),
+        rel.getConstraintsString() if rel.getConstraints() else '',
+        flags,
+        ','.join(args))
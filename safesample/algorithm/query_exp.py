@@ -11,11 +11,19 @@ import algorithm
 
 class Graph(object):
 
-    def __init__(self, adjacencyList={}):
+    # vertexOrder lists the vertices in the order of the query they come from;
+    # components are then returned in that order, each ordered the same way,
+    # so that plans and their SQL do not depend on set iteration order
+    def __init__(self, adjacencyList={}, vertexOrder=[]):
         self.adjacencyList = adjacencyList
+        self.vertexOrder = vertexOrder
 
     def connectedComponents(self):
-        vertices = self.adjacencyList.keys()
+        position = dict((id(v), i) for (i, v) in enumerate(self.vertexOrder))
+
+        def orderKey(v):
+            return position.get(id(v), len(position))
+        vertices = sorted(self.adjacencyList.keys(), key=orderKey)
         explored = set()
         components = []
         for v in vertices:
@@ -30,7 +38,7 @@ class Graph(object):
                         explored.add(next)
                         [neighbors.add(n) for n in self.adjacencyList[next]]
                         [component.add(n) for n in self.adjacencyList[next]]
-                components.append(component)
+                components.append(sorted(component, key=orderKey))
         return components
 
 
@@ -101,18 +109,31 @@ class Component(object):
     def containedIn(self, com2):
         # TODO(ericgribkoff) Implement minimization for queries with
         # negation
-        c1Vars = self.getVariables()
-        c2Vars = com2.getVariables()
-        byVarMaps = []
-        for var in c2Vars:
-            byVarMaps.append(
-                [pair for pair in itertools.product([var], c1Vars)])
-        mappings = [h for h in itertools.product(*byVarMaps)]
-        for mapping in mappings:
-            h = dict((x, y) for x, y in list(mapping))
-            if self.isHomomorphism(com2.applyH(h)):
-                return True
-        return False
+        return self.findHomomorphism(com2) is not None
+
+    # Returns a mapping from the variable names of com2 to variable names of
+    # this component under which every atom of com2 is an atom of this
+    # component, or None. Constants and separator replacements only match
+    # themselves. The search binds one atom of com2 at a time, always the one
+    # with the fewest matching atoms under the current bindings, and
+    # backtracks as soon as some atom has no match left.
+    def findHomomorphism(self, com2):
+        targets = defaultdict(set)
+        for rel in self.relations:
+            targets[(rel.getNameWithEqualityConstraints(),
+                     len(rel.getArguments()))].add(
+                tuple(rel.getVariablesForHomomorphism()))
+        targetVars = set([v.getVar() for v in self.getVariables()])
+        atoms = []
+        for rel in com2.getRelations():
+            key = (rel.getNameWithEqualityConstraints(),
+                   len(rel.getArguments()))
+            if key not in targets:
+                return None
+            isVar = [rel.isVariable(i) for i in range(len(rel.getArguments()))]
+            atoms.append(
+                (rel.getVariablesForHomomorphism(), isVar, targets[key]))
+        return extendHomomorphism({}, atoms, targetVars)
 
     def applyH(self, h):
         mappedRels = []
@@ -137,13 +158,42 @@ class Component(object):
                 return False
         return True
 
+    # Computes the core by retraction: as long as the component maps into
+    # itself without one of its atoms, it is replaced by the image of that
+    # map, which is equivalent and smaller
     def minimize(self):
-        for x in algorithm.powerset(self.getRelations()):
-            if len(x) and not len(x) == len(self.getRelations()):
-                c = Component(list(x))
-                if c.containedIn(self) and self.containedIn(c):
-                    return c
-        return self.copy()
+        relations = self.relations
+        retracted = True
+        while retracted:
+            retracted = False
+            for i in range(len(relations)):
+                rest = Component(relations[:i] + relations[i + 1:])
+                h = rest.findHomomorphism(Component(relations))
+                if h is not None:
+                    relations = rest.getImage(relations, h)
+                    retracted = True
+                    break
+        if len(relations) == len(self.relations):
+            return self.copy()
+        return Component(relations)
+
+    # Returns one atom of this component for each distinct atom of relations
+    # under the homomorphism h returned by findHomomorphism
+    def getImage(self, relations, h):
+        image = set()
+        for rel in relations:
+            tokens = rel.getVariablesForHomomorphism()
+            image.add((rel.getNameWithEqualityConstraints(), tuple(
+                [h[t] if rel.isVariable(i) else t
+                 for (i, t) in enumerate(tokens)])))
+        imageRelations = []
+        for rel in self.relations:
+            key = (rel.getNameWithEqualityConstraints(),
+                   tuple(rel.getVariablesForHomomorphism()))
+            if key in image:
+                image.remove(key)
+                imageRelations.append(rel)
+        return imageRelations
 
     def usesSeparator(self, subId):
         return any(r.usesSeparator(subId) for r in self.getRelations())
@@ -251,54 +301,12 @@ class ConjunctiveQuery(object):
             componentsWithVars[i].applySeparator(separator[i], replacement)
 
     def getSeparator(self):
-        componentsWithVars = [c for c in self.components if c.hasVariables()]
-        varPositions = [c.getVarPositions() for c in componentsWithVars]
-        componentVars = [c.keys()
-                         for c in varPositions]  # used to fix an ordering
-        for potentialSep in itertools.product(*componentVars):
-            potentialMap = {}
-            validMap = True
-            for ind, var in enumerate(potentialSep):
-                relationsWithThisVarInThisComponent = set(
-                    varPositions[ind][var].keys())
-                probabilisticRelationsInThisComponent = set(
-                    componentsWithVars[ind].getProbabilisticRelations())
-                if (len(probabilisticRelationsInThisComponent.difference(
-                        relationsWithThisVarInThisComponent))):
-                    validMap = False
-                    break
+        separators = self.getSeparators()
+        if separators:
+            return separators[0]
 
-                deterministicRelationsInThisComponent = set(
-                    self.components[ind].getDeterministicRelations())
-                for detR in deterministicRelationsInThisComponent.difference(
-                        relationsWithThisVarInThisComponent):
-                    if detR.getName() in potentialMap:
-                        del potentialMap[detR.getName()]
-
-                # look at all relations in the component with this variable
-                for rel in varPositions[ind][var]:
-                    if rel.getName() not in potentialMap:
-                        # haven't seen this relation before, add it to potential separator
-                        # mapping
-                        potentialMap[
-                            rel.getName()] = varPositions[ind][var][rel]
-                    # we have seen this relation before, see if the potential separator
-                    # positions intersect with those seen before
-                    elif len(potentialMap[rel.getName()].intersection(varPositions[ind][var][rel])) == 0:
-                        if not rel.isDeterministic():
-                            validMap = False
-                            break
-                        elif rel.getName() in potentialMap:
-                            del potentialMap[rel.getName()]
-                    else:
-                        potentialMap[
-                            rel.getName()] = potentialMap[
-                            rel.getName()].intersection(
-                            varPositions[ind][var][rel])
-                if not validMap:
-                    break
-            if validMap:
-                return potentialSep
+    def getSeparators(self):
+        return findSeparators(self.components)
 
     def minimize(self):
         minCom = [c.minimize() for c in self.getComponents()]
@@ -398,54 +406,12 @@ class DisjunctiveQuery(object):
     # TODO this function and getAdjacencyList should be using
     # getNameWithEqualityConstraints()
     def getSeparator(self):
-        componentsWithVars = [c for c in self.components if c.hasVariables()]
-        varPositions = [c.getVarPositions() for c in componentsWithVars]
-        componentVars = [c.keys()
-                         for c in varPositions]  # used to fix an ordering
-        for potentialSep in itertools.product(*componentVars):
-            potentialMap = {}
-            validMap = True
-            for ind, var in enumerate(potentialSep):
-                relationsWithThisVarInThisComponent = set(
-                    varPositions[ind][var].keys())
-                probabilisticRelationsInThisComponent = set(
-                    componentsWithVars[ind].getProbabilisticRelations())
-                if (len(probabilisticRelationsInThisComponent.difference(
-                        relationsWithThisVarInThisComponent))):
-                    validMap = False
-                    break
+        separators = self.getSeparators()
+        if separators:
+            return separators[0]
 
-                deterministicRelationsInThisComponent = set(
-                    self.components[ind].getDeterministicRelations())
-                for detR in deterministicRelationsInThisComponent.difference(
-                        relationsWithThisVarInThisComponent):
-                    if detR.getName() in potentialMap:
-                        del potentialMap[detR.getName()]
-
-                # look at all relations in the component with this variable
-                for rel in varPositions[ind][var]:
-                    if rel.getName() not in potentialMap:
-                        # haven't seen this relation before, add it to potential separator
-                        # mapping
-                        potentialMap[
-                            rel.getName()] = varPositions[ind][var][rel]
-                    # we have seen this relation before, see if the potential separator
-                    # positions intersect with those seen before
-                    elif len(potentialMap[rel.getName()].intersection(varPositions[ind][var][rel])) == 0:
-                        if not rel.isDeterministic():
-                            validMap = False
-                            break
-                        elif rel.getName() in potentialMap:
-                            del potentialMap[rel.getName()]
-                    else:
-                        potentialMap[
-                            rel.getName()] = potentialMap[
-                            rel.getName()].intersection(
-                            varPositions[ind][var][rel])
-                if not validMap:
-                    break
-            if validMap:
-                return potentialSep
+    def getSeparators(self):
+        return findSeparators(self.components)
 
     # TODO(ericgribkoff) using getNameWithEqualityConstraints() for adjacencyList computation is not
     # sufficient, as components are independent iff their equality constraints don't overlap
@@ -566,36 +532,47 @@ class DNF(object):
                 adjList[d].add(d)
         return adjList
 
-    def toCNF(self):
-        conjI = 0
-        comI = 0
-        stack = [(conjI, comI)]
+    # Distributes the disjunction over the conjunctions, dropping disjuncts
+    # implied by a disjunct that is kept. Raises
+    # algorithm.CNFTooLargeException as soon as more than maxDisjuncts
+    # disjuncts have to be kept.
+    def toCNF(self, maxDisjuncts=None):
         disjuncts = []
-        # Applying distributivity
-        while True:
-            if len(stack) < len(self.conjuncts):
-                stack.append((conjI + 1, 0))
-                conjI = conjI + 1
-            else:
-                disjuncts.append(
-                    DisjunctiveQuery(
-                        [self.conjuncts[i].getComponent(j) for(i, j) in
-                         stack]))
-                (lastConj, lastCom) = stack.pop()
-                if lastCom + 1 < len(self.conjuncts[lastConj].getComponents()):
-                    stack.append((lastConj, lastCom + 1))
-                else:
-                    while stack:
-                        (lastConj, lastCom) = stack.pop()
-                        conjI = conjI - 1
-                        if lastCom + 1 < len(
-                                self.conjuncts[lastConj].getComponents()):
-                            stack.append((lastConj, lastCom + 1))
-                            break
-                    if not stack:
-                        break
+        for d in self.iterCNFDisjuncts():
+            # a later disjunct may imply some that were kept earlier
+            disjuncts = [k for k in disjuncts if not d.containedIn(k)]
+            disjuncts.append(d)
+            if maxDisjuncts is not None and len(disjuncts) > maxDisjuncts:
+                raise algorithm.CNFTooLargeException(
+                    "CNF has more than %d disjuncts (at most %d)" % (
+                        maxDisjuncts, self.getCNFSizeBound()))
         return CNF(disjuncts)
 
+    # Yields the disjuncts of the CNF one at a time, in the order of the
+    # distribution, skipping every disjunct implied by one yielded before.
+    # Disjuncts are built one component at a time, and a partial disjunct
+    # that is already implied is not extended any further.
+    def iterCNFDisjuncts(self):
+        kept = []
+        stack = [[]]
+        while stack:
+            prefix = stack.pop()
+            d = DisjunctiveQuery(prefix)
+            if prefix and any(k.containedIn(d) for k in kept):
+                continue
+            if len(prefix) == len(self.conjuncts):
+                kept.append(d)
+                yield d
+                continue
+            # pushed in reverse so that the first component is expanded first
+            for c in reversed(self.conjuncts[len(prefix)].getComponents()):
+                stack.append(prefix + [c])
+
+    # Number of disjuncts of the CNF before any is dropped
+    def getCNFSizeBound(self):
+        return reduce(lambda n, conj: n * len(conj.getComponents()),
+                      self.conjuncts, 1)
+
     def prettyPrint(self):
         return "(%s)" % " v ".join([x.prettyPrint() for x in self.conjuncts])
 
@@ -707,8 +684,117 @@ class CNF(object):
             [x.__repr__() for x in self.disjuncts])
 
 
+# Returns every separator of the components: tuples holding one variable for
+# each component with variables, such that the variable occurs in every
+# probabilistic atom of its component, and every probabilistic relation
+# symbol has a position holding the separator in all of its atoms.
+# Deterministic atoms do not constrain separators. Candidate variables and
+# positions are first narrowed to a fixpoint, where every candidate variable
+# can occupy a candidate position of each of its component's probabilistic
+# atoms and vice versa; only the remaining combinations are checked.
+def findSeparators(components):
+    componentsWithVars = [c for c in components if c.hasVariables()]
+    varPositions = [c.getVarPositions() for c in componentsWithVars]
+    atoms = []
+    candidateVars = []
+    candidatePositions = {}
+    for (ind, c) in enumerate(componentsWithVars):
+        probabilisticRelations = c.getProbabilisticRelations()
+        # the dictionary order of getVarPositions fixes the order in which
+        # separators are returned
+        candidateVars.append([
+            var for var in varPositions[ind]
+            if all(rel in varPositions[ind][var]
+                   for rel in probabilisticRelations)])
+        for rel in probabilisticRelations:
+            atoms.append((ind, rel))
+            candidatePositions.setdefault(
+                rel.getName(), set(range(len(rel.getArguments()))))
+
+    changed = True
+    while changed:
+        if not all(candidateVars):
+            return []
+        changed = False
+        for (ind, rel) in atoms:
+            name = rel.getName()
+            reachable = set()
+            for var in candidateVars[ind]:
+                reachable.update(varPositions[ind][var][rel])
+            if not candidatePositions[name].issubset(reachable):
+                candidatePositions[name].intersection_update(reachable)
+                changed = True
+            consistent = [var for var in candidateVars[ind]
+                          if varPositions[ind][var][rel].intersection(
+                              candidatePositions[name])]
+            if len(consistent) < len(candidateVars[ind]):
+                candidateVars[ind] = consistent
+                changed = True
+
+    separators = []
+    for potentialSep in itertools.product(*candidateVars):
+        positions = {}
+        for (ind, rel) in atoms:
+            name = rel.getName()
+            positions[name] = positions.get(
+                name, candidatePositions[name]).intersection(
+                varPositions[ind][potentialSep[ind]][rel])
+            if not positions[name]:
+                break
+        else:
+            separators.append(potentialSep)
+    return separators
+
+
+def extendHomomorphism(h, atoms, targetVars):
+    if not atoms:
+        return h
+    best = None
+    for (i, (tokens, isVar, targets)) in enumerate(atoms):
+        extensions = []
+        for target in targets:
+            extension = matchAtom(tokens, isVar, target, h, targetVars)
+            if extension is not None:
+                extensions.append(extension)
+        if not extensions:
+            return None
+        if best is None or len(extensions) < len(best[1]):
+            best = (i, extensions)
+            if len(extensions) == 1:
+                break
+    (i, extensions) = best
+    remaining = atoms[:i] + atoms[i + 1:]
+    for extension in extensions:
+        extended = dict(h)
+        extended.update(extension)
+        result = extendHomomorphism(extended, remaining, targetVars)
+        if result is not None:
+            return result
+    return None
+
+
+# Returns the bindings that map the atom's tokens onto target given the
+# bindings in h, or None if they do not exist
+def matchAtom(tokens, isVar, target, h, targetVars):
+    extension = {}
+    for (token, var, t) in zip(tokens, isVar, target):
+        if not var:
+            if token != t:
+                return None
+            continue
+        bound = h.get(token, extension.get(token))
+        if bound is None:
+            if t not in targetVars:
+                return None
+            extension[token] = t
+        elif bound != t:
+            return None
+    return extension
+
+
 def decomposeComponent(orig):
-    connectedComponents = Graph(orig.getAdjacencyList()).connectedComponents()
+    connectedComponents = Graph(
+        orig.getAdjacencyList(), orig.getRelations()).connectedComponents()
     if len(connectedComponents) == 1:
         return [orig]
     else:
@@ -716,15 +802,23 @@ def decomposeComponent(orig):
 
 
 def computeSymbolComponentsDNF(dnf):
-    connectedComponents = Graph(dnf.getAdjacencyList()).connectedComponents()
+    # the planner passes CNFs here too
+    if isinstance(dnf, DNF):
+        vertexOrder = dnf.getConjuncts()
+    else:
+        vertexOrder = dnf.getDisjuncts()
+    connectedComponents = Graph(
+        dnf.getAdjacencyList(), vertexOrder).connectedComponents()
     return connectedComponents
 
 
 def computeSymbolComponentsCNF(cnf):
-    connectedComponents = Graph(cnf.getAdjacencyList()).connectedComponents()
+    connectedComponents = Graph(
+        cnf.getAdjacencyList(), cnf.getDisjuncts()).connectedComponents()
     return connectedComponents
 
 
 def computeSymbolComponentsDisjunct(d):
-    connectedComponents = Graph(d.getAdjacencyList()).connectedComponents()
+    connectedComponents = Graph(
+        d.getAdjacencyList(), d.getComponents()).connectedComponents()
     return connectedComponents
@@ -0,0 +1,111 @@
+from __future__ import division
+import math
+import Queue
+import threading
+import time
+
+from stats import RunningStats
+
+# z-score of the normal approximation of the confidence intervals (95%)
+confidenceZ = 1.96
+
+
+# The statistics of samples in [0, 1] with confidenceZ ** 2 pseudo-samples
+# added, half of them 0 and half 1, as in the Agresti-Coull interval of
+# 0/1 samples, so that samples all alike do not give an interval of width 0
+def adjustedStats(samples):
+    pseudoSamples = RunningStats()
+    pseudoSamples.count = confidenceZ ** 2
+    pseudoSamples.mean = 0.5
+    pseudoSamples.m2 = 0.25 * pseudoSamples.count
+    return pseudoSamples.merge(samples)
+
+
+# (samples so far, estimate, confidence interval half-width, elapsed
+# seconds) of a SampleRun, whose samples are in [0, 1] before scaling. The
+# half-width is infinite with fewer than two samples.
+def getEstimate(run, startTime):
+    n = run.getNumSamples()
+    if n < 2:
+        return (n, run.getEstimate(), float('inf'), time.time() - startTime)
+    adjusted = adjustedStats(run.samples)
+    halfWidth = confidenceZ * math.sqrt(
+        adjusted.getVariance() / adjusted.count) * run.scale
+    return (n, run.getEstimate(), halfWidth, time.time() - startTime)
+
+
+# Takes samples with sampleStep(), which records them in run, and yields the
+# estimate of the run whenever endOfBatch() holds, and after the last sample.
+# Sampling stops after maxSamples samples, or at the first end of a batch
+# after deadline, a time.time().
+def estimates(run, sampleStep, endOfBatch, maxSamples=None, deadline=None):
+    startTime = time.time()
+    yielded = 0
+    while maxSamples is None or run.getNumSamples() < maxSamples:
+        sampleStep()
+        if endOfBatch():
+            yielded = run.getNumSamples()
+            yield getEstimate(run, startTime)
+            if deadline is not None and time.time() >= deadline:
+                return
+    if yielded < run.getNumSamples():
+        yield getEstimate(run, startTime)
+
+
+# The last estimate of an iterator of estimates, stopping as soon as the
+# confidence interval half-width is at most maxHalfWidth
+def estimateUntil(estimateIterator, maxHalfWidth=None):
+    estimate = None
+    try:
+        for estimate in estimateIterator:
+            if maxHalfWidth is not None and estimate[2] <= maxHalfWidth:
+                break
+    finally:
+        estimateIterator.close()
+    return estimate
+
+
+# Runs an iterator of estimates in a thread of its own, so that a caller,
+# e.g. an event loop, can poll the latest estimate or wait on the queue of
+# updates without blocking on sampling. None is put on the queue at the end.
+class BackgroundEstimates(object):
+
+    def __init__(self, estimateIterator):
+        self.estimateIterator = estimateIterator
+        self.updates = Queue.Queue()
+        self.latestEstimate = None
+        self.error = None
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.runEstimates)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def runEstimates(self):
+        try:
+            for estimate in self.estimateIterator:
+                with self.lock:
+                    self.latestEstimate = estimate
+                self.updates.put(estimate)
+                if self.stopped:
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self.estimateIterator.close()
+            self.updates.put(None)
+
+    def latest(self):
+        with self.lock:
+            return self.latestEstimate
+
+    def isDone(self):
+        return not self.thread.is_alive()
+
+    # sampling stops after the batch being sampled
+    def stop(self):
+        self.stopped = True
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        return self.latest()
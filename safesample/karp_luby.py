@@ -1,25 +1,251 @@
 from __future__ import division
+from array import array as packedArray
+import hashlib
+import itertools
+import os
 import psycopg2
 import time
 
 from numpy import *
 import math
-
-from algorithm import algorithm
+from scipy import sparse
+
+from algorithm import algorithm, plan_cache
+import anytime
+import parallel
+import rng
+from stats import RunningStats, SampleRun
+
+# directory keeping processed lineages between runs, or None
+lineageCacheDir = None
+
+# the packed arrays of a processed lineage, one .npy file each
+lineageArrays = ['varProbs', 'termStarts', 'literals', 'termProbs']
+
+
+# Walker's alias method, as built by Vose: after O(n) setup, a term is
+# picked with probability termProbs[i] by one uniform draw, keeping bucket k
+# with probability prob[k] and taking alias[k] otherwise
+class AliasTable(object):
+
+    def __init__(self, termProbs):
+        n = len(termProbs)
+        scaled = [float(p) * n for p in termProbs]
+        prob = [1.0] * n
+        alias = range(n)
+        small = [k for k in range(n) if scaled[k] < 1]
+        large = [k for k in range(n) if scaled[k] >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        self.prob = array(prob)
+        self.alias = array(alias, dtype=int)
+        self.numTerms = n
+        self.picks = []
+
+    # draws come from randomState, by default the numpy.random module
+    def pickBatch(self, batchSize, randomState=None):
+        if randomState is None:
+            randomState = random
+        u = randomState.random_sample(batchSize) * self.numTerms
+        buckets = minimum(u.astype(int), self.numTerms - 1)
+        return where(u - buckets < self.prob[buckets], buckets,
+                     self.alias[buckets])
+
+    def pick(self, randomState=None):
+        if not self.picks:
+            self.picks = self.pickBatch(4096, randomState).tolist()
+        return self.picks.pop()
+
+
+def saveLineage(path, arrays):
+    tmpPath = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmpPath)
+    for name in lineageArrays:
+        save(os.path.join(tmpPath, name + '.npy'), asarray(arrays[name]))
+    try:
+        os.rename(tmpPath, path)
+    except OSError:
+        # another run cached the same lineage first
+        for name in lineageArrays:
+            os.remove(os.path.join(tmpPath, name + '.npy'))
+        os.rmdir(tmpPath)
+
+
+# The arrays are memory-mapped, so that only the pages used are read
+def loadLineage(path):
+    return dict((name, load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                for name in lineageArrays)
+
+
+# The terms of a lineage, packed into two integer arrays: the literals of
+# term i, +var or -var, are literals[termStarts[i]:termStarts[i + 1]]. Terms
+# are read as lists of literals, as when a lineage was a list of lists.
+class Lineage(object):
+
+    def __init__(self, termStarts, literals):
+        self.termStarts = asarray(termStarts, dtype=int)
+        self.literals = asarray(literals, dtype=int)
+
+    def __len__(self):
+        return len(self.termStarts) - 1
+
+    def __getitem__(self, i):
+        return self.literals[
+            self.termStarts[i]:self.termStarts[i + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def lineageFromTerms(terms):
+    if isinstance(terms, Lineage):
+        return terms
+    lengths = [len(term) for term in terms]
+    return Lineage(concatenate([[0], cumsum(lengths)]),
+                   [lit for term in terms for lit in term])
+
+
+# For each variable, the terms with a literal of it and the literals' signs,
+# sorted by term. index[var] lists them as (term, positive).
+class OccurrenceIndex(object):
+
+    def __init__(self, lineage, numVars):
+        variables = absolute(lineage.literals)
+        order = argsort(variables, kind='mergesort')
+        termOfLiteral = repeat(arange(len(lineage)), diff(lineage.termStarts))
+        self.starts = searchsorted(variables[order], arange(numVars + 2))
+        self.terms = termOfLiteral[order]
+        self.positive = lineage.literals[order] > 0
+
+    def __getitem__(self, var):
+        start = self.starts[var]
+        end = self.starts[var + 1]
+        return zip(self.terms[start:end].tolist(),
+                   self.positive[start:end].tolist())
+
+    # the occurrences of var in the terms before term i
+    def before(self, var, i):
+        start = self.starts[var]
+        end = start + searchsorted(
+            self.terms[start:self.starts[var + 1]], i)
+        return zip(self.terms[start:end].tolist(),
+                   self.positive[start:end].tolist())
+
+
+# The lineage compiled into compressed sparse rows: the literals of term i
+# are the variables literalVars[termStarts[i]:termStarts[i + 1]], each true
+# when its value equals literalPositive. Worlds are sampled in batches, as
+# rows of a (samples x variables) truth matrix. Terms are evaluated with the
+# term-by-variable matrix signed, +1 for a positive and -1 for a negative
+# literal: signed.dot(world) is at most the number of positive literals of a
+# term, and equals it exactly when the term is satisfied.
+class LineageMatrix(object):
+
+    def __init__(self, terms, numVars, varProbs, aliasTable):
+        terms = lineageFromTerms(terms)
+        self.termStarts = terms.termStarts
+        self.literalVars = absolute(terms.literals)
+        self.literalPositive = terms.literals > 0
+        self.numTerms = len(terms)
+        self.numVars = numVars
+        self.varProbs = array(varProbs, dtype=float)
+        self.aliasTable = aliasTable
+        termOfLiteral = repeat(arange(self.numTerms), diff(self.termStarts))
+        self.signed = sparse.csr_matrix(
+            (where(self.literalPositive, 1, -1).astype(int32),
+             (termOfLiteral, self.literalVars)),
+            shape=(self.numTerms, numVars + 1))
+        self.positiveCounts = bincount(
+            termOfLiteral, self.literalPositive,
+            self.numTerms).astype(int32)
+
+    # the cells a sample takes in a batch: a truth value of each variable
+    # and a count of each term
+    def getSampleCells(self):
+        return self.numVars + 1 + self.numTerms
+
+    # Sets the literals of term pickedTerms[b] in world b
+    def forceTerms(self, truth, pickedTerms):
+        counts = self.termStarts[pickedTerms + 1] - \
+            self.termStarts[pickedTerms]
+        worlds = repeat(arange(len(pickedTerms)), counts)
+        offsets = arange(counts.sum()) - repeat(cumsum(counts) - counts,
+                                                counts)
+        literals = repeat(self.termStarts[pickedTerms], counts) + offsets
+        truth[worlds, self.literalVars[literals]] = \
+            self.literalPositive[literals]
+
+    # The number of terms satisfied in each world
+    def countSatisfied(self, truth):
+        termsTrue = self.signed.dot(truth.T.astype(int8)) == \
+            self.positiveCounts[:, newaxis]
+        return termsTrue.sum(axis=0)
+
+    # The Vazirani estimator of batchSize samples, as
+    # KarpLuby.doSampleStepFractional computes for one
+    def sampleBatch(self, batchSize, randomState=None):
+        if randomState is None:
+            randomState = random
+        pickedTerms = self.aliasTable.pickBatch(batchSize, randomState)
+        truth = randomState.random_sample(
+            (batchSize, self.numVars + 1)) < self.varProbs
+        self.forceTerms(truth, pickedTerms)
+        return 1.0 / self.countSatisfied(truth)
 
 
 class KarpLuby(object):
-    sampleRecord = []
-    estimatesRecord = []
-    sampleTimes = []
-    timesPerSample = []
-
     sumTermProbs = 0
     step1NumSamples = 0
     step2NumSamples = 0
-
-    def __init__(self, dbConnection):
+    # trials and term checks of the self-adjusting coverage estimator
+    coverageNumTrials = 0
+    coverageNumSteps = 0
+
+    # batches of samples start small, so that stopping early wastes little,
+    # and double up to maxBatchCells cells of the truth and term matrices
+    initialBatchSize = 16
+    maxBatchCells = 2 ** 24
+
+    # samples in a block of a worker process
+    poolBatchSize = 1024
+
+    # estimator is 'dklr', the fractional estimator in the Dagum, Karp, Luby,
+    # Ross stopping rule algorithm, or 'klm', the self-adjusting coverage
+    # algorithm of Karp, Luby and Madras; both need epsilon and delta. With
+    # numWorkers above 1, the samples of the Karp-Luby estimators are drawn
+    # by processes forked once the lineage is read. With a seed, the samples
+    # are determined by it and the number of workers. The samples of a run
+    # are kept in run, a SampleRun with the given trace.
+    def __init__(self, dbConnection, estimator='dklr', numWorkers=1,
+                 seed=None, trace=None):
         self.conn = dbConnection
+        self.trace = trace
+        self.run = SampleRun(trace)
+        self.estimator = estimator
+        self.numWorkers = numWorkers
+        self.seed = seed
+        self.pool = None
+        self.sampleStats = RunningStats()
+        self.lineageFile = None
+        self.lineage = None
+        self.aliasTable = None
+        self.occurrences = []
+        self.uniforms = []
+        self.sampleBuffer = []
+        self.batchSize = self.initialBatchSize
+        # the source of the draws of a run: a RandomState of its own with a
+        # seed, and otherwise the numpy.random module, which worker processes
+        # seed apart
+        self.randomState = random
 
     def prepareQuery(self, query):
         maxComponentRels = max([len(c.getRelations())
@@ -99,167 +325,172 @@ class KarpLuby(object):
             conjunctSQL.append("SELECT %s FROM %s %s" % (selectSQL, relationsSQL,
                                                          whereSQL))
 
-        lineageQuery = ' UNION '.join(conjunctSQL)
+        lineageQuery = ' UNION ALL '.join(conjunctSQL)
         print algorithm.getPrettySQL(lineageQuery)
         return lineageQuery
 
-    def getEstimates(self):
-        self.estimatesRecord = []
-        sumSoFar = 0
-        for i in range(len(self.sampleRecord)):
-            sumSoFar += self.sampleRecord[i]
-            self.estimatesRecord.append(
-                sumSoFar / (i + 1) * self.sumTermProbs)
-        return self.estimatesRecord
-
     def karpLuby(self, query, numSamples, epsilon=0, delta=0):
+        if self.estimator == 'klm' and not (epsilon > 0 and delta > 0):
+            raise Exception("The klm estimator needs epsilon and delta")
+        lineageQuery = self.startRun(query)
+        try:
+            if epsilon > 0 and delta > 0:
+                if self.estimator == 'klm':
+                    return self.sampleSelfAdjusting(lineageQuery, epsilon, delta)
+                return self.sampleOptimal(lineageQuery, numSamples, epsilon, delta)
+            else:
+                return self.sample(lineageQuery, numSamples)
+        finally:
+            self.closePool()
+
+    # Yields (samples so far, estimate, confidence interval half-width,
+    # elapsed seconds) of the fractional estimator after each batch of
+    # samples, until maxSamples samples, or the first batch ending after
+    # deadline, a time.time()
+    def karpLubyEstimates(self, query, maxSamples=None, deadline=None):
+        lineageQuery = self.startRun(query)
+        cur = self.lineageCursor()
+        self.run = SampleRun(self.trace)
+        try:
+            try:
+                (varCounter, varProbs, terms, termProbs, numVars, numTerms,
+                 self.sumTermProbs, P) = self.processLineage(lineageQuery, cur)
+            finally:
+                cur.close()
+        except TypeError:
+            # no term has a positive probability
+            yield (0, 0.0, 0.0, 0.0)
+            return
+        self.startBatchSampling(terms, numVars, varProbs)
+        try:
+            for estimate in anytime.estimates(
+                    self.run,
+                    lambda: self.doRecordedSampleStep(
+                        terms, P, numTerms, numVars, varProbs),
+                    self.endOfBatch, maxSamples, deadline):
+                yield estimate
+        finally:
+            self.closePool()
+
+    def endOfBatch(self):
+        if self.pool is not None:
+            return self.pool.endOfBlock()
+        return not self.sampleBuffer
+
+    # Returns the query of the lineage of query
+    def startRun(self, query):
         lineageQuery = self.prepareQuery(query)
-        if epsilon > 0 and delta > 0:
-            return self.sampleOptimal(lineageQuery, numSamples, epsilon, delta)
-        else:
-            return self.sample(lineageQuery, numSamples)
+        self.lineageFile = None
+        if lineageCacheDir is not None:
+            self.lineageFile = self.getLineageFile(query)
+        self.sampleStats = RunningStats()
+        self.batchSize = self.initialBatchSize
+        self.coverageNumTrials = 0
+        self.coverageNumSteps = 0
+        self.resetDraws(random.RandomState(self.seed)
+                        if self.seed is not None else random)
+        return lineageQuery
 
-    def sample(self, lineageQuery, numSamples):
-        cur = self.conn.cursor()
+    # Draws buffered from another run or block are dropped
+    def resetDraws(self, randomState):
+        self.randomState = randomState
+        self.uniforms = []
+        self.sampleBuffer = []
+        if self.aliasTable is not None:
+            self.aliasTable.picks = []
+
+    # Samples of the fractional estimator are drawn in batches from the
+    # lineage compiled into a LineageMatrix
+    def startBatchSampling(self, terms, numVars, varProbs):
+        self.lineage = LineageMatrix(terms, numVars, varProbs,
+                                     self.aliasTable)
+        self.sampleBuffer = []
+        self.batchSize = self.initialBatchSize
+        poolBatchSize = max(1, min(self.poolBatchSize, self.maxBatchCells //
+                                   self.lineage.getSampleCells()))
+        self.startPool(
+            lambda: self.lineage.sampleBatch(
+                poolBatchSize, self.randomState).tolist())
+
+    # sampleBlock() returns poolBatchSize samples. The buffered draws are
+    # dropped first, so that the workers do not share them.
+    def startPool(self, sampleBlock):
+        if self.numWorkers > 1:
+            self.uniforms = []
+            self.aliasTable.picks = []
+            self.pool = parallel.SamplingPool(
+                lambda conn, blockIndex: self.sampleSeededBlock(
+                    sampleBlock, blockIndex), self.numWorkers)
+
+    # With a seed, each block is drawn from a stream of its own, whichever
+    # worker draws it
+    def sampleSeededBlock(self, sampleBlock, blockIndex):
+        if self.seed is not None:
+            self.resetDraws(rng.blockRandomState(self.seed, blockIndex))
+        return sampleBlock()
+
+    def closePool(self):
+        if self.pool is not None:
+            self.sampleStats = self.pool.getStats()
+            self.pool.close()
+            self.pool = None
 
-        self.sampleRecord = []
-        self.estimatesRecord = []
+    def sample(self, lineageQuery, numSamples):
+        cur = self.lineageCursor()
 
-        varsHashMap = {}
-        varCounter = 1
-        varProbs = [0]  # skip 0-index, so literals can be + or - indices
-        terms = []
-        termProbs = []
-        termsSeen = set()
+        self.run = SampleRun(self.trace)
 
         try:
-            cur.execute(lineageQuery)
-            for c in cur:
-                term = []
-                prob = 1
-                # Rows have format [R1,V1,P1,R2,V2,P2,...]
-                # for queries with self-joins, may have repeated id/rel
-                literalsInTerm = {}
-                termIsFalse = False  # lineage may include x ^ ~x
-                for i in range(0, len(c), 3):
-                    relation = c[i]
-                    relId = c[i + 1]
-                    varProb = float(c[i + 2])
-
-                    if relation == '':
-                        # Skip "dummy" columns added to satisfy SQL union
-                        # condition
-                        continue
-
-                    litSign = sign(relId)
-
-                    hashKey = (relation, abs(relId))
-
-                    if hashKey in literalsInTerm:
-                        if literalsInTerm[hashKey] == litSign:
-                            continue
-                        else:
-                            termIsFalse = True
-                            break
-                    else:
-                        literalsInTerm[hashKey] = litSign
-
-                    if hashKey in varsHashMap:
-                        term.append(litSign * varsHashMap[hashKey])
-                    else:
-                        varsHashMap[hashKey] = varCounter
-                        term.append(litSign * varsHashMap[hashKey])
-                        varProbs.append(varProb)
-                        varCounter += 1
-                    if litSign > 0:
-                        prob *= varProb
-                    else:
-                        prob *= (1 - varProb)
-                if termIsFalse:
-                    continue
-                term.sort()
-                termAsTuple = tuple(term)
-                if termAsTuple not in termsSeen:
-                    termsSeen.add(termAsTuple)
-                    terms.append(term)
-                    termProbs.append(prob)
-
-            numVars = varCounter - 1
-            numTerms = len(terms)
-            self.sumTermProbs = sum(termProbs)
-            if self.sumTermProbs == 0:
-                return 0
-            P = array(termProbs) / self.sumTermProbs
-
-            # print terms
-            startTime = time.time()
-            sampledSum = 0
-            for k in range(numSamples):
-                if k > 0 and k % 500 == 0:
-                    print "Computing sample %d" % (k + 1)
-                initTime = time.time()
-                i = random.choice(numTerms, p=P)
-
-                pickedTerm = terms[i]
-                # sample a random number for each var
-                sampleProbs = random.sample(numVars + 1)
-
-                sampledTruth = sampleProbs < varProbs
-
-                # Force literals in the chosen term to be true/false
-                for lit in pickedTerm:
-                    var = abs(lit)
-                    litSign = sign(lit)
-                    if litSign > 0:
-                        sampledTruth[var] = 1
-                    else:
-                        sampledTruth[var] = 0
-
-                lowerTermSat = False
-                for term in terms[0:i]:
-                    sat = True
-                    for lit in term:
-                        var = abs(lit)
-                        litSign = sign(lit)
-                        if (litSign > 0 and not sampledTruth[var]) or \
-                                (litSign < 0 and sampledTruth[var]):
-                            sat = False
-                            break
-                    if sat:
-                        lowerTermSat = True
-                        break
-                if not lowerTermSat:
-                    self.sampleRecord.append(1)
-                    sampledSum += 1
-                else:
-                    self.sampleRecord.append(0)
-                self.estimatesRecord.append(
-                    sampledSum / (k + 1) * self.sumTermProbs)
-                self.sampleTimes.append(time.time() - initTime)
-                self.timesPerSample.append(time.time() - startTime)
-            return sampledSum / numSamples * self.sumTermProbs
+            (varCounter, varProbs, terms, termProbs, numVars, numTerms,
+             self.sumTermProbs, P) = self.processLineage(lineageQuery, cur)
         except psycopg2.Error as e:
             print "SQL error: %s" % e.pgerror
-            cur.close()
             return -1
+        except TypeError as e:
+            # no term has a positive probability
+            return 0
+        finally:
+            cur.close()
+
+        self.startPool(lambda: [
+            self.doSampleStepOriginal(terms, P, numTerms, numVars, varProbs)
+            for k in range(self.poolBatchSize)])
+        sampledSum = 0
+        for k in range(numSamples):
+            if k > 0 and k % 500 == 0:
+                print "Computing sample %d" % (k + 1)
+            initTime = time.time()
+            if self.pool is not None:
+                z = self.pool.nextSample()[0]
+            else:
+                z = self.doSampleStepOriginal(terms, P, numTerms, numVars,
+                                              varProbs)
+                self.sampleStats.add(z)
+            if z:
+                self.run.add(1, time.time() - initTime)
+                sampledSum += 1
+            else:
+                self.run.add(0, time.time() - initTime)
+        return sampledSum / numSamples * self.sumTermProbs
 
     def sampleOptimal(self, lineageQuery, numSamples, epsilon, delta):
-        cur = self.conn.cursor()
+        cur = self.lineageCursor()
 
-        self.sampleRecord = []
-        self.estimatesRecord = []
+        self.run = SampleRun(self.trace)
 
         try:
-            (varsHashMap, varCounter, varProbs, terms, termProbs, termsSeen, numVars,
-             numTerms, self.sumTermProbs, P) = self.processLineage(lineageQuery, cur)
+            (varCounter, varProbs, terms, termProbs, numVars, numTerms,
+             self.sumTermProbs, P) = self.processLineage(lineageQuery, cur)
         except psycopg2.Error as e:
             print "SQL error: %s" % e.pgerror
-            cur.close()
             return -1
         except TypeError as e:
             print "Error: %s" % e
-            cur.close()
             return 0
+        finally:
+            cur.close()
+
+        self.startBatchSampling(terms, numVars, varProbs)
 
         # def according to Dagum Karp Luby Ross paper
         lam = math.exp(1) - 2
@@ -295,15 +526,72 @@ class KarpLuby(object):
             if i < len(sampledZ):
                 S += sampledZ[i]
             else:
-                initTime = time.time()
-                z = self.doSampleStep(terms, P, numTerms, numVars, varProbs)
-                self.sampleTimes.append(time.time() - initTime)
-                self.sampleRecord.append(z)
-                S += z
+                S += self.doRecordedSampleStep(
+                    terms, P, numTerms, numVars, varProbs)
         muTildeZ = S / N
 
         return muTildeZ * self.sumTermProbs
 
+    # Self-adjusting coverage algorithm (Karp, Luby, Madras 1989). A trial
+    # picks a term and a world satisfying it, then checks terms picked
+    # uniformly at random until one is satisfied in that world. After
+    # T = 8 (1 + epsilon) m ln(2 / delta) / epsilon^2 checks in all, the
+    # number of trials N gives the estimate T * sumTermProbs / (m * N).
+    def sampleSelfAdjusting(self, lineageQuery, epsilon, delta):
+        cur = self.lineageCursor()
+
+        self.run = SampleRun(self.trace)
+
+        try:
+            (varCounter, varProbs, terms, termProbs, numVars, numTerms,
+             self.sumTermProbs, P) = self.processLineage(lineageQuery, cur)
+        except psycopg2.Error as e:
+            print "SQL error: %s" % e.pgerror
+            return -1
+        except TypeError as e:
+            print "Error: %s" % e
+            return 0
+        finally:
+            cur.close()
+
+        T = int(math.ceil(8 * (1 + epsilon) * numTerms *
+                          math.log(2.0 / delta) / epsilon ** 2))
+        print "Coverage steps: ", T
+        checkedTerms = []
+        steps = 0
+        trials = 0
+        while steps < T:
+            initTime = time.time()
+            sampledTruth = {}
+            for lit in terms[self.pickTerm(numTerms, P)]:
+                sampledTruth[lit if lit > 0 else -lit] = lit > 0
+            covered = False
+            while steps < T and not covered:
+                if not checkedTerms:
+                    checkedTerms = self.randomState.randint(
+                        numTerms, size=4096).tolist()
+                steps += 1
+                covered = self.isSatisfied(terms[checkedTerms.pop()],
+                                           sampledTruth, varProbs)
+            if covered:
+                trials += 1
+            self.run.addTime(time.time() - initTime)
+
+        self.coverageNumTrials = trials
+        self.coverageNumSteps = steps
+        return T * self.sumTermProbs / (numTerms * max(trials, 1))
+
+    # Whether term holds in the world sampledTruth, drawing the variables
+    # it has not set
+    def isSatisfied(self, term, sampledTruth, varProbs):
+        for lit in term:
+            var = lit if lit > 0 else -lit
+            if var not in sampledTruth:
+                sampledTruth[var] = self.nextUniform() < varProbs[var]
+            if sampledTruth[var] != (lit > 0):
+                return False
+        return True
+
     # def according to Dagum Karp Luby Ross paper
     def stoppingRuleAlgorithm(self, epsilon, delta, terms, P, numTerms, numVars, varProbs):
         lam = math.exp(1) - 2
@@ -316,10 +604,8 @@ class KarpLuby(object):
         S = 0
         while S < gamma1:
             N += 1
-            initTime = time.time()
-            z = self.doSampleStep(terms, P, numTerms, numVars, varProbs)
-            self.sampleTimes.append(time.time() - initTime)
-            self.sampleRecord.append(z)
+            z = self.doRecordedSampleStep(
+                terms, P, numTerms, numVars, varProbs)
             S += z
             sampledZ.append(z)
 
@@ -329,127 +615,226 @@ class KarpLuby(object):
         print "Step 1 N: ", N
         return (muHatZ, sampledZ)
 
+    # the lineage is streamed from a server-side cursor, fetchSize rows at a
+    # time, so that it never is entirely in the client as rows. Each cursor
+    # is named after a number of its own, so that runs sharing a connection
+    # do not clash.
+    fetchSize = 10000
+    cursorIds = itertools.count(1)
+
+    def lineageCursor(self):
+        return self.conn.cursor(
+            "lineage_%d" % next(KarpLuby.cursorIds), withhold=True)
+
+    # The cache file of the lineage of query, named after its canonical form
+    # and a change signal of each of its relations that costs no scan: its
+    # oid and file node, which change when it is recreated or truncated, its
+    # size, and its inserted, updated and deleted tuple counts. Postgres
+    # reports these counts some seconds after a write (up to 10 in 16),
+    # so a lineage read right after changing a relation in place may be
+    # served from the cache; lineageCacheDir should be cleared then.
+    def getLineageFile(self, query):
+        digest = hashlib.sha1(plan_cache.canonicalKey(query))
+        cur = self.conn.cursor()
+        for relName in sorted(set(rel.getName()
+                                  for rel in query.getRelations())):
+            cur.execute("select c.oid, c.relfilenode, "
+                        "pg_relation_size(c.oid), s.n_tup_ins, "
+                        "s.n_tup_upd, s.n_tup_del "
+                        "from pg_class c left join pg_stat_user_tables s "
+                        "on s.relid = c.oid where c.oid = %s::regclass",
+                        (relName,))
+            digest.update("%s:%s;" % (relName, cur.fetchone()))
+        cur.close()
+        return os.path.join(lineageCacheDir, digest.hexdigest())
+
+    # Reads the lineage from the cache when it is there, and from the
+    # database otherwise
     def processLineage(self, lineageQuery, cur):
+        if self.lineageFile is not None and os.path.isdir(self.lineageFile):
+            arrays = loadLineage(self.lineageFile)
+        else:
+            arrays = self.readLineage(lineageQuery, cur)
+            if self.lineageFile is not None:
+                saveLineage(self.lineageFile, arrays)
+
+        varProbs = asarray(arrays['varProbs'])
+        terms = Lineage(arrays['termStarts'], arrays['literals'])
+        varCounter = len(varProbs)
+        numVars = varCounter - 1
+        numTerms = len(terms)
+        self.occurrences = OccurrenceIndex(terms, numVars)
+        termProbs = asarray(arrays['termProbs'])
+        self.sumTermProbs = termProbs.sum()
+        # the samples estimate the probability divided by sumTermProbs
+        self.run.scale = self.sumTermProbs
+        if self.sumTermProbs == 0:
+            return 0
+        P = termProbs / self.sumTermProbs
+        self.aliasTable = AliasTable(P)
+
+        return (varCounter, varProbs, terms, termProbs, numVars, numTerms,
+                self.sumTermProbs, P)
+
+    # Reads the lineage into packed arrays of literals, term offsets and
+    # probabilities. Variables are numbered per relation and tuple id, and
+    # a term is kept the first time its sorted literals are seen. The maps of
+    # variables and of terms seen are only kept while reading.
+    def readLineage(self, lineageQuery, cur):
         varsHashMap = {}
         varCounter = 1
-        varProbs = [0]  # skip 0-index, so literals can be + or - indices
-        terms = []
-        termProbs = []
+        # skip 0-index, so literals can be + or - indices
+        varProbs = packedArray('d', [0])
+        literals = packedArray('l')
+        termStarts = packedArray('l', [0])
+        termProbs = packedArray('d')
         termsSeen = set()
-        numVars = 0
 
         cur.execute(lineageQuery)
-        for c in cur:
-            term = []
-            prob = 1
-            # Rows have format [R1,V1,P1,R2,V2,P2,...]
-            # for queries with self-joins, may have repeated id/rel
-            literalsInTerm = {}
-            termIsFalse = False  # lineage may include x ^ ~x
-            for i in range(0, len(c), 3):
-                relation = c[i]
-                relId = c[i + 1]
-                varProb = float(c[i + 2])
-
-                if relation == '':
-                    # Skip "dummy" columns added to satisfy SQL union
-                    # condition
-                    continue
+        while True:
+            rows = cur.fetchmany(self.fetchSize)
+            if not rows:
+                break
+            for c in rows:
+                term = []
+                prob = 1
+                # Rows have format [R1,V1,P1,R2,V2,P2,...]
+                # for queries with self-joins, may have repeated id/rel
+                literalsInTerm = {}
+                termIsFalse = False  # lineage may include x ^ ~x
+                for i in range(0, len(c), 3):
+                    relation = c[i]
+                    relId = c[i + 1]
 
-                litSign = sign(relId)
+                    if relation == '':
+                        # Skip "dummy" columns added to satisfy SQL union
+                        # condition
+                        continue
 
-                hashKey = (relation, abs(relId))
+                    varProb = float(c[i + 2])
+                    positive = relId > 0
+                    tupleId = relId if positive else -relId
+                    hashKey = (relation, tupleId)
 
-                if hashKey in literalsInTerm:
-                    if literalsInTerm[hashKey] == litSign:
-                        continue
+                    if hashKey in literalsInTerm:
+                        if literalsInTerm[hashKey] == positive:
+                            continue
+                        else:
+                            termIsFalse = True
+                            break
                     else:
-                        termIsFalse = True
-                        break
-                else:
-                    literalsInTerm[hashKey] = litSign
+                        literalsInTerm[hashKey] = positive
 
-                if hashKey in varsHashMap:
-                    term.append(litSign * varsHashMap[hashKey])
-                else:
-                    varsHashMap[hashKey] = varCounter
-                    term.append(litSign * varsHashMap[hashKey])
-                    varProbs.append(varProb)
-                    varCounter += 1
-                if litSign > 0:
-                    prob *= varProb
-                else:
-                    prob *= (1 - varProb)
-            if termIsFalse:
-                continue
-            term.sort()
-            termAsTuple = tuple(term)
-            if termAsTuple not in termsSeen:
-                termsSeen.add(termAsTuple)
-                terms.append(term)
-                termProbs.append(prob)
-
-        numVars = varCounter - 1
-        numTerms = len(terms)
-        self.sumTermProbs = sum(termProbs)
-        if self.sumTermProbs == 0:
-            return 0
-        P = array(termProbs) / self.sumTermProbs
+                    relationVars = varsHashMap.setdefault(relation, {})
+                    var = relationVars.get(tupleId)
+                    if var is None:
+                        var = varCounter
+                        relationVars[tupleId] = var
+                        varProbs.append(varProb)
+                        varCounter += 1
+                    if positive:
+                        term.append(var)
+                        prob *= varProb
+                    else:
+                        term.append(-var)
+                        prob *= (1 - varProb)
+                if termIsFalse:
+                    continue
+                term.sort()
+                packedTerm = packedArray('l', term).tostring()
+                if packedTerm not in termsSeen:
+                    termsSeen.add(packedTerm)
+                    literals.extend(term)
+                    termStarts.append(len(literals))
+                    termProbs.append(prob)
 
-        return (varsHashMap, varCounter, varProbs, terms, termProbs, termsSeen, numVars, numTerms, self.sumTermProbs, P)
+        return {'varProbs': varProbs, 'termStarts': termStarts,
+                'literals': literals, 'termProbs': termProbs}
 
+    # Samples come from the worker processes, from batches drawn from the
+    # compiled lineage, or one at a time without it
     def doSampleStep(self, terms, termProbs, numTerms, numVars, varProbs):
-        return self.doSampleStepFractional(terms, termProbs, numTerms, numVars, varProbs)
-
-    # return a 0/1 estimator, as defined by Karp-Luby
-    def doSampleStepOriginal(self, terms, termProbs, numTerms, numVars, varProbs):
-
+        if self.pool is not None:
+            return self.pool.nextSample()[0]
+        if self.lineage is None:
+            z = self.doSampleStepFractional(terms, termProbs, numTerms, numVars, varProbs)
+        else:
+            if not self.sampleBuffer:
+                maxBatchSize = max(1, self.maxBatchCells //
+                                   self.lineage.getSampleCells())
+                self.batchSize = min(self.batchSize, maxBatchSize)
+                self.sampleBuffer = self.lineage.sampleBatch(
+                    self.batchSize, self.randomState).tolist()
+                self.batchSize *= 2
+            z = self.sampleBuffer.pop()
+        self.sampleStats.add(z)
+        return z
+
+    # a sample of doSampleStep, recorded in the run
+    def doRecordedSampleStep(self, terms, termProbs, numTerms, numVars,
+                             varProbs):
         initTime = time.time()
-        i = random.choice(numTerms, p=termProbs)
+        z = self.doSampleStep(terms, termProbs, numTerms, numVars, varProbs)
+        self.run.add(z, time.time() - initTime)
+        return z
+
+    # terms are picked from the alias table of the lineage, when it has one
+    def pickTerm(self, numTerms, termProbs):
+        if self.aliasTable is None:
+            return self.randomState.choice(numTerms, p=termProbs)
+        return self.aliasTable.pick(self.randomState)
+
+    def nextUniform(self):
+        if not self.uniforms:
+            self.uniforms = self.randomState.random_sample(4096).tolist()
+        return self.uniforms.pop()
+
+    # return a 0/1 estimator, as defined by Karp-Luby. Only the variables of
+    # the terms examined are drawn, when first needed, and a drawn value
+    # falsifies the earlier terms with the opposite literal, found through
+    # the occurrence index, so that they are skipped. Only the occurrences
+    # in earlier terms are visited.
+    def doSampleStepOriginal(self, terms, termProbs, numTerms, numVars, varProbs):
+        i = self.pickTerm(numTerms, termProbs)
 
-        pickedTerm = terms[i]
-        # sample a random number for each var
-        sampleProbs = random.sample(numVars + 1)
+        sampledTruth = {}
+        falsified = set()
 
-        sampledTruth = sampleProbs < varProbs
+        def assign(var, value):
+            sampledTruth[var] = value
+            for (j, positive) in self.occurrences.before(var, i):
+                if positive != value:
+                    falsified.add(j)
 
         # Force literals in the chosen term to be true/false
-        for lit in pickedTerm:
-            var = abs(lit)
-            litSign = sign(lit)
-            if litSign > 0:
-                sampledTruth[var] = 1
-            else:
-                sampledTruth[var] = 0
+        for lit in terms[i]:
+            assign(lit if lit > 0 else -lit, lit > 0)
 
-        lowerTermSat = False
-        for term in terms[0:i]:
+        for j in range(i):
+            if j in falsified:
+                continue
             sat = True
-            for lit in term:
-                var = abs(lit)
-                if (lit > 0 and not sampledTruth[var]) or \
-                        (lit < 0 and sampledTruth[var]):
+            for lit in terms[j]:
+                var = lit if lit > 0 else -lit
+                if var not in sampledTruth:
+                    assign(var, self.nextUniform() < varProbs[var])
+                if sampledTruth[var] != (lit > 0):
                     sat = False
                     break
             if sat:
-                lowerTermSat = True
-                break
-
-        if not lowerTermSat:
-            return 1
-        else:
-            return 0
+                return 0
+        return 1
 
     # Vazirani estimator (implemented in MayBMS, returns fraction of clauses
     # satisfied)
     def doSampleStepFractional(self, terms, termProbs, numTerms, numVars, varProbs):
         initTime = time.time()
 
-        i = random.choice(numTerms, p=termProbs)
+        i = self.pickTerm(numTerms, termProbs)
 
         pickedTerm = terms[i]
         # sample a random number for each var
-        sampleProbs = random.sample(numVars + 1)
+        sampleProbs = self.randomState.random_sample(numVars + 1)
 
         sampledTruth = sampleProbs < varProbs
 
@@ -5,121 +5,392 @@ import time
 from numpy import *
 
 from algorithm import algorithm
+from algorithm import in_memory
+import anytime
+import parallel
+import rng
+from stats import RunningStats, SampleRun
+
+# number of joined tuples whose bitsets are combined at once in memory
+joinChunkSize = 100000
+
+
+# The relations of a conjunct, named as in its SQL, with the constant and
+# join conditions on their columns
+class ConjunctJoin(object):
+
+    def __init__(self, relations, constantConditions, joinConditions):
+        # (alias, relName, isNegated) for each relation
+        self.relations = relations
+        # (alias, column, constant, isEqual)
+        self.constantConditions = constantConditions
+        # (alias1, column1, alias2, column2)
+        self.joinConditions = joinConditions
+
+
+# Each tuple of a relation is in a world with its probability. Worlds are
+# sampled numSamples at a time as packed bitsets, one row of bits per tuple,
+# and the query holds in a world if some joined tuples of a conjunct are all
+# (or, negated, are all not) in it.
+class BitsetEvaluator(object):
+
+    def __init__(self, conjunctJoins, database):
+        self.database = database
+        self.relNames = sorted(set(relName for join in conjunctJoins
+                                   for (_, relName, _) in join.relations))
+        self.conjuncts = [(join, self.joinTuples(join))
+                          for join in conjunctJoins]
+
+    # The row of each relation of the conjunct in each joined tuple
+    def joinTuples(self, join):
+        joined = [()]
+        for (k, (alias, relName, _)) in enumerate(join.relations):
+            conditions = []
+            for (column, constant, isEqual) in [
+                    (c[1], c[2], c[3]) for c in join.constantConditions
+                    if c[0] == alias]:
+                if type(constant) != int:
+                    raise in_memory.UnsupportedPlanException(
+                        "Generic constants are only evaluated in SQL")
+                conditions.append((column, constant, isEqual))
+            tuples = self.database.getTuples(relName)
+            aliases = [a for (a, _, _) in join.relations[:k]]
+            links = []
+            for (alias1, column1, alias2, column2) in join.joinConditions:
+                if alias1 == alias and alias2 in aliases:
+                    links.append((column1, aliases.index(alias2), column2))
+                elif alias2 == alias and alias1 in aliases:
+                    links.append((column2, aliases.index(alias1), column1))
+            index = {}
+            for (row, t) in enumerate(tuples):
+                selected = True
+                for (column, constant, isEqual) in conditions:
+                    if (t[column] == constant) != isEqual:
+                        selected = False
+                if selected:
+                    index.setdefault(tuple(t[column] for (column, _, _)
+                                           in links), []).append(row)
+            result = []
+            for rows in joined:
+                value = tuple(
+                    self.database.getTuples(join.relations[j][1])[
+                        rows[j]][column]
+                    for (_, j, column) in links)
+                for row in index.get(value, []):
+                    result.append(rows + (row,))
+            joined = result
+        return [array([rows[k] for rows in joined], dtype=int)
+                for k in range(len(join.relations))]
+
+    def drawWorlds(self, numSamples, randomState=None):
+        if randomState is None:
+            randomState = random
+        worlds = {}
+        for relName in self.relNames:
+            p = self.database.getProbabilities(relName, False, None)
+            draws = randomState.random_sample((len(p), numSamples))
+            worlds[relName] = packbits(draws < p, axis=1)
+        return worlds
+
+    # Returns an array with the outcome of the query in each world
+    def sample(self, numSamples, randomState=None):
+        worlds = self.drawWorlds(numSamples, randomState)
+        outcome = zeros((numSamples + 7) // 8, dtype=uint8)
+        for (join, rows) in self.conjuncts:
+            for start in range(0, len(rows[0]), joinChunkSize):
+                inWorld = None
+                for (k, (_, relName, isNegated)) in enumerate(join.relations):
+                    bits = worlds[relName][rows[k][start:start +
+                                                   joinChunkSize]]
+                    if isNegated:
+                        bits = invert(bits)
+                    if inWorld is None:
+                        inWorld = bits
+                    else:
+                        inWorld = inWorld & bits
+                outcome |= bitwise_or.reduce(inWorld, axis=0)
+        return unpackbits(outcome)[:numSamples].astype(bool)
 
 
 class NaiveSampler(object):
-    sampleRecord = []
-    estimatesRecord = []
-    sampleTimes = []
 
-    def __init__(self, dbConnection):
+    # with a batchSize above 1, each execution of the query samples
+    # batchSize worlds. With inMemory, the relations of the query are loaded
+    # once and the worlds are evaluated with NumPy instead of SQL. With
+    # numWorkers above 1, batches are sampled concurrently, by processes in
+    # memory and otherwise on connections opened by connect. With a seed, the
+    # worlds sampled are determined by it, and in SQL are the same worlds as
+    # those of SafeSample with that seed. The samples of a run are kept in
+    # run, a SampleRun with the given trace.
+    def __init__(self, dbConnection, batchSize=1, inMemory=False,
+                 numWorkers=1, connect=None, seed=None, trace=None):
         self.conn = dbConnection
+        self.seed = seed
+        self.trace = trace
+        self.run = SampleRun(trace)
+        self.batchSize = batchSize
+        self.inMemory = inMemory
+        self.numWorkers = numWorkers
+        self.connect = connect
+        self.queryBatchSize = 1
+        self.bitsetEvaluator = None
+        self.pool = None
+        self.outcomes = []
+        self.numBlocks = 0
+        self.sampleTime = 0
+        self.sampleStats = RunningStats()
+
+    def getConjunctJoin(self, conjunct):
+        relations = conjunct.getRelations()
+
+        relationNamesUsed = {}
+        relationSQLIds = {}
+        for rel in relations:
+            relName = rel.getName()
+            if relName in relationNamesUsed:
+                relationSQLIds[rel] = relName + \
+                    str(relationNamesUsed[relName] + 1)
+                relationNamesUsed[relName] += 1
+            else:
+                relationSQLIds[rel] = relName + str(1)
+                relationNamesUsed[relName] = 1
+
+        constantConditions = []
+        for rel in relations:
+            for i, constant in enumerate(rel.getConstraints()):
+                if not constant:
+                    continue
+                elif constant > 0:
+                    constantConditions.append(
+                        (relationSQLIds[rel], i, constant, True))
+                else:
+                    constantConditions.append(
+                        (relationSQLIds[rel], i, -1 * constant, False))
+
+        joinConditions = []
+        varPositions = [component.getVarPositions()
+                        for component in conjunct.getComponents()]
+        for componentVarPositions in varPositions:
+            for v in componentVarPositions.keys():
+                relsWithVar = componentVarPositions[v].keys()
+
+                for i in range(len(relsWithVar) - 1):
+                    positionsRelI = componentVarPositions[
+                        v][relsWithVar[i]]
+                    positionsRelIPlus1 = componentVarPositions[
+                        v][relsWithVar[i + 1]]
+                    for pos1 in positionsRelI:
+                        for pos2 in positionsRelIPlus1:
+                            joinConditions.append(
+                                (relationSQLIds[relsWithVar[i]],
+                                 relsWithVar[i].getTableColumn(pos1),
+                                 relationSQLIds[relsWithVar[i + 1]],
+                                 relsWithVar[i + 1].getTableColumn(pos2)))
 
-    def prepareQuery(self, query):
+        return ConjunctJoin(
+            [(relationSQLIds[rel], rel.getName(), rel.isNegated())
+             for rel in relations],
+            constantConditions, joinConditions)
+
+    # With a batchSize above 1, the query returns a bit string with the
+    # outcome of each of batchSize worlds, otherwise a single boolean. With a
+    # seed, tuples are drawn by safesample_uniform in the worlds numbered from
+    # the firstSample parameter of the query.
+    def prepareQuery(self, query, batchSize=1, seed=None):
 
         allRelationsUsed = set()
         conjunctSQL = []
         for conjunct in query.getConjuncts():
-            relations = conjunct.getRelations()
-
-            relationNamesUsed = {}
-            relationSQLIds = {}
-            for rel in relations:
-                relName = rel.getName()
-                if relName in relationNamesUsed:
-                    relationSQLIds[rel] = relName + \
-                        str(relationNamesUsed[relName] + 1)
-                    relationNamesUsed[relName] += 1
-                else:
-                    relationSQLIds[rel] = relName + str(1)
-                    relationNamesUsed[relName] = 1
-                    if relName not in allRelationsUsed:
-                        allRelationsUsed.add(relName)
+            join = self.getConjunctJoin(conjunct)
 
             relationNames = []
-            for rel in relations:
-                relName = rel.getName()
-                relationNames.append(
-                    "%s as %s" % (relName, relationSQLIds[rel]))
+            for (alias, relName, _) in join.relations:
+                allRelationsUsed.add(relName)
+                relationNames.append("%s as %s" % (relName, alias))
             relationsSQL = ', '.join(relationNames)
 
-            relationsUsed = {}
             equalityConstraints = []
-
-            for rel in relations:
-                if rel.isNegated():
-                    equalityConstraints.append(
-                        "%s.InSample = 0" % (relationSQLIds[rel]))
+            for (alias, _, isNegated) in join.relations:
+                if isNegated:
+                    equalityConstraints.append("%s.InSample = 0" % alias)
                 else:
-                    equalityConstraints.append(
-                        "%s.InSample = 1" % (relationSQLIds[rel]))
-                for i, constant in enumerate(rel.getConstraints()):
-                    if not constant:
-                        continue
-                    elif constant > 0:
+                    equalityConstraints.append("%s.InSample = 1" % alias)
+                for (_, i, constant, isEqual) in [
+                        c for c in join.constantConditions if c[0] == alias]:
+                    if isEqual:
                         equalityConstraints.append(
-                            "%s.v%d = %d" % (relationSQLIds[rel], i, constant))
+                            "%s.v%d = %d" % (alias, i, constant))
                     else:
                         equalityConstraints.append(
-                            "%s.v%d != %d" % (relationSQLIds[rel], i, -1 * constant))
-
-            varPositions = [component.getVarPositions()
-                            for component in conjunct.getComponents()]
-            for componentVarPositions in varPositions:
-                for v in componentVarPositions.keys():
-                    relsWithVar = componentVarPositions[v].keys()
-
-                    for i in range(len(relsWithVar) - 1):
-                        positionsRelI = componentVarPositions[
-                            v][relsWithVar[i]]
-                        positionsRelIPlus1 = componentVarPositions[
-                            v][relsWithVar[i + 1]]
-                        for pos1 in positionsRelI:
-                            for pos2 in positionsRelIPlus1:
-                                equalityConstraints.append("%s.v%d = %s.v%d" %
-                                                           (relationSQLIds[relsWithVar[i]], relsWithVar[i].getTableColumn(pos1),
-                                                            relationSQLIds[relsWithVar[i + 1]], relsWithVar[i + 1].getTableColumn(pos2)))
+                            "%s.v%d != %d" % (alias, i, constant))
+            for (alias1, column1, alias2, column2) in join.joinConditions:
+                equalityConstraints.append("%s.v%d = %s.v%d" %
+                                           (alias1, column1, alias2, column2))
+            if batchSize > 1:
+                firstAlias = join.relations[0][0]
+                for (alias, _, _) in join.relations[1:]:
+                    equalityConstraints.append("%s.sample_id = %s.sample_id" %
+                                               (alias, firstAlias))
 
             if len(equalityConstraints):
                 whereSQL = "WHERE %s" % ' AND '.join(equalityConstraints)
             else:
                 whereSQL = ""
 
-            conjunctSQL.append("SELECT EXISTS (SELECT * FROM %s %s)" % (relationsSQL,
-                                                                        whereSQL))
+            if batchSize > 1:
+                conjunctSQL.append("SELECT %s.sample_id FROM %s %s" % (
+                    join.relations[0][0], relationsSQL, whereSQL))
+            else:
+                conjunctSQL.append("SELECT EXISTS (SELECT * FROM %s %s)" % (
+                    relationsSQL, whereSQL))
 
         sampledTables = []
-        for relName in allRelationsUsed:
+        if batchSize > 1:
+            if seed is None:
+                sampleIds = "1, %d" % batchSize
+            else:
+                sampleIds = "%%(firstSample)s, %%(firstSample)s + %d" % (
+                    batchSize - 1)
             sampledTables.append(
-                "%s as (select *, CASE WHEN random() < p THEN 1 ELSE 0 END as InSample FROM %s)" % (relName, relName))
+                "sample_ids as (select generate_series(%s) as sample_id)" %
+                sampleIds)
+        for relName in allRelationsUsed:
+            if batchSize > 1:
+                sampledTables.append(
+                    "%s as (select sample_ids.sample_id, %s.*, CASE WHEN %s < p THEN 1 ELSE 0 END as InSample FROM %s, sample_ids)" % (relName, relName, rng.uniformSQL(seed, "sample_ids.sample_id", relName, "%s.id" % relName), relName))
+            else:
+                sampledTables.append(
+                    "%s as (select *, CASE WHEN %s < p THEN 1 ELSE 0 END as InSample FROM %s)" % (relName, rng.uniformSQL(seed, "%(firstSample)s", relName), relName))
 
         sampleTableSQL = ', '.join(sampledTables)
 
-        querySQL = 'WITH %s SELECT true IN (%s) Q' % (
-            sampleTableSQL, ' UNION '.join(conjunctSQL))
+        if batchSize > 1:
+            querySQL = ("WITH %s SELECT string_agg(CASE WHEN sample_ids.sample_id IN (%s) THEN '1' ELSE '0' END, '' ORDER BY sample_ids.sample_id)::varbit Q FROM sample_ids" % (
+                sampleTableSQL, ' UNION '.join(conjunctSQL)))
+        else:
+            querySQL = 'WITH %s SELECT true IN (%s) Q' % (
+                sampleTableSQL, ' UNION '.join(conjunctSQL))
         print algorithm.getPrettySQL(querySQL)
         return querySQL
 
     def naiveSample(self, query, numSamples):
-        querySQL = self.prepareQuery(query)
+        querySQL = self.startRun(query)
         return self.sample(querySQL, numSamples)
 
-    def sample(self, querySQL, numSamples):
-        cur = self.conn.cursor()
-        self.sampleRecord = []
-        self.estimatesRecord = []
-        sampledSum = 0
-        for i in range(numSamples):
-            if i > 0 and i % 500 == 0:
-                print "Computing sample %d" % (i + 1)
-            initTime = time.time()
+    # Yields (samples so far, estimate, confidence interval half-width,
+    # elapsed seconds) after each batch of worlds, until maxSamples samples,
+    # or the first batch ending after deadline, a time.time()
+    def naiveSampleEstimates(self, query, maxSamples=None, deadline=None):
+        querySQL = self.startRun(query)
+        self.startSampling(querySQL)
+        try:
+            for estimate in anytime.estimates(
+                    self.run, lambda: self.doSampleStep(querySQL),
+                    self.endOfBatch, maxSamples, deadline):
+                yield estimate
+        finally:
+            self.closeRun()
+
+    # Returns the query sampling the worlds of the run, or None in memory
+    def startRun(self, query):
+        self.queryBatchSize = self.batchSize
+        self.bitsetEvaluator = None
+        if self.inMemory:
+            try:
+                conjunctJoins = [self.getConjunctJoin(conjunct)
+                                 for conjunct in query.getConjuncts()]
+                database = in_memory.loadDatabase(
+                    self.conn, sorted(set(
+                        relName for join in conjunctJoins
+                        for (_, relName, _) in join.relations)))
+                self.bitsetEvaluator = BitsetEvaluator(conjunctJoins,
+                                                       database)
+                self.queryBatchSize = max(self.batchSize,
+                                          in_memory.blockSize)
+                return None
+            except in_memory.UnsupportedPlanException as e:
+                print "Sampling in SQL: %s" % e
+        return self.prepareQuery(query, self.queryBatchSize, self.seed)
+
+    # Returns the outcomes of the worlds of the blockIndex-th batch
+    def sampleWorlds(self, conn, querySQL, blockIndex):
+        if self.bitsetEvaluator is not None:
+            return self.bitsetEvaluator.sample(
+                self.queryBatchSize,
+                rng.blockRandomState(self.seed, blockIndex)).tolist()
+        cur = conn.cursor()
+        if self.seed is None:
             cur.execute(querySQL)
-            queryTrue = cur.fetchone()[0]
-            if queryTrue:
-                sampledSum = sampledSum + 1
-                self.sampleRecord.append(1)
-            else:
-                self.sampleRecord.append(0)
-            self.estimatesRecord.append(sampledSum / (i + 1))
-            self.sampleTimes.append(time.time() - initTime)
-        return sampledSum / (i + 1)
+        else:
+            cur.execute(querySQL, {
+                'firstSample': blockIndex * self.queryBatchSize + 1})
+        if self.queryBatchSize > 1:
+            outcomes = [bit == '1' for bit in cur.fetchone()[0]]
+        else:
+            outcomes = [cur.fetchone()[0]]
+        cur.close()
+        return outcomes
+
+    def startSampling(self, querySQL):
+        self.run = SampleRun(self.trace)
+        self.sampleStats = RunningStats()
+        self.outcomes = []
+        self.numBlocks = 0
+        self.pool = None
+        if self.numWorkers > 1:
+            if self.bitsetEvaluator is not None:
+                self.pool = parallel.SamplingPool(
+                    lambda conn, blockIndex: self.sampleWorlds(
+                        conn, querySQL, blockIndex),
+                    self.numWorkers)
+            elif self.connect is not None:
+                self.pool = parallel.SamplingPool(
+                    lambda conn, blockIndex: self.sampleWorlds(
+                        conn, querySQL, blockIndex),
+                    self.numWorkers, self.connect)
+
+    def closeRun(self):
+        if self.pool is not None:
+            self.sampleStats = self.pool.getStats()
+            self.pool.close()
+            self.pool = None
+
+    def sample(self, querySQL, numSamples):
+        self.startSampling(querySQL)
+        try:
+            sampledSum = 0
+            for i in range(numSamples):
+                if i > 0 and i % 500 == 0:
+                    print "Computing sample %d" % (i + 1)
+                if self.doSampleStep(querySQL):
+                    sampledSum = sampledSum + 1
+            return sampledSum / (i + 1)
+        finally:
+            self.closeRun()
+
+    # Returns the outcome of the query in the next world, and records it
+    def doSampleStep(self, querySQL):
+        if self.pool is not None:
+            (queryTrue, self.sampleTime) = self.pool.nextSample()
+        else:
+            if not self.outcomes:
+                # the time of a batch is spread evenly over its worlds
+                initTime = time.time()
+                outcomes = self.sampleWorlds(self.conn, querySQL,
+                                             self.numBlocks)
+                self.numBlocks += 1
+                outcomes.reverse()
+                self.sampleTime = (time.time() - initTime) / len(outcomes)
+                self.outcomes = outcomes
+            queryTrue = self.outcomes.pop()
+            self.sampleStats.add(queryTrue)
+        if queryTrue:
+            self.run.add(1, self.sampleTime)
+        else:
+            self.run.add(0, self.sampleTime)
+        return queryTrue
+
+    def endOfBatch(self):
+        if self.pool is not None:
+            return self.pool.endOfBlock()
+        return not self.outcomes
@@ -0,0 +1,137 @@
+from __future__ import division
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import threading
+import time
+
+import numpy as np
+
+from stats import RunningStats
+
+# blocks each worker may have sampled ahead of the consumer
+blocksAhead = 2
+
+# the sampler of the process pool being started, inherited by its workers
+processSampleBlock = None
+
+
+# each worker process takes its own seed, so that its samples come from an
+# independent stream
+def seedWorker(seeds):
+    np.random.seed(seeds.get())
+
+
+def sampleProcessBlock(blockIndex):
+    return (os.getpid(), processSampleBlock(None, blockIndex))
+
+
+# Workers sample blocks of samples concurrently, which are handed out one
+# sample at a time in the order the blocks were submitted, whichever worker
+# finishes first. The samples then are a single sequence independent of the
+# timing of the workers, so that stopping rules hold over all workers.
+class SamplingPool(object):
+
+    # sampleBlock(conn, blockIndex) returns the list of samples of the
+    # blockIndex-th block, numbered from 0. With connect, a function opening a
+    # database connection, numWorkers threads sample in SQL, each on a
+    # connection of its own, prepared by prepare(conn) if given. Otherwise
+    # numWorkers processes, forked from this one, sample in memory with a
+    # connection of None.
+    def __init__(self, sampleBlock, numWorkers, connect=None, prepare=None):
+        global processSampleBlock
+        self.sampleBlock = sampleBlock
+        self.numWorkers = numWorkers
+        self.connect = connect
+        self.prepare = prepare
+        self.connections = []
+        self.idleConnections = Queue.Queue()
+        self.started = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.workerStats = {}
+        self.pending = []
+        self.numBlocks = 0
+        self.buffer = []
+        self.bufferWorker = None
+        self.sampleTime = 0
+        if connect is None:
+            processSampleBlock = sampleBlock
+            seeds = multiprocessing.Queue()
+            for seed in np.random.randint(2 ** 31, size=numWorkers):
+                seeds.put(seed)
+            self.pool = multiprocessing.Pool(numWorkers, seedWorker, (seeds,))
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(numWorkers)
+
+    # The connections are opened and prepared before any block is submitted,
+    # so that the time of the blocks leaves out their preparation, and errors
+    # in it are raised by the first nextSample
+    def start(self):
+        self.started = True
+        if self.connect is not None:
+            for i in range(self.numWorkers):
+                conn = self.connect()
+                self.connections.append(conn)
+                if self.prepare is not None:
+                    self.prepare(conn)
+                self.idleConnections.put(conn)
+        self.lastTime = time.time()
+        for i in range(self.numWorkers * blocksAhead):
+            self.submit()
+
+    def submit(self):
+        if self.connect is None:
+            self.pending.append(self.pool.apply_async(
+                sampleProcessBlock, (self.numBlocks,)))
+        else:
+            self.pending.append(self.pool.apply_async(
+                self.sampleThreadBlock, (self.numBlocks,)))
+        self.numBlocks += 1
+
+    def sampleThreadBlock(self, blockIndex):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.idleConnections.get()
+        return (threading.current_thread().ident,
+                self.sampleBlock(self.local.conn, blockIndex))
+
+    # Returns the next sample and the wall time per sample of its block,
+    # since the block before it was handed out
+    def nextSample(self):
+        if not self.started:
+            self.start()
+        while not self.buffer:
+            (worker, block) = self.pending.pop(0).get()
+            self.submit()
+            now = time.time()
+            if block:
+                self.sampleTime = (now - self.lastTime) / len(block)
+                self.lastTime = now
+            self.buffer = list(reversed(block))
+            self.bufferWorker = worker
+        value = self.buffer.pop()
+        self.workerStats.setdefault(self.bufferWorker,
+                                    RunningStats()).add(value)
+        return (value, self.sampleTime)
+
+    # whether the last sample handed out ended its block
+    def endOfBlock(self):
+        return not self.buffer
+
+    # the statistics of the samples handed out, merged over the workers
+    def getStats(self):
+        stats = RunningStats()
+        for workerStats in self.workerStats.values():
+            stats.merge(workerStats)
+        return stats
+
+    # blocks still being sampled are dropped
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.cancel()
+        self.pool.terminate()
+        self.pool.join()
+        for conn in self.connections:
+            conn.close()
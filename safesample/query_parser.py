@@ -14,7 +14,7 @@ import re
 import sys
 import time
 
-from algorithm import algorithm, query_exp, query_sym
+from algorithm import algorithm, plan_cache, query_exp, query_sym
 import karp_luby
 import naive
 import safe
@@ -43,6 +43,27 @@ def executeSQL(sql):
     return prob
 
 
+# Number of tuples of each relation, used to rank residual queries
+def getCardinalities(queryDNF):
+    cardinalities = {}
+    cur = conn.cursor()
+    for relName in set([r.getName() for r in queryDNF.getRelations()]):
+        try:
+            cur.execute("select count(*) from %s" % relName)
+            cardinalities[relName] = cur.fetchone()[0]
+        except psycopg2.Error as e:
+            print "SQL error: %s" % e.pgerror
+    cur.close()
+    return cardinalities
+
+
+# A connection of its own for a sampling worker
+def connect():
+    workerConn = psycopg2.connect(dbname=database)
+    workerConn.autocommit = True
+    return workerConn
+
+
 def printProbability(sql):
     prob = executeSQL(sql)
     if prob is not None:
@@ -171,8 +192,16 @@ class CommandLineParser(cmd.Cmd):
     graphQueryPlan = False
     sample = True
     karpluby = False
+    karpLubyEstimator = 'dklr'
     naive = False
+    rankResiduals = False
+    residualProcesses = None
     numSamples = 1000
+    batchSize = 1
+    inMemory = False
+    numWorkers = 1
+    seed = None
+    trace = None
     graphQueryPlanFile = "/tmp/query.png"
     showGraph = False
     exact = 0
@@ -181,12 +210,6 @@ class CommandLineParser(cmd.Cmd):
 
     def default(self, line):
         try:
-            safeSampleEstimates = []
-            safeSampleTimes = []
-            karpLubyEstimates = []
-            karpLubyTimes = []
-            naiveEstimates = []
-            naiveTimes = []
             exactProb = 0
             queryStr = line
             queryDNF = parse(queryStr)
@@ -206,37 +229,60 @@ class CommandLineParser(cmd.Cmd):
                         startTime = time.time()
                         print ("Query unsafe, ",
                                "trying to find safe residual query")
-                        (relationsToSample,
-                         residualDNF,
-                         querySQL,
-                         relsObjects) = algorithm.\
-                            findSafeResidualQuery(queryDNF)
+                        if self.rankResiduals:
+                            (querySQL, ranked) = algorithm.\
+                                findRankedSafeResidualQueries(
+                                    queryDNF,
+                                    getCardinalities(queryDNF),
+                                    self.residualProcesses)
+                            for (rels, _, _, _, cost) in ranked:
+                                print ("Candidate: %s (tuples %d, joins %d, "
+                                       "depth %d)" % ((', '.join(rels),) +
+                                                      cost))
+                            (relationsToSample,
+                             residualDNF,
+                             _,
+                             relsObjects,
+                             _) = ranked[0]
+                        else:
+                            (relationsToSample,
+                             residualDNF,
+                             querySQL,
+                             relsObjects) = algorithm.\
+                                findSafeResidualQuery(queryDNF)
+                        residualPlan = algorithm.getSafeQueryPlan(
+                            residualDNF)
                         print ("Relations to sample: ",
                                ', '.join(relationsToSample))
                         print "Residual Query: ", residualDNF
                         print algorithm.getPrettySQL(querySQL), "\n"
                         if self.execSQL:
-                            ssExecutor = safe.SafeSample(conn)
+                            ssExecutor = safe.SafeSample(
+                                conn, self.batchSize, self.inMemory,
+                                self.numWorkers, connect, self.seed,
+                                self.trace)
                             estimate = ssExecutor.safeSample(
                                 relationsToSample,
                                 relsObjects,
                                 querySQL,
                                 self.numSamples,
                                 self.epsilon,
-                                self.delta)
+                                self.delta,
+                                residualPlan)
                             print "SafeSample Estimate:", estimate
-                            safeSampleTimes = ssExecutor.sampleTimes
                             print "SafeSample Total Time: %f seconds" % (
                                 time.time() - startTime)
                             print "SafeSample Mean Sample Time: %f seconds" % (
-                                sum(safeSampleTimes) /
-                                float(len(safeSampleTimes)))
-                            safeSampleEstimates = ssExecutor.getEstimates()
+                                ssExecutor.run.getMeanSampleTime())
+                            print "SafeSample Prepare Time: %f seconds" % (
+                                ssExecutor.prepareTime)
+                            print "SafeSample Sample Variance: %f" % (
+                                ssExecutor.sampleStats.getVariance())
+                            numSamples = ssExecutor.run.getNumSamples()
                             print "SafeSample Number of Samples: " + \
                                    "%d (%d + %d to estimate variance)" % (
-                                len(safeSampleEstimates) +
-                                ssExecutor.step2NumSamples,
-                                len(safeSampleEstimates),
+                                numSamples + ssExecutor.step2NumSamples,
+                                numSamples,
                                 ssExecutor.step2NumSamples)
                     except algorithm.UnsafeException:
                         print "Error: No safe residual query found"
@@ -246,36 +292,47 @@ class CommandLineParser(cmd.Cmd):
             if self.naive:
                 print ""
                 startTime = time.time()
-                naiveExecutor = naive.NaiveSampler(conn)
+                naiveExecutor = naive.NaiveSampler(
+                    conn, self.batchSize, self.inMemory, self.numWorkers,
+                    connect, self.seed, self.trace)
                 estimate = naiveExecutor.naiveSample(queryDNF, self.numSamples)
                 print "Naive Sampler Estimate: %f (%d samples)" % (
                     estimate, self.numSamples)
-                naiveEstimates = naiveExecutor.estimatesRecord
-                naiveTimes = naiveExecutor.sampleTimes
                 print "Naive Sampler Total Time: %f seconds" % (
                     time.time() - startTime)
                 print "Naive Sampler Mean Sample Time: %f seconds" % (
-                    sum(naiveTimes) / float(len(naiveTimes)))
+                    naiveExecutor.run.getMeanSampleTime())
+                print "Naive Sampler Sample Variance: %f" % (
+                    naiveExecutor.sampleStats.getVariance())
 
-            if self.karpluby:
+            if self.karpluby and not self.karpLubyRunnable():
+                print ""
+                print "Error: the klm estimator needs epsilon and delta above 0"
+            elif self.karpluby:
                 print ""
                 startTime = time.time()
-                klExecutor = karp_luby.KarpLuby(conn)
+                klExecutor = karp_luby.KarpLuby(
+                    conn, self.karpLubyEstimator, self.numWorkers,
+                    self.seed, self.trace)
                 estimate = klExecutor.karpLuby(
                     queryDNF, self.numSamples, self.epsilon, self.delta)
                 print "Karp-Luby Estimate:", estimate
-                karpLubyTimes = klExecutor.sampleTimes
                 print "Karp-Luby Total Time: %f seconds" % (
                     time.time() - startTime)
                 print "Karp-Luby Mean Sample Time: %f seconds" % (
-                    sum(karpLubyTimes) / float(len(karpLubyTimes)))
-                karpLubyEstimates = klExecutor.getEstimates()
-                print "Karp-Luby Number of Samples: %d (%d + %d to estimate variance)" % (
-                    len(karpLubyEstimates) + klExecutor.step2NumSamples,
-                    len(karpLubyEstimates), klExecutor.step2NumSamples)
-                print "Karp-Luby Stopping Rule Samples " + \
-                       "(included in total above): %d" % (
-                    klExecutor.step1NumSamples)
+                    klExecutor.run.getMeanSampleTime())
+                numSamples = klExecutor.run.getNumSamples()
+                if klExecutor.estimator == 'klm':
+                    print "Karp-Luby-Madras Trials: %d, Term Checks: %d" % (
+                        klExecutor.coverageNumTrials,
+                        klExecutor.coverageNumSteps)
+                else:
+                    print "Karp-Luby Number of Samples: %d (%d + %d to estimate variance)" % (
+                        numSamples + klExecutor.step2NumSamples,
+                        numSamples, klExecutor.step2NumSamples)
+                    print "Karp-Luby Stopping Rule Samples " + \
+                           "(included in total above): %d" % (
+                        klExecutor.step1NumSamples)
 
         except ParseError:
             print "Failed to parse"
@@ -366,6 +423,20 @@ class CommandLineParser(cmd.Cmd):
         else:
             print "Karp-Luby off"
 
+    # the self-adjusting coverage estimator has no fixed number of samples
+    def karpLubyRunnable(self):
+        return (self.karpLubyEstimator != 'klm' or
+                (self.epsilon > 0 and self.delta > 0))
+
+    def do_klestimator(self, line):
+        if line in ['dklr', 'klm']:
+            self.karpLubyEstimator = line
+            print "Karp-Luby estimator set to %s" % line
+            if not self.karpLubyRunnable():
+                print "Error: the klm estimator needs epsilon and delta above 0"
+        else:
+            print "Karp-Luby estimator must be dklr or klm"
+
     def do_naive(self, line):
         self.naive = not self.naive
         if self.naive:
@@ -373,6 +444,58 @@ class CommandLineParser(cmd.Cmd):
         else:
             print "Naive sample off"
 
+    def do_rankresiduals(self, line):
+        self.rankResiduals = not self.rankResiduals
+        if line:
+            self.rankResiduals = True
+            self.residualProcesses = int(line)
+        if self.rankResiduals:
+            print "Rank residual queries on"
+        else:
+            print "Rank residual queries off"
+
+    def do_batchsize(self, line):
+        try:
+            self.batchSize = int(line)
+            print "Sampling batch size set to %d" % self.batchSize
+        except:
+            print "Failed to parse batch size"
+
+    def do_workers(self, line):
+        try:
+            self.numWorkers = int(line)
+            print "Sampling workers set to %d" % self.numWorkers
+        except:
+            print "Failed to parse number of workers"
+
+    def do_seed(self, line):
+        try:
+            if line:
+                self.seed = int(line)
+                print "Sampling seed set to %d" % self.seed
+            else:
+                self.seed = None
+                print "Sampling seed off"
+        except:
+            print "Failed to parse seed"
+
+    def do_trace(self, line):
+        if line in ['decimated', 'full']:
+            self.trace = line
+            print "Sample trace: %s" % self.trace
+        elif line in ['', 'none']:
+            self.trace = None
+            print "Sample trace off"
+        else:
+            print "Unknown trace %s" % line
+
+    def do_inmemory(self, line):
+        self.inMemory = not self.inMemory
+        if self.inMemory:
+            print "In-memory sampling on"
+        else:
+            print "In-memory sampling off"
+
     def do_epsilon(self, line):
         self.epsilon = float(line)
         print "Epsilon = %f" % self.epsilon
@@ -381,8 +504,12 @@ class CommandLineParser(cmd.Cmd):
         self.delta = float(line)
         print "Delta = %f" % self.delta
 
+    def do_plancache(self, line):
+        print "Plan cache: %s" % algorithm.planCache.getStats()
+
     def do_EOF(self, line):
         print ""
+        algorithm.planCache.save()
         return True
 
     def help_overview(self):
@@ -391,18 +518,45 @@ class CommandLineParser(cmd.Cmd):
         print "(* denotes deterministic relation)\n"
         print "Extra commands:\n"
         print "karpluby : toggle Karp-Luby estimate (default=True)"
+        print ("klestimator dklr|klm : Karp-Luby stopping rule or ",
+               "self-adjusting coverage estimator (default=dklr)")
         print ("numsamples INT : number of samples for SafeSample ",
                "and Karp-Luby (default=1000)")
+        print ("batchsize INT : number of worlds SafeSample and the naive ",
+               "sampler sample per query (default=1)")
+        print ("inmemory : toggle evaluating residual and naive queries ",
+               "in memory (default=False)")
+        print ("workers INT : number of connections, or processes in ",
+               "memory, sampling at once (default=1)")
+        print ("seed [INT] : sample reproducible worlds from a seed, ",
+               "or random ones without (default=none)")
+        print ("trace none|decimated|full : keep no trace of the samples, ",
+               "a bounded one of the estimates, or all of them (default=none)")
         print "sample : toggle sampling for unsafe queries (default=True)"
         print "queryplan [file]: save query plan to file, or /tmp/query.png"
+        print ("rankresiduals [processes] : toggle ranking all safe ",
+               "residual queries by cost (default=False)")
+        print "plancache : show query plan cache statistics"
         print "sql : toggle executing SQL (default=True)\n"
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Usage: python query_parser.py [--db database: default=sampling]')
     parser.add_argument("--db", default="sampling")
+    parser.add_argument("--plancache", default=None,
+                        help="file to load query plans from and save them to")
+    parser.add_argument("--plancachesize", type=int, default=1024)
+    parser.add_argument("--maxcnfdisjuncts", type=int, default=None,
+                        help="sample queries whose CNF has more disjuncts")
+    parser.add_argument("--lineagecache", default=None,
+                        help="directory to keep Karp-Luby lineages in")
     args = parser.parse_args()
     database = args.db
 
+    algorithm.planCache = plan_cache.PlanCache(
+        args.plancachesize, args.plancache)
+    algorithm.maxCNFDisjuncts = args.maxcnfdisjuncts
+    karp_luby.lineageCacheDir = args.lineagecache
+
     conn = psycopg2.connect(dbname=database)
     conn.autocommit = True
     
@@ -0,0 +1,30 @@
+from __future__ import division
+import hashlib
+
+import numpy as np
+
+
+# The draw of the safesample_uniform SQL function: a uniform number in [0, 1)
+# from the first 52 bits of the md5 hash of the seed, the sample id, the
+# relation and the tuple id
+def uniform(seed, sampleId, relName, tupleId):
+    digest = hashlib.md5("%d:%d:%s:%d" % (seed, sampleId, relName.lower(),
+                                          tupleId)).hexdigest()
+    return int(digest[:13], 16) / 2 ** 52
+
+
+# SQL text of the draw for the tuple of relSym in the world sampleId, or
+# random() without a seed
+def uniformSQL(seed, sampleId, relSym, tupleId="id"):
+    if seed is None:
+        return "random()"
+    return "safesample_uniform(%d, %s, '%s', %s)" % (seed, sampleId, relSym,
+                                                     tupleId)
+
+
+# The random numbers of a block of samples, in memory, come from a stream of
+# their own, so that they do not depend on which worker samples the block
+def blockRandomState(seed, blockIndex):
+    if seed is None:
+        return None
+    return np.random.RandomState([seed, blockIndex])
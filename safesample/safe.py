@@ -1,28 +1,102 @@
 from __future__ import division
+import itertools
 import psycopg2
+import threading
 import time
 import math
 import numpy as np
 
+from algorithm import algorithm
+from algorithm import ground_tup
+from algorithm import in_memory
+import anytime
+import parallel
+import rng
+from stats import RunningStats, SampleRun
 
-class SafeSample(object):
-    sampleRecord = []
-    estimatesRecord = []
-    sampleTimes = []
 
+class SafeSample(object):
     step2NumSamples = 0
 
-    def __init__(self, dbConnection):
+    # the query of a run is prepared once on each connection and executed
+    # for every batch of worlds, with the first sample id as a parameter
+    prepareQueries = True
+    statementPrefix = "safesample_query"
+
+    # subplans of the residual query reading no sampled relations are
+    # computed once per connection into indexed temporary tables
+    materializeSubplans = True
+    tablePrefix = "safesample_subplan"
+
+    # the statement and tables of a run are named after a number of its own,
+    # so that runs sharing a connection do not clash
+    runIds = itertools.count(1)
+
+    # with a batchSize above 1, each execution of the query samples
+    # batchSize worlds, and samples are handed out from a buffer. With
+    # inMemory, the relations of the residual plan are loaded once and the
+    # plan is evaluated with NumPy instead of SQL. With numWorkers above 1,
+    # batches are sampled concurrently, by processes in memory and otherwise
+    # on connections opened by connect. With a seed, the worlds sampled are
+    # determined by it. The samples of a run are kept in run, a SampleRun
+    # with the given trace.
+    def __init__(self, dbConnection, batchSize=1, inMemory=False,
+                 numWorkers=1, connect=None, seed=None, trace=None):
         self.conn = dbConnection
+        self.seed = seed
+        self.trace = trace
+        self.run = SampleRun(trace)
+        self.numBlocks = 0
+        self.batchSize = batchSize
+        self.inMemory = inMemory
+        self.numWorkers = numWorkers
+        self.connect = connect
+        self.queryBatchSize = 1
+        self.worldEvaluator = None
+        self.pool = None
+        self.sampleStats = RunningStats()
+        self.sampleBuffer = []
+        self.bufferSampleTime = 0
+        self.preparedConnections = set()
+        # guards preparedConnections and prepareTime, as worker threads
+        # sample on connections of their own
+        self.prepareLock = threading.Lock()
+        # (table name, SQL) of the subplans materialized in a run
+        self.materializedTables = []
+        # seconds spent preparing the query and materializing subplans, not
+        # counted in the sample times
+        self.prepareTime = 0
+        self.nameRun()
+
+    def nameRun(self):
+        runId = next(SafeSample.runIds)
+        self.statementName = "%s_%d" % (self.statementPrefix, runId)
+        self.runTablePrefix = "%s_%d" % (self.tablePrefix, runId)
 
-    def prepareQuery(self, relationsToSample, relsObjects, querySQL):
+    # With a seed, tuples are drawn by safesample_uniform in the worlds
+    # numbered from the firstSample parameter of the query
+    def prepareQuery(self, relationsToSample, relsObjects, querySQL,
+                     batchSize=1, seed=None):
         sampledTables = []
+        if batchSize > 1:
+            if seed is None:
+                sampleIds = "1, %d" % batchSize
+            else:
+                sampleIds = "%%(firstSample)s, %%(firstSample)s + %d" % (
+                    batchSize - 1)
+            sampledTables.append(
+                "sample_ids as (select generate_series(%s) as sample_id)" %
+                sampleIds)
         for rel in relsObjects:
             relSym = rel.getName()
             # TODO(ericgribkoff) generalize this for sampled relations with
             # more than just v0
-            sampledTables.append(
-                "%s as (select v0, CASE WHEN random() < p THEN 1 ELSE 0 END as p from %s)" % (relSym, relSym))
+            if batchSize > 1:
+                sampledTables.append(
+                    "%s as (select sample_ids.sample_id, v0, CASE WHEN %s < p THEN 1 ELSE 0 END as p from %s, sample_ids)" % (relSym, rng.uniformSQL(seed, "sample_ids.sample_id", relSym), relSym))
+            else:
+                sampledTables.append(
+                    "%s as (select v0, CASE WHEN %s < p THEN 1 ELSE 0 END as p from %s)" % (relSym, rng.uniformSQL(seed, "%(firstSample)s", relSym), relSym))
 
         safeSampleQuery = "with %s %s" % (', '.join(sampledTables),
                                           querySQL)
@@ -31,44 +105,181 @@ class SafeSample(object):
 
         return safeSampleQuery
 
-    def getEstimates(self):
-        self.estimatesRecord = []
-        sumSoFar = 0
-        for i in range(len(self.sampleRecord)):
-            sumSoFar += self.sampleRecord[i]
-            self.estimatesRecord.append(sumSoFar / (i + 1))
-        return self.estimatesRecord
+    # Given the plan of the residual query, worlds are sampled batchSize at a
+    # time, in memory or in SQL, otherwise querySQL is run once per sample
+    def safeSample(self, relationsToSample, relsObjects, querySQL, numSamples, epsilon=0, delta=0, plan=None):
+        safeSampleQuery = self.startRun(relationsToSample, relsObjects,
+                                        querySQL, plan)
+        try:
+            if epsilon > 0 and delta > 0:
+                return self.sampleOptimal(safeSampleQuery, numSamples, epsilon, delta)
+            else:
+                return self.sample(safeSampleQuery, numSamples)
+        finally:
+            self.closeRun()
+
+    # Yields (samples so far, estimate, confidence interval half-width,
+    # elapsed seconds) after each batch of worlds, until maxSamples samples,
+    # or the first batch ending after deadline, a time.time()
+    def safeSampleEstimates(self, relationsToSample, relsObjects, querySQL,
+                            plan=None, maxSamples=None, deadline=None):
+        safeSampleQuery = self.startRun(relationsToSample, relsObjects,
+                                        querySQL, plan)
+        try:
+            for estimate in anytime.estimates(
+                    self.run,
+                    lambda: self.doSampleStep(safeSampleQuery, True),
+                    self.endOfBatch, maxSamples, deadline):
+                yield estimate
+        finally:
+            self.closeRun()
+
+    def endOfBatch(self):
+        if self.pool is not None:
+            return self.pool.endOfBlock()
+        return not self.sampleBuffer
 
-    def safeSample(self, relationsToSample, relsObjects, querySQL, numSamples, epsilon=0, delta=0):
+    # Returns the query sampling the worlds of the run
+    def startRun(self, relationsToSample, relsObjects, querySQL, plan):
+        self.queryBatchSize = 1
+        self.worldEvaluator = None
+        self.materializedTables = []
+        self.nameRun()
+        if plan is not None and self.inMemory:
+            try:
+                database = in_memory.loadDatabase(
+                    self.conn, in_memory.getPlanRelationNames(plan))
+                self.worldEvaluator = in_memory.WorldEvaluator(plan, database)
+                self.queryBatchSize = max(self.batchSize, in_memory.blockSize)
+            except in_memory.UnsupportedPlanException as e:
+                print "Sampling in SQL: %s" % e
+        materialize = None
+        if (self.worldEvaluator is None and plan is not None and
+                self.materializeSubplans):
+            materialize = self.materializeSubplan
+        if (self.worldEvaluator is None and plan is not None and
+                self.batchSize > 1):
+            batchedSQL = algorithm.generateBatchedSQL_DNF(
+                plan, materialize=materialize)
+            # answers of non-Boolean queries are not batched
+            if not plan.hasGenericConstant():
+                querySQL = batchedSQL
+                self.queryBatchSize = self.batchSize
+        if materialize is not None and self.queryBatchSize == 1:
+            self.materializedTables = []
+            querySQL = plan.generateSQL_DNF(
+                None, algorithm.CompilationContext(materialize=materialize))
+        if self.worldEvaluator is None:
+            sqlBatchSize = self.queryBatchSize
+        else:
+            sqlBatchSize = 1
         safeSampleQuery = self.prepareQuery(
-            relationsToSample, relsObjects, querySQL)
-        self.sampleRecord = []
-        self.estimatesRecord = []
+            relationsToSample, relsObjects, querySQL, sqlBatchSize,
+            self.seed)
+        self.numBlocks = 0
+        self.sampleBuffer = []
+        self.run = SampleRun(self.trace)
+        self.sampleStats = RunningStats()
+
+        self.preparedConnections = set()
+        self.prepareTime = 0
+        self.pool = None
+        if self.numWorkers > 1:
+            if self.worldEvaluator is not None:
+                self.pool = parallel.SamplingPool(
+                    lambda conn, blockIndex: self.sampleBlock(
+                        conn, safeSampleQuery, blockIndex),
+                    self.numWorkers)
+            elif self.connect is not None:
+                self.pool = parallel.SamplingPool(
+                    lambda conn, blockIndex: self.sampleBlock(
+                        conn, safeSampleQuery, blockIndex),
+                    self.numWorkers, self.connect,
+                    lambda conn: self.prepareConnection(
+                        conn, safeSampleQuery))
+        return safeSampleQuery
 
-        if epsilon > 0 and delta > 0:
-            return self.sampleOptimal(safeSampleQuery, numSamples, epsilon, delta)
+    def closeRun(self):
+        if self.pool is not None:
+            self.sampleStats = self.pool.getStats()
+            self.pool.close()
+            self.pool = None
+        if self.conn in self.preparedConnections:
+            cur = self.conn.cursor()
+            try:
+                for (tableName, sql) in self.materializedTables:
+                    cur.execute("DROP TABLE IF EXISTS %s" % tableName)
+                if self.prepareQueries:
+                    cur.execute("DEALLOCATE %s" % self.statementName)
+            except psycopg2.Error as e:
+                print "SQL error: %s" % e.pgerror
+            cur.close()
+        self.preparedConnections = set()
+
+    # Replaces the SQL of a subplan reading no sampled relations with a read
+    # of the table its rows are materialized in; identical subplans share a
+    # table. A ground tuple is a scan of its relation, which a table would
+    # only copy.
+    def materializeSubplan(self, plan, sql):
+        if isinstance(plan, ground_tup.GroundTuple):
+            return sql
+        tableNames = dict((tableSQL, tableName)
+                          for (tableName, tableSQL) in self.materializedTables)
+        if sql in tableNames:
+            tableName = tableNames[sql]
         else:
-            return self.sample(safeSampleQuery, numSamples)
+            tableName = "%s_%d" % (self.runTablePrefix,
+                                   len(self.materializedTables) + 1)
+            self.materializedTables.append((tableName, sql))
+        return "\n -- materialized subplan \n select * from %s" % tableName
+
+    # Temporary tables are only seen by the connection creating them. The
+    # separator columns the query joins on are indexed.
+    def materializeTables(self, cur):
+        for (tableName, sql) in self.materializedTables:
+            cur.execute("DROP TABLE IF EXISTS %s" % tableName)
+            cur.execute("CREATE TEMPORARY TABLE %s AS %s" % (tableName, sql))
+            cur.execute("select * from %s limit 0" % tableName)
+            for column in [d[0] for d in cur.description]:
+                if column != 'puse':
+                    cur.execute("CREATE INDEX ON %s (%s)" % (tableName,
+                                                            column))
+            cur.execute("ANALYZE %s" % tableName)
+
+    # Materializes the subplans of the query and prepares it on conn, the
+    # first time it is used in the run. The first sample id is the parameter
+    # $1. The connections of a pool are prepared before it samples.
+    def prepareConnection(self, conn, safeSampleQuery):
+        with self.prepareLock:
+            if conn in self.preparedConnections:
+                return
+            # added first so that closeRun cleans up after errors
+            self.preparedConnections.add(conn)
+        initTime = time.time()
+        cur = conn.cursor()
+        self.materializeTables(cur)
+        if self.prepareQueries and self.seed is None:
+            cur.execute("PREPARE %s AS %s" % (self.statementName,
+                                              safeSampleQuery))
+        elif self.prepareQueries:
+            cur.execute("PREPARE %s (integer) AS %s" % (
+                self.statementName,
+                safeSampleQuery % {'firstSample': '$1'}))
+        cur.close()
+        with self.prepareLock:
+            self.prepareTime += time.time() - initTime
 
     def sample(self, safeSampleQuery, numSamples):
-        cur = self.conn.cursor()
         total = 0
         try:
             for i in range(numSamples):
                 if i > 0 and i % 500 == 0:
                     print "Computing sample %d" % (i + 1)
-                initTime = time.time()
-                cur.execute(safeSampleQuery)
-                residualProb = cur.fetchone()[0]
+                residualProb = self.doSampleStep(safeSampleQuery, True)
                 total = total + residualProb
-                self.sampleRecord.append(residualProb)
-                self.estimatesRecord.append(total / (i + 1))
-                self.sampleTimes.append(time.time() - initTime)
-            cur.close()
             return total / numSamples
         except psycopg2.Error as e:
             print "SQL error: %s" % e.pgerror
-            cur.close()
             return -1
 
     def sampleOptimal(self, safeSampleQuery, numSamples, epsilon, delta):
@@ -137,12 +348,52 @@ class SafeSample(object):
 
         return (muHatZ, sampledZ)
 
+    # The residual probabilities of the worlds of the blockIndex-th execution
+    # of the query, which are the same however many workers sample
+    def sampleBlock(self, conn, safeSampleQuery, blockIndex):
+        if self.worldEvaluator is not None:
+            return self.worldEvaluator.sample(
+                self.queryBatchSize,
+                rng.blockRandomState(self.seed, blockIndex)).tolist()
+        self.prepareConnection(conn, safeSampleQuery)
+        cur = conn.cursor()
+        firstSample = blockIndex * self.queryBatchSize + 1
+        if self.prepareQueries:
+            if self.seed is None:
+                cur.execute("EXECUTE %s" % self.statementName)
+            else:
+                cur.execute("EXECUTE %s (%%(firstSample)s)" %
+                            self.statementName, {'firstSample': firstSample})
+        elif self.seed is None:
+            cur.execute(safeSampleQuery)
+        else:
+            cur.execute(safeSampleQuery, {'firstSample': firstSample})
+        if self.queryBatchSize > 1:
+            block = [row[1] for row in cur.fetchall()]
+        else:
+            block = [cur.fetchone()[0]]
+        cur.close()
+        return block
+
+    # Returns the residual probability of the next sampled world, running
+    # the query again once the worlds of its last execution are used up. The
+    # time of an execution is spread evenly over its worlds.
     def doSampleStep(self, safeSampleQuery, record=False):
-        cur = self.conn.cursor()
-        initTime = time.time()
-        cur.execute(safeSampleQuery)
-        residualProb = cur.fetchone()[0]
+        if self.pool is not None:
+            (residualProb, self.bufferSampleTime) = self.pool.nextSample()
+        else:
+            if not self.sampleBuffer:
+                initTime = time.time()
+                prepareTime = self.prepareTime
+                block = self.sampleBlock(self.conn, safeSampleQuery,
+                                         self.numBlocks)
+                self.numBlocks += 1
+                self.bufferSampleTime = (time.time() - initTime - (
+                    self.prepareTime - prepareTime)) / len(block)
+                block.reverse()
+                self.sampleBuffer = block
+            residualProb = self.sampleBuffer.pop()
+            self.sampleStats.add(residualProb)
         if record:
-            self.sampleTimes.append(time.time() - initTime)
-            self.sampleRecord.append(residualProb)
+            self.run.add(residualProb, self.bufferSampleTime)
         return residualProb
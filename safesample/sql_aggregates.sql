@@ -13,3 +13,10 @@ create aggregate ior (double precision) (
   stype = double precision,
   finalfunc = ior_finalfunc,
   initcond = '1.0');
+
+-- a uniform draw in [0, 1) determined by a seed, a sample id, a relation and
+-- a tuple id, from the first 52 bits of their md5 hash, so that sampled
+-- worlds can be reproduced (mirrored by rng.uniform)
+create or replace function safesample_uniform (integer, integer, text, integer) returns double precision as
+'select (''x'' || substr(md5($1 || '':'' || $2 || '':'' || lower($3) || '':'' || $4), 1, 13))::bit(52)::bigint / 4503599627370496.0'
+language SQL immutable;
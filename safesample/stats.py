@@ -0,0 +1,112 @@
+from __future__ import division
+
+import numpy as np
+
+
+# Count, mean and variance of a stream of samples, updated one sample at a
+# time (Welford), which can be merged with those of another stream (Chan,
+# Golub, LeVeque), e.g. of another worker
+class RunningStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    def getSum(self):
+        return self.mean * self.count
+
+    # the unbiased sample variance, 0 with fewer than two samples
+    def getVariance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def __repr__(self):
+        return "n=%d mean=%f variance=%f" % (self.count, self.mean,
+                                             self.getVariance())
+
+
+# The result of one sampling run: statistics of its samples and of the time
+# per sample in constant memory, and optionally a trace of it. With trace
+# 'decimated', the running estimate is kept after every stride-th sample, at
+# most traceSize points, the stride doubling whenever the trace is full. With
+# trace 'full', every sample and sample time is kept in NumPy arrays.
+# Estimates are the mean of the samples times scale.
+class SampleRun(object):
+
+    def __init__(self, trace=None, traceSize=1024, scale=1.0):
+        self.trace = trace
+        self.traceSize = traceSize
+        self.scale = scale
+        self.samples = RunningStats()
+        self.times = RunningStats()
+        self.traceIndices = []
+        self.traceMeans = []
+        self.stride = 1
+        self.values = np.empty(0)
+        self.sampleTimes = np.empty(0)
+
+    def add(self, sample, sampleTime):
+        self.samples.add(sample)
+        self.times.add(sampleTime)
+        n = self.samples.count
+        if self.trace == 'decimated' and n % self.stride == 0:
+            if len(self.traceIndices) == self.traceSize:
+                self.traceIndices = self.traceIndices[1::2]
+                self.traceMeans = self.traceMeans[1::2]
+                self.stride *= 2
+            if n % self.stride == 0:
+                self.traceIndices.append(n)
+                self.traceMeans.append(self.samples.mean)
+        elif self.trace == 'full':
+            if n > len(self.values):
+                size = max(2 * len(self.values), 1024)
+                self.values = np.resize(self.values, size)
+                self.sampleTimes = np.resize(self.sampleTimes, size)
+            self.values[n - 1] = sample
+            self.sampleTimes[n - 1] = sampleTime
+
+    # the time of a step that yields no sample
+    def addTime(self, sampleTime):
+        self.times.add(sampleTime)
+
+    def getNumSamples(self):
+        return self.samples.count
+
+    def getEstimate(self):
+        return self.samples.mean * self.scale
+
+    def getMeanSampleTime(self):
+        return self.times.mean
+
+    def getSamples(self):
+        return self.values[:self.samples.count]
+
+    def getSampleTimes(self):
+        return self.sampleTimes[:self.samples.count]
+
+    # (numbers of samples, running estimates after them), as arrays
+    def getTrace(self):
+        if self.trace == 'full':
+            n = np.arange(1, self.samples.count + 1)
+            return (n, np.cumsum(self.getSamples()) / n * self.scale)
+        return (np.array(self.traceIndices, dtype=int),
+                np.array(self.traceMeans) * self.scale)
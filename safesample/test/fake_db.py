@@ -0,0 +1,39 @@
+# A stand-in for a psycopg2 connection, for tests of the samplers that need
+# no database. Every statement executed on its cursors is recorded in
+# executed, and fetchone returns row.
+
+
+class Cursor(object):
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        self.connection.executed.append((sql, params))
+
+    def fetchone(self):
+        return self.connection.row
+
+    def close(self):
+        self.closed = True
+
+
+class Connection(object):
+
+    def __init__(self, row=None):
+        self.row = row
+        self.executed = []
+        self.cursors = []
+
+    def cursor(self, name=None, withhold=False):
+        cur = Cursor(self, name)
+        self.cursors.append(cur)
+        return cur
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
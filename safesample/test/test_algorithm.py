@@ -1,4 +1,8 @@
-from safesample.algorithm import algorithm, query_exp, query_sym
+import multiprocessing.pool
+import pytest
+
+from safesample import query_parser
+from safesample.algorithm import algorithm, ind_proj, query_exp, query_sym
 
 def test_answer():
     R1 = query_sym.Relation('R', [query_sym.Variable('x1')])
@@ -144,3 +148,153 @@ def test_comp_minimization():
     assert com1.minimize().containedIn(com2) == True
     assert com2.containedIn(com1.minimize()) == True
 
+
+def test_conj_containment_long_chain():
+    def chain(n):
+        return query_exp.Component([
+            query_sym.Relation('R', [query_sym.Variable('x%d' % i),
+                                     query_sym.Variable('x%d' % (i + 1))])
+            for i in range(n)])
+    # a path of 12 edges maps onto a path of 6, but not the other way around
+    assert chain(12).containedIn(chain(6)) == True
+    assert chain(6).containedIn(chain(12)) == False
+    assert chain(12).findHomomorphism(chain(12)) is not None
+
+def test_comp_minimization_retraction():
+    S = query_sym.Relation('S', [query_sym.Variable('x')])
+    rels = [query_sym.Relation('R', [query_sym.Variable('x'), query_sym.Variable('y%d' % i)])
+            for i in range(12)]
+    core = query_exp.Component([S] + rels).minimize()
+    assert len(core.getRelations()) == 2
+    # a cycle of length 3 is already minimal
+    cycle = query_exp.Component([
+        query_sym.Relation('R', [query_sym.Variable('x'), query_sym.Variable('y')]),
+        query_sym.Relation('R', [query_sym.Variable('y'), query_sym.Variable('z')]),
+        query_sym.Relation('R', [query_sym.Variable('z'), query_sym.Variable('x')])])
+    assert len(cycle.minimize().getRelations()) == 3
+
+def test_separators():
+    x = query_sym.Variable('x')
+    y = query_sym.Variable('y')
+    R = query_sym.Relation('R', [y, x])
+    S = query_sym.Relation('S', [y, x])
+    T = query_sym.Relation('T', [x])
+    d = query_exp.DisjunctiveQuery([query_exp.Component([R, S])])
+    separators = d.getSeparators()
+    assert set(separators) == set([(x,), (y,)])
+    assert ind_proj.cheapestSeparator(d, separators) == (y,)
+    # R(y,x),T(x) v R(x,y): the separator must occupy the same position of R
+    d = query_exp.DisjunctiveQuery([
+        query_exp.Component([R, T]),
+        query_exp.Component([query_sym.Relation('R', [x, y])])])
+    assert d.getSeparators() == [(x, y)]
+    d = query_exp.DisjunctiveQuery([
+        query_exp.Component([R, T]),
+        query_exp.Component([query_sym.Relation('R', [x, x]), query_sym.Relation('T', [y])])])
+    assert d.getSeparators() == []
+
+def test_cnf_conversion_subsumption():
+    def com(name):
+        return query_exp.Component([query_sym.Relation(name, [query_sym.Variable('x')])])
+    # (R ^ S) v (R ^ T) v R distributes to 4 disjuncts, all of them implied
+    # by the first one, R v R v R
+    dnf = query_exp.DNF([query_exp.ConjunctiveQuery([com('R'), com('S')]),
+                         query_exp.ConjunctiveQuery([com('R'), com('T')]),
+                         query_exp.ConjunctiveQuery([com('R')])])
+    assert dnf.getCNFSizeBound() == 4
+    assert len(list(dnf.iterCNFDisjuncts())) == 1
+    assert len(dnf.toCNF().getDisjuncts()) == 1
+    with pytest.raises(algorithm.CNFTooLargeException):
+        query_exp.DNF([query_exp.ConjunctiveQuery([com('R'), com('S')]),
+                       query_exp.ConjunctiveQuery([com('T'), com('U')])]).toCNF(maxDisjuncts=3)
+
+def test_compilation_is_deterministic():
+    queries = ["R(x),S(x,y) v T(z),S(z,w)", "R(x),S(x,y),T(u) v T(x),U(x,y)"]
+    # a plan cached for an isomorphic query may order its children differently
+    algorithm.planCache.clear()
+    expected = [algorithm.buildSafeQueryPlan(
+        query_parser.parse(q), algorithm.CompilationContext()).generateSQL_DNF()
+        for q in queries]
+    assert [algorithm.getSafeQueryPlan(query_parser.parse(q)).generateSQL_DNF()
+            for q in queries] == expected
+    pool = multiprocessing.pool.ThreadPool(4)
+    try:
+        compiled = pool.map(
+            lambda q: algorithm.getSafeQueryPlan(query_parser.parse(q)).generateSQL_DNF(),
+            queries * 4)
+    finally:
+        pool.close()
+    assert compiled == expected * 4
+
+def test_mobius_coefficients_independent():
+    terms = algorithm.mobiusCoefficients(3, lambda s: s)
+    assert len(terms) == 7
+    assert all(coeff == (-1) ** len(s) for (s, coeff) in terms)
+
+def test_mobius_coefficients_cancellation():
+    # disjunct 2 is implied by the union of disjuncts 0 and 1, so the union of
+    # all three gets coefficient zero and is never generated
+    def closure(s):
+        if 0 in s and 1 in s:
+            return frozenset([0, 1, 2])
+        return s
+    terms = dict(algorithm.mobiusCoefficients(3, closure))
+    assert frozenset([0, 1, 2]) not in terms
+    assert terms[frozenset([0, 2])] == 1
+    assert terms[frozenset([1, 2])] == 1
+    assert len(terms) == 5
+
+def test_ranked_residual_queries():
+    R = query_sym.Relation('R', [query_sym.Variable('x')])
+    S = query_sym.Relation('S', [query_sym.Variable('x'), query_sym.Variable('y')])
+    T = query_sym.Relation('T', [query_sym.Variable('y')])
+    dnf = query_exp.DNF([query_exp.ConjunctiveQuery([query_exp.Component([R,S,T])])])
+    # sampling S is safe but samples the largest relation
+    cardinalities = {'R': 10, 'S': 100, 'T': 20}
+    (sql, ranked) = algorithm.findRankedSafeResidualQueries(
+        dnf, cardinalities, processes=1)
+    assert [rels for (rels, _, _, _, _) in ranked][0] == ('R',)
+    assert [cost[0] for (_, _, _, _, cost) in ranked] == sorted(
+        [cost[0] for (_, _, _, _, cost) in ranked])
+    assert sql
+    assert algorithm.findSafeResidualQuery(dnf)[0] in [r[0] for r in ranked]
+
+def test_is_safe_agrees_with_planner():
+    for q in ["R(x),S(x,y)", "R(x),S(x,y),T(y)", "R(x),S(x,y) v S(x,y),T(y)",
+              "R*(x),S(x,y),T(y)", "R(x),S*(x,y),T(y)", "S(x,y),S(y,x)"]:
+        dnf = query_parser.parse(q)
+        try:
+            algorithm.buildSafeQueryPlan(
+                query_parser.parse(q), algorithm.CompilationContext())
+            safe = True
+        except algorithm.UnsafeException:
+            safe = False
+        assert algorithm.isSafe(dnf) == safe
+
+def test_batched_sql_groups_by_world():
+    dnf = query_parser.parse("R(x),S(x,y) v S(x,y),T(y)").copyWithDeterminism(
+        set(['R', 'T']))
+    plan = algorithm.getSafeQueryPlan(dnf)
+    assert plan.usesSampledRelations()
+    sql = algorithm.generateBatchedSQL_DNF(plan)
+    assert 'group by sample_id' in sql
+    assert 'order by sample_ids.sample_id' in sql
+    assert 'sample_id' not in plan.generateSQL_DNF()
+
+def test_deterministic_subplans_materialized():
+    dnf = query_parser.parse("P1(x,y),Smokes(x),Friends(x,y),~Smokes(y)")
+    plan = algorithm.getSafeQueryPlan(
+        dnf.copyWithDeterminism(set(['Smokes'])))
+    materialized = []
+    def materialize(subplan, sql):
+        assert not subplan.usesSampledRelations()
+        materialized.append(sql)
+        return "select * from m%d" % len(materialized)
+    sql = plan.generateSQL_DNF(
+        None, algorithm.CompilationContext(materialize=materialize))
+    # the deterministic P1 and Friends are joined in one subplan
+    assert len(materialized) == 1
+    assert "from P1" in materialized[0] and "from Friends" in materialized[0]
+    assert "from P1" not in sql and "from Friends" not in sql
+    assert "select * from m1" in sql and "from Smokes" in sql
+    assert "from P1" in plan.generateSQL_DNF()
@@ -0,0 +1,29 @@
+from safesample import anytime, stats
+
+def test_anytime_estimates():
+    def estimates(maxSamples=None, deadline=None):
+        run = stats.SampleRun()
+        return anytime.estimates(
+            run, lambda: run.add(run.getNumSamples() % 2, 0.),
+            lambda: run.getNumSamples() % 3 == 0, maxSamples, deadline)
+    yielded = list(estimates(7))
+    assert [e[0] for e in yielded] == [3, 6, 7]
+    assert abs(yielded[-1][1] - 3 / 7.) < 1e-12
+    assert yielded[-1][2] > 0
+    # a deadline that has passed stops after the first batch
+    assert [e[0] for e in estimates(deadline=0)] == [3]
+    assert anytime.estimateUntil(estimates(), 0.05)[2] <= 0.05
+
+def test_anytime_estimates_batch_size_one():
+    # every sample is its own batch, and the first samples are all alike
+    def estimates(sample):
+        run = stats.SampleRun()
+        return anytime.estimates(run, lambda: run.add(sample, 0.),
+                                 lambda: True, 1000)
+    for sample in [0., 1.]:
+        yielded = list(estimates(sample))
+        assert yielded[0][2] == float('inf')
+        assert all(e[2] > 0 for e in yielded)
+        (n, estimate, halfWidth, elapsed) = anytime.estimateUntil(
+            estimates(sample), 0.01)
+        assert n > 100 and estimate == sample and halfWidth <= 0.01
@@ -0,0 +1,22 @@
+import numpy
+
+from safesample import query_parser
+from safesample.algorithm import algorithm, in_memory
+
+def test_in_memory_evaluation():
+    dnf = query_parser.parse("R(x),S(x,y) v S(x,y),T(y)").copyWithDeterminism(
+        set(['R', 'T']))
+    plan = algorithm.getSafeQueryPlan(dnf)
+    database = in_memory.InMemoryDatabase({
+        'R': ([(1,), (2,)], numpy.array([0.5, 0.5])),
+        'S': ([(1, 1), (1, 2), (2, 3)], numpy.array([0.5, 0.2, 0.4])),
+        'T': ([(2,), (3,)], numpy.array([0.5, 0.5]))})
+    evaluator = in_memory.WorldEvaluator(plan, database)
+    assert evaluator.sampledRelations == ['R', 'T']
+    # no tuples, only R(1), and R(1) with T(3)
+    worlds = {'R': numpy.array([[0., 1., 1.], [0., 0., 0.]]),
+              'T': numpy.array([[0., 0., 0.], [0., 0., 1.]])}
+    p = evaluator.evaluate(worlds, 3)
+    assert abs(p[0]) < 1e-12
+    assert abs(p[1] - (1 - 0.5 * 0.8)) < 1e-12
+    assert abs(p[2] - (1 - 0.5 * 0.8 * 0.6)) < 1e-12
@@ -0,0 +1,120 @@
+import numpy
+import pytest
+
+from safesample import karp_luby, query_parser
+from safesample.test import fake_db
+
+def test_lineage_matrix_counts_satisfied_terms():
+    terms = [[1, 2], [-2, 3], [3]]
+    lineage = karp_luby.LineageMatrix(
+        terms, 3, [0, 0.5, 0.5, 0.5],
+        karp_luby.AliasTable(numpy.array([0.25, 0.25, 0.5])))
+    truth = numpy.array([[False, True, True, True],
+                         [False, False, False, True],
+                         [False, False, False, False]])
+    assert list(lineage.countSatisfied(truth)) == [2, 2, 0]
+    lineage.forceTerms(truth, numpy.array([0, 0, 1]))
+    assert list(truth[1]) == [False, True, True, True]
+    assert list(truth[2]) == [False, False, False, True]
+    assert list(lineage.countSatisfied(truth)) == [2, 2, 2]
+    estimates = lineage.sampleBatch(100)
+    assert len(estimates) == 100
+    assert ((estimates > 0) & (estimates <= 1)).all()
+    # a repeated literal, and a term that can never be satisfied
+    lineage = karp_luby.LineageMatrix(
+        [[1, 1, -2], [1, -1]], 2, [0, 0.5, 0.5],
+        karp_luby.AliasTable(numpy.array([1.0, 0.0])))
+    truth = numpy.array([[False, True, False], [False, True, True],
+                         [False, False, False]])
+    assert list(lineage.countSatisfied(truth)) == [1, 0, 0]
+
+def test_karp_luby_original_step_draws_lazily():
+    kl = karp_luby.KarpLuby(None)
+    terms = karp_luby.lineageFromTerms([[1], [1, 2], [-3]])
+    kl.occurrences = karp_luby.OccurrenceIndex(terms, 3)
+    assert kl.occurrences[1] == [(0, True), (1, True)]
+    assert kl.occurrences[3] == [(2, False)]
+    assert kl.occurrences.before(1, 1) == [(0, True)]
+    assert kl.occurrences.before(1, 0) == []
+    assert kl.occurrences.before(3, 3) == [(2, False)]
+    varProbs = [0, 0.5, 0.5, 0.5]
+    # the first term is always the first satisfied term picked
+    assert kl.doSampleStepOriginal(terms, [1., 0., 0.], 3, 3, varProbs) == 1
+    # the first term covers the second whenever the second is picked
+    assert kl.doSampleStepOriginal(terms, [0., 1., 0.], 3, 3, varProbs) == 0
+
+def test_alias_table_picks_by_probability():
+    table = karp_luby.AliasTable(numpy.array([0.1, 0.0, 0.6, 0.3]))
+    assert table.prob[1] == 0
+    picks = table.pickBatch(100000)
+    frequencies = numpy.bincount(picks, minlength=4) / 100000.0
+    assert frequencies[1] == 0
+    assert numpy.allclose(frequencies, [0.1, 0.0, 0.6, 0.3], atol=0.01)
+    assert table.pick() in [0, 2, 3]
+
+def test_lineage_packs_terms():
+    terms = [[1, 2], [-2, 3], [3]]
+    lineage = karp_luby.lineageFromTerms(terms)
+    assert len(lineage) == 3
+    assert list(lineage.termStarts) == [0, 2, 4, 5]
+    assert list(lineage) == terms
+    assert lineage[1] == [-2, 3]
+    occurrences = karp_luby.OccurrenceIndex(lineage, 3)
+    assert occurrences[2] == [(0, True), (1, False)]
+    assert occurrences[3] == [(1, True), (2, True)]
+
+def test_lineage_cache_round_trip(tmpdir):
+    path = str(tmpdir.join('lineage'))
+    karp_luby.saveLineage(path, {
+        'varProbs': [0, 0.5, 0.25], 'termStarts': [0, 2, 3],
+        'literals': [1, -2, 2], 'termProbs': [0.375, 0.25]})
+    arrays = karp_luby.loadLineage(path)
+    assert isinstance(arrays['literals'], numpy.memmap)
+    assert list(arrays['literals']) == [1, -2, 2]
+    assert list(karp_luby.Lineage(arrays['termStarts'],
+                                  arrays['literals'])) == [[1, -2], [2]]
+
+def test_self_adjusting_coverage_single_term(monkeypatch):
+    kl = karp_luby.KarpLuby(fake_db.Connection(), 'klm')
+    lineage = karp_luby.lineageFromTerms([[1, -2]])
+
+    def processLineage(lineageQuery, cur):
+        kl.sumTermProbs = 0.3 * 0.5
+        kl.aliasTable = karp_luby.AliasTable(numpy.array([1.0]))
+        return (3, numpy.array([0, 0.3, 0.5]), lineage, numpy.array([0.15]),
+                2, 1, kl.sumTermProbs, numpy.array([1.0]))
+    monkeypatch.setattr(kl, 'processLineage', processLineage)
+    monkeypatch.setattr(kl, 'prepareQuery', lambda query: '')
+    # every check finds the only term satisfied
+    assert abs(kl.sampleSelfAdjusting('', 0.5, 0.5) - 0.15) < 1e-12
+    assert kl.coverageNumTrials == kl.coverageNumSteps
+    # the counts of a run are not carried into the next one
+    kl.startRun(None)
+    assert kl.coverageNumTrials == kl.coverageNumSteps == 0
+
+def test_self_adjusting_coverage_needs_epsilon_and_delta():
+    kl = karp_luby.KarpLuby(None, 'klm')
+    with pytest.raises(Exception):
+        kl.karpLuby(None, 1000)
+    shell = query_parser.CommandLineParser()
+    shell.do_klestimator('klm')
+    assert shell.karpLubyRunnable()
+    shell.do_epsilon('0')
+    assert not shell.karpLubyRunnable()
+
+def test_seeded_runs_repeat_on_one_instance(monkeypatch):
+    conn = fake_db.Connection()
+    kl = karp_luby.KarpLuby(conn, seed=7)
+
+    # the lineage R1,~R2 v R2,R3 v ~R1,R3
+    def readLineage(lineageQuery, cur):
+        return {'varProbs': [0, 0.3, 0.5, 0.6], 'termStarts': [0, 2, 4, 6],
+                'literals': [1, -2, 2, 3, -1, 3],
+                'termProbs': [0.15, 0.3, 0.42]}
+    monkeypatch.setattr(kl, 'prepareQuery', lambda query: '')
+    monkeypatch.setattr(kl, 'readLineage', readLineage)
+    estimates = [kl.karpLuby(None, 500) for run in range(2)]
+    assert estimates[0] == estimates[1]
+    # each run has a cursor of its own, closed when the lineage is read
+    assert len(set(cur.name for cur in conn.cursors)) == 2
+    assert all(cur.closed for cur in conn.cursors)
@@ -0,0 +1,19 @@
+import numpy
+
+from safesample import naive, query_parser
+from safesample.algorithm import in_memory
+
+def test_naive_bitset_evaluation():
+    dnf = query_parser.parse("R(x),S(x,y),~T(y) v R(x),S(x,y),T(y)")
+    sampler = naive.NaiveSampler(None, 50)
+    assert "string_agg" in sampler.prepareQuery(dnf, 50)
+    joins = [sampler.getConjunctJoin(c) for c in dnf.getConjuncts()]
+    database = in_memory.InMemoryDatabase({
+        'R': ([(1,), (2,)], numpy.array([1., 0.])),
+        'S': ([(1, 2), (2, 3)], numpy.array([1., 1.])),
+        'T': ([(2,), (3,)], numpy.array([1., 1.]))})
+    evaluator = naive.BitsetEvaluator(joins, database)
+    # only R(1), S(1,2), T(2) holds
+    assert list(evaluator.sample(20)) == [True] * 20
+    database.tables['S'][1][0] = 0.
+    assert list(evaluator.sample(20)) == [False] * 20
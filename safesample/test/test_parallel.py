@@ -0,0 +1,28 @@
+import numpy
+
+from safesample import parallel
+from safesample.test import fake_db
+
+def test_sampling_pool_worker_streams():
+    pool = parallel.SamplingPool(
+        lambda conn, blockIndex: numpy.random.random_sample(4).tolist(), 2)
+    try:
+        samples = [pool.nextSample()[0] for i in range(40)]
+    finally:
+        pool.close()
+    assert len(set(samples)) == 40
+    assert pool.getStats().count == 40
+
+def test_sampling_pool_prepares_connections_first():
+    prepared = []
+    def sampleBlock(conn, blockIndex):
+        assert conn in prepared
+        return [blockIndex]
+    pool = parallel.SamplingPool(sampleBlock, 2, fake_db.Connection,
+                                 prepared.append)
+    assert prepared == []
+    try:
+        samples = [pool.nextSample()[0] for i in range(6)]
+    finally:
+        pool.close()
+    assert samples == range(6) and len(prepared) == 2
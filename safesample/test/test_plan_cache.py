@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+from safesample.algorithm import plan_cache, query_exp, query_sym
+
+def test_canonical_key_renaming():
+    R1 = query_sym.Relation('R', [query_sym.Variable('x')])
+    S1 = query_sym.Relation('S', [query_sym.Variable('x'), query_sym.Variable('y')])
+    R2 = query_sym.Relation('R', [query_sym.Variable('u')])
+    S2 = query_sym.Relation('S', [query_sym.Variable('u'), query_sym.Variable('v')])
+    dnf1 = query_exp.DNF([query_exp.ConjunctiveQuery([query_exp.Component([R1,S1])])])
+    dnf2 = query_exp.DNF([query_exp.ConjunctiveQuery([query_exp.Component([S2,R2])])])
+    assert plan_cache.canonicalKey(dnf1) == plan_cache.canonicalKey(dnf2)
+
+def test_canonical_key_structure():
+    S1 = query_sym.Relation('S', [query_sym.Variable('x'), query_sym.Variable('y')])
+    S2 = query_sym.Relation('S', [query_sym.Variable('y'), query_sym.Variable('x')])
+    S3 = query_sym.Relation('S', [query_sym.Variable('x'), query_sym.Variable('x')])
+    dnf1 = query_exp.DNF([query_exp.ConjunctiveQuery([query_exp.Component([S1,S2])])])
+    dnf2 = query_exp.DNF([query_exp.ConjunctiveQuery([query_exp.Component([S1,S3])])])
+    assert plan_cache.canonicalKey(dnf1) != plan_cache.canonicalKey(dnf2)
+
+def test_plan_cache_lru():
+    cache = plan_cache.PlanCache(maxSize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+def test_plan_cache_persistence(tmpdir):
+    path = str(tmpdir.join('plans.pickle'))
+    cache = plan_cache.PlanCache(path=path)
+    cache.put('a', (None, 'FAIL'))
+    cache.save()
+    assert plan_cache.PlanCache(path=path).get('a') == (None, 'FAIL')
+
+def test_plan_cache_ignores_unreadable_files(tmpdir):
+    path = str(tmpdir.join('plans.pickle'))
+    cache = plan_cache.PlanCache(path=path)
+    cache.put('a', (None, 'FAIL'))
+    cache.save()
+    contents = open(path, 'rb').read()
+    # a truncated file, a file of another format and a plan whose class is
+    # gone all start an empty cache
+    for data in [contents[:len(contents) // 2],
+                 "(I0\n(lp0\ntp1\n.", "(I1\n(lp0\n(S'a'\np1\n"
+                 "csafesample.algorithm.query_exp\nNoSuchPlan\np2\ntp3\n"
+                 "atp4\n."]:
+        open(path, 'wb').write(data)
+        assert len(plan_cache.PlanCache(path=path)) == 0
+
+def test_plan_cache_imports_first():
+    # plan_cache and equivalence are importable before algorithm
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    for module in ['plan_cache', 'equivalence']:
+        subprocess.check_call([
+            sys.executable, '-c',
+            'from safesample.algorithm import %s' % module], cwd=root)
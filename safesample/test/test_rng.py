@@ -0,0 +1,14 @@
+from safesample import naive, query_parser, rng
+
+def test_seeded_sampling_is_reproducible():
+    # the draw of safesample_uniform(1, 1, 'Smokes', 3)
+    assert rng.uniform(1, 1, 'Smokes', 3) == rng.uniform(1, 1, 'smokes', 3)
+    assert abs(rng.uniform(1, 1, 'Smokes', 3) - 0.658479597795) < 1e-12
+    assert rng.uniform(1, 2, 'Smokes', 3) != rng.uniform(1, 1, 'Smokes', 3)
+    dnf = query_parser.parse("R(x),S(x,y)")
+    sampler = naive.NaiveSampler(None, 10, seed=7)
+    querySQL = sampler.prepareQuery(dnf, 10, 7)
+    assert "random()" not in querySQL
+    assert "safesample_uniform(7, sample_ids.sample_id, 'R', R.id)" in querySQL
+    draws = [rng.blockRandomState(7, 3).random_sample(5) for i in range(2)]
+    assert list(draws[0]) == list(draws[1])
@@ -0,0 +1,20 @@
+from safesample import safe
+from safesample.test import fake_db
+
+def test_safe_sample_prepares_once():
+    conn = fake_db.Connection((0.5,))
+    ssExecutor = safe.SafeSample(conn, seed=3)
+    query = "select %(firstSample)s"
+    assert ssExecutor.sampleBlock(conn, query, 0) == [0.5]
+    assert ssExecutor.sampleBlock(conn, query, 1) == [0.5]
+    name = ssExecutor.statementName
+    assert conn.executed == [
+        ("PREPARE %s (integer) AS select $1" % name, None),
+        ("EXECUTE %s (%%(firstSample)s)" % name, {'firstSample': 1}),
+        ("EXECUTE %s (%%(firstSample)s)" % name, {'firstSample': 2})]
+    ssExecutor.closeRun()
+    assert conn.executed[-1] == ("DEALLOCATE %s" % name, None)
+    # runs sharing a connection name their statements and tables apart
+    other = safe.SafeSample(conn, seed=3)
+    assert other.statementName != name
+    assert other.runTablePrefix != ssExecutor.runTablePrefix
@@ -0,0 +1,31 @@
+import numpy
+
+from safesample import stats
+
+def test_running_stats_merge():
+    samples = [0.5, 1., 0., 0.25, 1., 0.75, 0.]
+    merged = stats.RunningStats()
+    for part in [samples[:3], samples[3:]]:
+        partStats = stats.RunningStats()
+        for x in part:
+            partStats.add(x)
+        merged.merge(partStats)
+    assert merged.count == len(samples)
+    assert abs(merged.getSum() - sum(samples)) < 1e-12
+    assert abs(merged.getVariance() - numpy.var(samples, ddof=1)) < 1e-12
+
+def test_sample_run_traces():
+    samples = [i % 3 / 2. for i in range(1000)]
+    decimated = stats.SampleRun('decimated', traceSize=16, scale=2.)
+    full = stats.SampleRun('full', scale=2.)
+    for x in samples:
+        decimated.add(x, 0.5)
+        full.add(x, 0.5)
+    (n, estimates) = decimated.getTrace()
+    assert len(n) <= 16 and n[-1] == 960
+    assert abs(estimates[-1] - 2 * numpy.mean(samples[:960])) < 1e-12
+    (n, estimates) = full.getTrace()
+    assert list(full.getSamples()) == samples
+    assert abs(estimates[9] - 2 * numpy.mean(samples[:10])) < 1e-12
+    assert abs(full.getEstimate() - 2 * numpy.mean(samples)) < 1e-12
+    assert full.getNumSamples() == 1000 and full.getMeanSampleTime() == 0.5